@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""cache_backends
+
+Time updating one hash cache entry as the number of tracked files grows, both written to disk after each update and
+batched with one write at the end.
+
+    python benchmarks/cache_backends.py [entries ...]
+"""
+
+from __future__ import print_function
+import sys
+import os
+import shutil
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keepuppy import JSONCacheBackend, SQLiteCacheBackend
+
+DEFAULT_ENTRY_COUNTS = [10, 100, 1000, 10000]
+UPDATE_COUNT = 50
+
+
+def create_file_info(index):
+    return {'last_changed': '2015-01-01 00:00:00', 'file_hash': '%032x' % index}
+
+
+def time_updates(backend, batched = False):
+    # Setting an entry only changes it in memory, so the time includes writing it to disk
+    time_start = time()
+    for index in range(UPDATE_COUNT):
+        backend.set('local|/path/to/file%d' % index, create_file_info(index + 1))
+        if not batched:
+            backend.flush()
+
+    if batched:
+        backend.flush()
+
+    return (time() - time_start) / UPDATE_COUNT
+
+
+def main():
+    entry_counts = [int(arg) for arg in sys.argv[1:]] or DEFAULT_ENTRY_COUNTS
+
+    print('%8s %16s %16s %16s %16s' % ('entries', 'json ms/update', 'sqlite ms/update',
+                                       'json batched', 'sqlite batched'))
+    for entry_count in entry_counts:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache = dict(('local|/path/to/file%d' % index, create_file_info(index)) for index in range(entry_count))
+
+            # Seed the JSON cache directly, as populating it one entry at a time is quadratic
+            json_backend = JSONCacheBackend(os.path.join(temp_dir, 'cache.json'))
+            json_backend.cache = cache
+            json_time = time_updates(json_backend)
+            json_time_batched = time_updates(json_backend, batched = True)
+
+            sqlite_backend = SQLiteCacheBackend(os.path.join(temp_dir, 'cache.sqlite'))
+            sqlite_backend.set_many(cache)
+            sqlite_time = time_updates(sqlite_backend)
+            sqlite_time_batched = time_updates(sqlite_backend, batched = True)
+            sqlite_backend.close()
+
+            print('%8d %16.3f %16.3f %16.3f %16.3f' % (entry_count, json_time * 1000, sqlite_time * 1000,
+                                                       json_time_batched * 1000, sqlite_time_batched * 1000))
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""hash_memory
+
+Compare peak memory of hashing a local file in one read against the chunked
+HashCache path.
+
+    python benchmarks/hash_memory.py [size_mb] [block_size]
+"""
+
+from __future__ import print_function
+import sys
+import os
+import resource
+import subprocess
+import tempfile
+from time import time
+from hashlib import md5
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keepuppy import FileLocal, HashCache
+
+DEFAULT_SIZE_MB = 256
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, MacOS X reports bytes
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+
+    return peak / 1024.0
+
+
+def hash_whole(file_name, block_size):
+    m = md5()
+    m.update(FileLocal(file_name).read())
+    return m.hexdigest()
+
+
+def hash_chunked(file_name, block_size):
+    return HashCache.calculate_hash_chunks(FileLocal(file_name).read_chunks(block_size))
+
+
+MODES = {
+    'whole': hash_whole,
+    'chunked': hash_chunked,
+}
+
+
+def run_mode(mode, file_name, block_size):
+    baseline = peak_rss_mb()
+    time_start = time()
+    file_hash = MODES[mode](file_name, block_size)
+    time_taken = time() - time_start
+
+    print('%s %s %.3f %.1f' % (mode, file_hash, time_taken, peak_rss_mb() - baseline))
+
+
+def create_file(size_mb):
+    block = os.urandom(1024 * 1024)
+    with tempfile.NamedTemporaryFile(delete = False) as file_object:
+        for _ in range(size_mb):
+            file_object.write(block)
+
+        return file_object.name
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SIZE_MB
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BLOCK_SIZE
+
+    file_name = create_file(size_mb)
+    try:
+        print('File size %d MB, block size %d bytes' % (size_mb, block_size))
+        print('%-8s %-32s %8s %14s' % ('mode', 'hash', 'seconds', 'peak delta MB'))
+
+        for mode in sorted(MODES):
+            # Run each mode in a fresh interpreter so peak RSS is not shared
+            output = subprocess.check_output([sys.executable, __file__, '--mode', mode, file_name, str(block_size)])
+            mode, file_hash, time_taken, peak = output.decode('utf-8').split()
+            print('%-8s %-32s %8s %14s' % (mode, file_hash, time_taken, peak))
+
+    finally:
+        os.unlink(file_name)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--mode':
+        run_mode(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+
+    else:
+        main()
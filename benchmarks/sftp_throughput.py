@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""sftp_throughput
+
+Compare SFTP upload and download speed with and without pipelining, through
+the test server with latency added to each direction.
+
+    python benchmarks/sftp_throughput.py [size_mb] [delay_ms] [window_size]
+"""
+
+from __future__ import print_function
+import sys
+import os
+import shutil
+import tempfile
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keepuppy import FileSFTP
+from keepuppy.pool import SFTPConnectionPool
+from keepuppy.tests.sftp_server import SFTPAuth, SFTPServer, LatencyProxy
+
+DEFAULT_SIZE_MB = 4
+DEFAULT_DELAY_MS = 25
+DEFAULT_WINDOW_SIZE = 8 * 1024 * 1024
+BLOCK_SIZE = 64 * 1024
+SETUP_DELAY = 1.0
+
+
+def time_mode(file_name, size_mb, pipelined, window_size):
+    pool = SFTPConnectionPool(window_size = window_size)
+    file_object = FileSFTP(file_name,
+                           SFTPAuth.user_name,
+                           SFTPAuth.password,
+                           LatencyProxy.host_name,
+                           LatencyProxy.host_port,
+                           server_hash = False,
+                           pool = pool,
+                           pipelined = pipelined)
+
+    file_data = b'\0' * BLOCK_SIZE
+    block_count = size_mb * 1024 * 1024 // BLOCK_SIZE
+    try:
+        # Connect first so the handshake is not timed
+        file_object.open()
+
+        time_start = time()
+        file_object.write_chunks(file_data for index in range(block_count))
+        upload_time = time() - time_start
+
+        time_start = time()
+        for file_data in file_object.read_chunks(BLOCK_SIZE):
+            pass
+        download_time = time() - time_start
+
+    finally:
+        file_object.close()
+        pool.close_all()
+
+    return size_mb / upload_time, size_mb / download_time
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SIZE_MB
+    delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else DEFAULT_DELAY_MS / 1000.0
+    window_size = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_WINDOW_SIZE
+
+    temp_dir = tempfile.mkdtemp()
+    sftp_server = SFTPServer(temp_dir)
+    sftp_server.daemon = True
+    sftp_server.start()
+    latency_proxy = LatencyProxy(SFTPServer.host_name, SFTPServer.host_port, delay)
+    latency_proxy.start()
+    sleep(SETUP_DELAY)
+
+    try:
+        print('%d MB, %.0f ms round trip' % (size_mb, delay * 2000))
+        print('%-24s %12s %14s' % ('mode', 'upload MB/s', 'download MB/s'))
+        for mode, pipelined, mode_window_size in [('lock-step', False, None),
+                                                  ('pipelined', True, None),
+                                                  ('pipelined, window %d' % window_size, True, window_size)]:
+            upload_speed, download_speed = time_mode('benchmark.dat', size_mb, pipelined, mode_window_size)
+            print('%-24s %12.2f %14.2f' % (mode, upload_speed, download_speed))
+
+    finally:
+        latency_proxy.stop()
+        sftp_server.stop()
+        sftp_server.join()
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""suite
+
+Time hashing, syncing and SFTP transfers against the in-process test server,
+and compare the results of two runs.
+
+    python benchmarks/suite.py run [--output results.json] [--sizes 4K,1M] [--repeat 3] [--delay-ms 0]
+    python benchmarks/suite.py compare base.json new.json [--threshold 10]
+"""
+
+from __future__ import print_function
+import sys
+import os
+import json
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+import logging
+from time import time, sleep
+from timeit import default_timer
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PACKAGE_DIR)
+
+import keepuppy
+from keepuppy import FileLocal, FileSFTP, HashCache, Syncer
+from keepuppy.pool import SFTPConnectionPool
+from keepuppy.tests.sftp_server import SFTPAuth, SFTPServer, LatencyProxy
+
+DEFAULT_SIZES = '4K,64K,1M,16M,128M,500M'
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 10.0
+HASH_SIZE = 1024 * 1024
+SYNC_SIZE = 256 * 1024
+BLOCK_SIZE = 64 * 1024
+SETUP_DELAY = 1.0
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1:] in SIZE_UNITS:
+        return int(size[:-1]) * SIZE_UNITS[size[-1]]
+
+    return int(size)
+
+
+def format_size(size):
+    for unit in ['G', 'M', 'K']:
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return '%d%s' % (size // SIZE_UNITS[unit], unit)
+
+    return str(size)
+
+
+def file_chunks(size, fill = b'\xa5'):
+    block = fill * BLOCK_SIZE
+    while size > 0:
+        yield block[:min(size, BLOCK_SIZE)]
+        size -= BLOCK_SIZE
+
+
+def measure(func_run, repeat, func_setup = None, size = None):
+    times = []
+    for index in range(repeat):
+        if func_setup:
+            func_setup()
+
+        time_start = default_timer()
+        func_run()
+        times.append(default_timer() - time_start)
+
+    times_sorted = sorted(times)
+    result = {
+        'times': times,
+        'min': times_sorted[0],
+        'median': times_sorted[len(times_sorted) // 2]
+    }
+    if size:
+        result['bytes'] = size
+        result['mb_per_s'] = size / (1024.0 * 1024.0) / result['median'] if result['median'] > 0 else None
+
+    return result
+
+
+class Environment(object):
+    """A test SFTP server, optionally behind a delay, with a local directory alongside."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+        self.server_dir = tempfile.mkdtemp()
+        self.local_dir = tempfile.mkdtemp()
+        self.pool = SFTPConnectionPool(idle_timeout = None)
+
+        self.sftp_server = SFTPServer(self.server_dir)
+        self.sftp_server.daemon = True
+        self.latency_proxy = LatencyProxy(SFTPServer.host_name, SFTPServer.host_port, delay) if delay else None
+
+    def __enter__(self):
+        self.sftp_server.start()
+        if self.latency_proxy:
+            self.latency_proxy.start()
+
+        sleep(SETUP_DELAY)
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.pool.close_all()
+
+        if self.latency_proxy:
+            self.latency_proxy.stop()
+
+        self.sftp_server.stop()
+        self.sftp_server.join()
+
+        shutil.rmtree(self.server_dir)
+        shutil.rmtree(self.local_dir)
+
+    def file_local(self, file_name):
+        return FileLocal(os.path.join(self.local_dir, file_name))
+
+    @property
+    def host_port(self):
+        return LatencyProxy.host_port if self.latency_proxy else SFTPServer.host_port
+
+    def file_remote(self, file_name):
+        # The test server's check-file does not finish on larger files, so hashes are calculated here
+        return FileSFTP(file_name,
+                        SFTPAuth.user_name,
+                        SFTPAuth.password,
+                        SFTPServer.host_name,
+                        self.host_port,
+                        server_hash = False,
+                        pool = self.pool)
+
+    def write_remote(self, file_name, file_data, mtime):
+        # Files are placed on the server directly, so their times can be set
+        file_name_full = os.path.join(self.server_dir, file_name)
+        with open(file_name_full, 'wb') as file_object:
+            file_object.write(file_data)
+
+        os.utime(file_name_full, (mtime, mtime))
+
+    def write_local(self, file_name, file_data, mtime):
+        file_name_full = os.path.join(self.local_dir, file_name)
+        with open(file_name_full, 'wb') as file_object:
+            file_object.write(file_data)
+
+        os.utime(file_name_full, (mtime, mtime))
+
+    def cache_file_name(self):
+        return os.path.join(self.local_dir, 'cache.json')
+
+
+def benchmark_hash(environment, repeat):
+    results = {}
+    file_data = b''.join(file_chunks(HASH_SIZE))
+    mtime = int(time()) - 60
+    environment.write_local('hash.dat', file_data, mtime)
+    environment.write_remote('hash.dat', file_data, mtime)
+
+    for source_type, file_object in [('local', environment.file_local('hash.dat')),
+                                     ('sftp', environment.file_remote('hash.dat'))]:
+        hash_cache = {}
+
+        def setup_cold():
+            if os.path.exists(environment.cache_file_name()):
+                os.unlink(environment.cache_file_name())
+
+            hash_cache['cache'] = HashCache(environment.cache_file_name())
+            file_object.invalidate_stat()
+
+        def setup_warm():
+            file_object.invalidate_stat()
+
+        results['get_hash.%s.cold' % source_type] = measure(lambda: hash_cache['cache'].get_hash(file_object),
+                                                            repeat,
+                                                            setup_cold,
+                                                            HASH_SIZE)
+        results['get_hash.%s.warm' % source_type] = measure(lambda: hash_cache['cache'].get_hash(file_object),
+                                                            repeat,
+                                                            setup_warm)
+
+    return results
+
+
+def benchmark_sync(environment, repeat):
+    results = {}
+    file_data = b''.join(file_chunks(SYNC_SIZE))
+    file_data_changed = b''.join(file_chunks(SYNC_SIZE, b'\x5a'))
+
+    # Each outcome starts from files in sync and known to the cache, then changes one or both sides
+    outcomes = [
+        ('up_to_date', False, False),
+        ('local_newer', True, False),
+        ('remote_newer', False, True),
+        ('conflict', True, True),
+    ]
+    for outcome, local_changed, remote_changed in outcomes:
+        file_name = 'sync_%s.dat' % outcome
+        file_local = environment.file_local(file_name)
+        file_remote = environment.file_remote(file_name)
+        state = {}
+
+        def setup():
+            if os.path.exists(environment.cache_file_name()):
+                os.unlink(environment.cache_file_name())
+
+            mtime = int(time()) - 60
+            environment.write_local(file_name, file_data, mtime)
+            environment.write_remote(file_name, file_data, mtime)
+
+            hash_cache = HashCache(environment.cache_file_name())
+            state['syncer'] = Syncer(hash_cache)
+            state['syncer'].sync(file_local, file_remote)
+
+            if local_changed:
+                environment.write_local(file_name, file_data_changed, mtime + 10)
+
+            if remote_changed:
+                environment.write_remote(file_name, file_data_changed + b'remote', mtime + 20)
+
+        results['sync.%s' % outcome] = measure(lambda: state['syncer'].sync(file_local, file_remote), repeat, setup)
+
+    return results
+
+
+def benchmark_startup(environment, repeat):
+    results = {}
+
+    def run_python(*args, **kwargs):
+        subprocess.check_call([sys.executable] + list(args), cwd = PACKAGE_DIR, stdout = subprocess.PIPE, **kwargs)
+
+    results['startup.import'] = measure(lambda: run_python('-c', 'import keepuppy'), repeat)
+
+    # A whole run of the script with nothing to do, from starting Python to exiting
+    file_name = 'startup.dat'
+    file_data = b''.join(file_chunks(SYNC_SIZE))
+    mtime = int(time()) - 60
+    environment.write_local(file_name, file_data, mtime)
+    environment.write_remote(file_name, file_data, mtime)
+
+    if os.path.exists(environment.cache_file_name()):
+        os.unlink(environment.cache_file_name())
+
+    Syncer(HashCache(environment.cache_file_name())).sync(environment.file_local(file_name), environment.file_remote(file_name))
+
+    env = dict(os.environ)
+    env.update({
+        'KEEPUPPY_CACHE_FILE': environment.cache_file_name(),
+        'KEEPUPPY_LOCAL_FILE': environment.file_local(file_name).name,
+        'KEEPUPPY_REMOTE_FILE': file_name,
+        'KEEPUPPY_SFTP_USER_NAME': SFTPAuth.user_name,
+        'KEEPUPPY_SFTP_PASSWORD': SFTPAuth.password,
+        'KEEPUPPY_SFTP_HOST_NAME': SFTPServer.host_name,
+        'KEEPUPPY_SFTP_HOST_PORT': str(environment.host_port),
+        'KEEPUPPY_SFTP_SERVER_HASH': '0',
+    })
+    for name, fast_check in [('startup.noop_sync', '0'), ('startup.noop_sync_fast', '1')]:
+        env['KEEPUPPY_FAST_CHECK'] = fast_check
+        results[name] = measure(lambda: run_python('keepuppy_sync.py', env = env, stderr = subprocess.PIPE), repeat)
+
+    return results
+
+
+def benchmark_transfer(environment, repeat, sizes):
+    results = {}
+    for size in sizes:
+        file_remote = environment.file_remote('transfer_%s.dat' % format_size(size))
+
+        results['sftp.write.%s' % format_size(size)] = measure(lambda: file_remote.write_chunks(file_chunks(size)),
+                                                               repeat,
+                                                               size = size)
+
+        def read():
+            for file_data in file_remote.read_chunks(BLOCK_SIZE):
+                pass
+
+        results['sftp.read.%s' % format_size(size)] = measure(read, repeat, size = size)
+
+        os.unlink(os.path.join(environment.server_dir, file_remote.name))
+
+    return results
+
+
+def command_run(args):
+    sizes = [parse_size(size) for size in args.sizes.split(',') if size.strip()]
+
+    results = {}
+    with Environment(args.delay_ms / 1000.0) as environment:
+        for name, func_benchmark in [('hash', lambda: benchmark_hash(environment, args.repeat)),
+                                     ('sync', lambda: benchmark_sync(environment, args.repeat)),
+                                     ('startup', lambda: benchmark_startup(environment, args.repeat)),
+                                     ('transfer', lambda: benchmark_transfer(environment, args.repeat, sizes))]:
+            print('Running %s benchmarks' % name, file = sys.stderr)
+            results.update(func_benchmark())
+
+    report = {
+        'meta': {
+            'keepuppy_version': keepuppy.__version__,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'time': int(time()),
+            'repeat': args.repeat,
+            'delay_ms': args.delay_ms,
+        },
+        'results': results
+    }
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent = 2, sort_keys = True)
+
+
+def print_results(results):
+    print('%-28s %12s %12s %10s' % ('benchmark', 'median ms', 'min ms', 'MB/s'))
+    for name in sorted(results):
+        result = results[name]
+        mb_per_s = result.get('mb_per_s')
+        print('%-28s %12.3f %12.3f %10s' % (name,
+                                             result['median'] * 1000,
+                                             result['min'] * 1000,
+                                             '%.2f' % mb_per_s if mb_per_s else ''))
+
+
+def command_compare(args):
+    with open(args.base) as base_file:
+        base_results = json.load(base_file)['results']
+
+    with open(args.new) as new_file:
+        new_results = json.load(new_file)['results']
+
+    regressions = []
+    print('%-28s %12s %12s %9s' % ('benchmark', 'base ms', 'new ms', 'change'))
+    for name in sorted(set(base_results) | set(new_results)):
+        if name not in base_results or name not in new_results:
+            print('%-28s %s' % (name, 'only in new' if name in new_results else 'only in base'))
+            continue
+
+        base_median = base_results[name]['median']
+        new_median = new_results[name]['median']
+        change = (new_median - base_median) / base_median * 100 if base_median > 0 else 0.0
+
+        flag = ''
+        if change > args.threshold:
+            flag = ' slower'
+            regressions.append(name)
+
+        elif change < -args.threshold:
+            flag = ' faster'
+
+        print('%-28s %12.3f %12.3f %+8.1f%%%s' % (name, base_median * 1000, new_median * 1000, change, flag))
+
+    # A non-zero exit lets a build fail on regressions
+    if regressions:
+        print('%d of the benchmarks are more than %.0f%% slower' % (len(regressions), args.threshold))
+        return 1
+
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark keepuppy and compare results.')
+    subparsers = parser.add_subparsers(dest = 'command')
+
+    parser_run = subparsers.add_parser('run', help = 'run the benchmarks')
+    parser_run.add_argument('--output', help = 'file to write the results to as JSON')
+    parser_run.add_argument('--sizes', default = DEFAULT_SIZES, help = 'comma separated SFTP transfer sizes (default %s)' % DEFAULT_SIZES)
+    parser_run.add_argument('--repeat', type = int, default = DEFAULT_REPEAT, help = 'times to run each benchmark (default %d)' % DEFAULT_REPEAT)
+    parser_run.add_argument('--delay-ms', type = float, default = 0, help = 'delay added to SFTP traffic in each direction')
+
+    parser_compare = subparsers.add_parser('compare', help = 'compare two sets of results')
+    parser_compare.add_argument('base', help = 'results to compare against')
+    parser_compare.add_argument('new', help = 'results to compare')
+    parser_compare.add_argument('--threshold', type = float, default = DEFAULT_THRESHOLD, help = 'percentage change reported as a regression (default %.0f)' % DEFAULT_THRESHOLD)
+
+    args = parser.parse_args()
+
+    # Missing cache files and closed test connections are expected here
+    logging.getLogger('keepuppy').setLevel(logging.ERROR)
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+    if args.command == 'run':
+        command_run(args)
+
+    elif args.command == 'compare':
+        sys.exit(command_compare(args))
+
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
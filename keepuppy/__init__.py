@@ -11,5 +11,13 @@ __license__ = 'MIT'
 __copyright__ = 'Copyright (c) 2014 Warren Moore'
 
 from .files import FileLocal, FileSFTP
-from .sync import Syncer, HashCache
+from .sync import Syncer, HashCache, SyncResult
+from .cache import JSONCacheBackend, SQLiteCacheBackend
+from .transfer import Transfer, transfer
+from .delta import DeltaTransfer
+from .backup import BackupStore
+from .manifest import RemoteManifest
+from .lease import RemoteLease, RemoteLocker
+from .metrics import SyncMetrics, JSONLinesExporter, PrometheusTextfileExporter
+from .watch import create_watcher
 from .exceptions import FileException, HashCacheException, SyncException
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio versions of the file backends and Syncer, for Python 3.5 or later.
+
+paramiko and file IO are blocking, so each step of a sync runs on a small
+thread pool. Each pool thread has its own SFTP session on the one shared
+connection per server, so the pool size bounds the sessions, while any
+number of syncs wait their turn on the event loop.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from timeit import default_timer
+import logging
+
+from .files import FileLocal, FileSFTP
+from .sync import Syncer, SyncResult, plan_sync
+from .exceptions import FileException, HashCacheException, SyncException
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SESSIONS = 4
+DEFAULT_CONCURRENCY = 100
+
+
+class AsyncFileBase(object):
+    """Awaitable calls to a blocking file object, run on an executor."""
+
+    def __init__(self, file_object, executor = None):
+        self.file_object = file_object
+        self.executor = executor
+
+    @property
+    def name(self):
+        return self.file_object.name
+
+    @property
+    def key(self):
+        return self.file_object.key
+
+    @property
+    def source_type(self):
+        return self.file_object.source_type
+
+    def invalidate_stat(self):
+        self.file_object.invalidate_stat()
+
+    def _run(self, func, *args, **kwargs):
+        return asyncio.get_event_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def stat(self):
+        return await self._run(self.file_object.stat)
+
+    async def exists(self):
+        return await self._run(self.file_object.exists)
+
+    async def fingerprint(self):
+        return await self._run(self.file_object.fingerprint)
+
+    async def server_hash(self):
+        return await self._run(self.file_object.server_hash)
+
+    async def read(self):
+        return await self._run(self.file_object.read)
+
+    async def write(self, file_data):
+        return await self._run(self.file_object.write, file_data)
+
+    async def rename(self, file_name):
+        return await self._run(self.file_object.rename, file_name)
+
+    async def copy(self, file_name):
+        return await self._run(self.file_object.copy, file_name)
+
+
+class AsyncFileLocal(AsyncFileBase):
+    """A local file with awaitable calls."""
+
+    def __init__(self, file_name, executor = None):
+        super(AsyncFileLocal, self).__init__(FileLocal(file_name), executor)
+
+
+class AsyncFileSFTP(AsyncFileBase):
+    """A file on an SFTP server with awaitable calls."""
+
+    def __init__(self, file_name, user_name, password, host_name, host_port, executor = None, **kwargs):
+        super(AsyncFileSFTP, self).__init__(FileSFTP(file_name, user_name, password, host_name, host_port, **kwargs),
+                                            executor)
+
+
+def unwrap_file(file_object):
+    return file_object.file_object if isinstance(file_object, AsyncFileBase) else file_object
+
+
+class AsyncSyncer(object):
+    """Sync files from asyncio, making the same decisions as Syncer, with a bounded number running at once."""
+
+    def __init__(self, hash_cache, sessions = DEFAULT_SESSIONS, concurrency = DEFAULT_CONCURRENCY, executor = None, **kwargs):
+        # Syncer does the work of each step, the keyword arguments are passed to it
+        self._syncer = Syncer(hash_cache, **kwargs)
+
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers = sessions)
+        self._concurrency = concurrency
+        self._semaphore = None
+
+    @property
+    def hash_cache(self):
+        return self._syncer.hash_cache
+
+    @property
+    def metrics(self):
+        return self._syncer.metrics
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown(wait = True)
+
+    async def sync(self, file_local, file_remote):
+        # Created on first use, so it belongs to the loop the syncs run on
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+
+        async with self._semaphore:
+            time_start = default_timer()
+            try:
+                self.hash_cache.begin_batch()
+                try:
+                    status = await self._sync(unwrap_file(file_local), unwrap_file(file_remote))
+
+                finally:
+                    await self._end_batch()
+
+            except SyncException:
+                self.metrics.increment('sync_errors')
+                raise
+
+            finally:
+                self.metrics.add_phase_time('sync', default_timer() - time_start)
+
+            self.metrics.increment('syncs')
+            return status
+
+    async def sync_many(self, file_pairs):
+        async def sync_pair(file_local, file_remote):
+            try:
+                return SyncResult(file_local, file_remote, await self.sync(file_local, file_remote), None)
+
+            except asyncio.CancelledError:
+                # Before Python 3.8 this is an Exception, but cancelling must not be reported as a failed sync
+                raise
+
+            except Exception as e:
+                log.error('Failed to sync (%s) (%s) (%s)' % (file_local.name if file_local else None,
+                                                            file_remote.name if file_remote else None,
+                                                            e))
+                return SyncResult(file_local, file_remote, None, e)
+
+        # Cache changes are written once at the end, cancelling this cancels every sync not yet finished
+        self.hash_cache.begin_batch()
+        try:
+            return await asyncio.gather(*[sync_pair(file_local, file_remote) for file_local, file_remote in file_pairs])
+
+        finally:
+            await self._end_batch()
+
+    def _run(self, func, *args, **kwargs):
+        return asyncio.get_event_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def _end_batch(self):
+        # Writing the cache can take a while, e.g. an fsync, so is not done on the event loop
+        if self.hash_cache.end_batch(flush = False):
+            await self._run(self.hash_cache.flush)
+
+    async def _sync(self, file_local, file_remote):
+        # A cancelled sync stops between steps, a step already running on the executor finishes first
+        for file_object in (file_local, file_remote):
+            if file_object:
+                file_object.invalidate_stat()
+
+        info_local, info_remote = await self._get_hashes(file_local, file_remote)
+
+        log.debug('File info local (%s)' % info_local)
+        log.debug('File info remote (%s)' % info_remote)
+
+        sync_plan = plan_sync(info_local, info_remote)
+
+        # Waiting for and holding a lease is one step, so it is always released by the thread that took it
+        if self._syncer.needs_lease(sync_plan):
+            return await self._run(self._syncer.sync_leased, file_local, file_remote, info_local, info_remote)
+
+        await self._run(self._syncer.run_backup, sync_plan, file_local, info_local)
+        file_hash = await self._run(self._syncer.run_copy, sync_plan, file_local, file_remote)
+        await self._run(self._syncer.run_finish, sync_plan, file_local, file_remote, file_hash)
+
+        return sync_plan.status
+
+    async def _get_hashes(self, file_local, file_remote):
+        info_local, info_remote = await asyncio.gather(self._get_hash(file_local),
+                                                       self._get_hash(file_remote, True),
+                                                       return_exceptions = True)
+
+        # Local errors are reported first, as by Syncer
+        for file_info, message in [(info_local, 'Local file error'), (info_remote, 'Remote file error')]:
+            if isinstance(file_info, (FileException, HashCacheException)):
+                raise SyncException(message, file_info)
+
+            elif isinstance(file_info, BaseException):
+                raise file_info
+
+        return info_local, info_remote
+
+    async def _get_hash(self, file_object, remote = False):
+        if not file_object:
+            return None
+
+        return await self._run(self._syncer.get_file_info, file_object, remote)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+from .exceptions import FileException
+from .files import DEFAULT_BLOCK_SIZE, replace_file, write_file_atomic
+from hashlib import md5
+from itertools import chain
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+import json
+import os
+import zlib
+import threading
+import logging
+
+try:
+    import lzma
+
+except ImportError:
+    lzma = None
+
+try:
+    import fcntl
+
+except ImportError:
+    fcntl = None
+
+DECOMPRESS_ERRORS = (IOError, EOFError, zlib.error) + ((lzma.LZMAError,) if lzma else ())
+
+log = logging.getLogger(__name__)
+
+BACKUP_TIME_FORMAT = '%Y%m%d_%H%M%S'
+DEFAULT_MAX_COUNT = 50
+DEFAULT_MAX_AGE_DAYS = 90
+ZLIB_LEVEL = 9
+
+BLOB_EXTENSIONS = {
+    'lzma': '.xz',
+    'zlib': '.zz',
+}
+
+
+class BackupStore(object):
+    """Keep each distinct version of a file once, compressed and named by its hash, with an index of when each was backed up."""
+
+    def __init__(self, store_dir, max_count = DEFAULT_MAX_COUNT, max_age_days = DEFAULT_MAX_AGE_DAYS, compression = None):
+        self.store_dir = os.path.expanduser(store_dir)
+        self.index_file_name = os.path.join(self.store_dir, 'index.json')
+
+        # A max count or age of None keeps backups forever
+        self.max_count = max_count
+        self.max_age_days = max_age_days
+
+        # lzma compresses better but is not in the Python 2 standard library
+        self.compression = compression or ('lzma' if lzma else 'zlib')
+        if self.compression not in BLOB_EXTENSIONS or (self.compression == 'lzma' and not lzma):
+            raise FileException('Unsupported backup compression (%s)' % self.compression)
+
+        self.lock_file_name = os.path.join(self.store_dir, 'index.lock')
+
+        self._lock = threading.Lock()
+        self._index = {}
+        self._index_mtime = 0
+
+        try:
+            os.makedirs(os.path.join(self.store_dir, 'blobs'))
+
+        except OSError:
+            if not os.path.isdir(os.path.join(self.store_dir, 'blobs')):
+                raise FileException('Unable to create backup store (%s)' % self.store_dir)
+
+        self._load_index()
+
+    def backup(self, file_object, file_hash = None, conflict = False):
+        # A version already held, known from the hash cache, is only added to the index. The blob is written with the
+        # index locked, so another process cannot prune it before it is added.
+        with self._index_locked():
+            blob_file_name = self._find_blob(file_hash) if file_hash else None
+            if blob_file_name:
+                log.debug('Backup of (%s) already held (%s)' % (file_object.name, file_hash))
+
+            else:
+                file_hash = self._write_blob(file_object)
+
+            entry = {
+                'time': datetime.utcnow().strftime(BACKUP_TIME_FORMAT),
+                'file_hash': file_hash,
+                'conflict': conflict
+            }
+            log.info('Backing up (%s) as (%s)' % (file_object.name, file_hash))
+
+            self._index.setdefault(file_object.key, []).append(entry)
+            self._prune()
+            self._save_index()
+
+            return entry
+
+    def versions(self, file_object):
+        with self._lock:
+            self._load_index()
+            return list(self._index.get(file_object.key, []))
+
+    def restore(self, file_hash, file_object):
+        blob_file_name = self._find_blob(file_hash)
+        if not blob_file_name:
+            raise FileException('Backup not found (%s)' % file_hash)
+
+        # Read the first chunk before the destination is opened, so a bad backup does not truncate it
+        chunks = self._read_blob(blob_file_name)
+        file_data = next(chunks, None)
+        if file_data is not None:
+            chunks = chain([file_data], chunks)
+
+        file_object.write_chunks(chunks)
+
+    def prune(self):
+        with self._index_locked():
+            self._prune()
+            self._save_index()
+
+    @contextmanager
+    def _index_locked(self):
+        # Other processes may share the store, e.g. the daemon and a sync run from cron, so the index is read again
+        # under an exclusive lock before every change rather than overwriting theirs
+        with self._lock:
+            try:
+                lock_file = open(self.lock_file_name, 'ab')
+
+            except IOError as e:
+                raise FileException('Unable to lock backup store (%s) (%s)' % (self.store_dir, e))
+
+            try:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+                self._load_index()
+                yield
+
+            finally:
+                # Closing the file releases the lock
+                lock_file.close()
+
+    def _blob_file_name(self, file_hash, compression):
+        return os.path.join(self.store_dir, 'blobs', file_hash[:2], file_hash + BLOB_EXTENSIONS[compression])
+
+    def _find_blob(self, file_hash):
+        # Blobs written before the compression was changed are still used
+        for compression in BLOB_EXTENSIONS:
+            blob_file_name = self._blob_file_name(file_hash, compression)
+            if os.path.exists(blob_file_name):
+                return blob_file_name
+
+        return None
+
+    def _compressor(self):
+        if self.compression == 'lzma':
+            return lzma.LZMACompressor()
+
+        return zlib.compressobj(ZLIB_LEVEL)
+
+    @staticmethod
+    def _decompressor(blob_file_name):
+        if blob_file_name.endswith(BLOB_EXTENSIONS['lzma']):
+            if not lzma:
+                raise FileException('Backup needs lzma to read (%s)' % blob_file_name)
+
+            return lzma.LZMADecompressor()
+
+        return zlib.decompressobj()
+
+    def _write_blob(self, file_object):
+        # The hash is only known once the file has been read, so compress to a temporary file and then name it
+        temp_file_name = os.path.join(self.store_dir, 'blobs', 'backup.%d.tmp' % os.getpid())
+        m = md5()
+        compressor = self._compressor()
+        try:
+            with open(temp_file_name, 'wb') as blob_file:
+                for file_data in file_object.read_chunks(DEFAULT_BLOCK_SIZE):
+                    m.update(file_data)
+                    blob_file.write(compressor.compress(file_data))
+
+                blob_file.write(compressor.flush())
+                blob_file.flush()
+                os.fsync(blob_file.fileno())
+
+            file_hash = m.hexdigest()
+            if not self._find_blob(file_hash):
+                blob_file_name = self._blob_file_name(file_hash, self.compression)
+                if not os.path.isdir(os.path.dirname(blob_file_name)):
+                    os.makedirs(os.path.dirname(blob_file_name))
+
+                replace_file(temp_file_name, blob_file_name)
+
+        except (IOError, OSError) as e:
+            raise FileException('Error writing backup of (%s) (%s)' % (file_object.name, e))
+
+        finally:
+            if os.path.exists(temp_file_name):
+                os.unlink(temp_file_name)
+
+        return file_hash
+
+    def _read_blob(self, blob_file_name):
+        decompressor = self._decompressor(blob_file_name)
+        try:
+            with open(blob_file_name, 'rb') as blob_file:
+                while True:
+                    blob_data = blob_file.read(DEFAULT_BLOCK_SIZE)
+                    if not blob_data:
+                        break
+
+                    yield decompressor.decompress(blob_data)
+
+            if hasattr(decompressor, 'flush'):
+                yield decompressor.flush()
+
+        except DECOMPRESS_ERRORS as e:
+            raise FileException('Error reading backup (%s) (%s)' % (blob_file_name, e))
+
+    def _prune(self):
+        time_limit = None
+        if self.max_age_days is not None:
+            time_limit = (datetime.utcnow() - timedelta(days = self.max_age_days)).strftime(BACKUP_TIME_FORMAT)
+
+        for key, entries in list(self._index.items()):
+            # Entries are added in time order, so keep the newest
+            if time_limit is not None:
+                entries = [entry for entry in entries if entry['time'] >= time_limit]
+
+            if self.max_count is not None:
+                entries = entries[-self.max_count:] if self.max_count > 0 else []
+
+            if entries:
+                self._index[key] = entries
+
+            else:
+                del self._index[key]
+
+        # Remove blobs no longer used by any backup. Blobs newer than the index may belong to a backup another process
+        # has not yet recorded, e.g. one that stopped part way, so are left for a later prune.
+        file_hashes = set(entry['file_hash'] for entries in self._index.values() for entry in entries)
+        blobs_dir = os.path.join(self.store_dir, 'blobs')
+        for blob_dir in os.listdir(blobs_dir):
+            blob_dir = os.path.join(blobs_dir, blob_dir)
+            if not os.path.isdir(blob_dir):
+                continue
+
+            for blob_file_name in os.listdir(blob_dir):
+                if os.path.splitext(blob_file_name)[0] in file_hashes:
+                    continue
+
+                blob_file_name = os.path.join(blob_dir, blob_file_name)
+                if os.stat(blob_file_name).st_mtime <= self._index_mtime:
+                    log.debug('Removing backup (%s)' % blob_file_name)
+                    os.unlink(blob_file_name)
+
+    def _load_index(self):
+        try:
+            with open(self.index_file_name, 'rb') as index_file:
+                self._index_mtime = os.fstat(index_file.fileno()).st_mtime
+                self._index = json.loads(index_file.read().decode('utf-8'))
+
+        except ValueError:
+            raise FileException('Backup index exists but does not contain valid data (%s)' % self.index_file_name)
+
+        except IOError:
+            self._index = {}
+            self._index_mtime = 0
+
+    def _save_index(self):
+        try:
+            write_file_atomic(self.index_file_name, json.dumps(self._index).encode('utf-8'))
+
+        except (IOError, OSError) as e:
+            raise FileException('Error writing backup index (%s) (%s)' % (self.index_file_name, e))
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+from .exceptions import HashCacheException
+from .files import write_file_atomic
+import json
+import os
+import sqlite3
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+SQLITE_TIMEOUT = 30
+
+
+class CacheBackendBase(object):
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, file_info):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JSONCacheBackend(CacheBackendBase):
+    """Keep every entry in memory and rewrite the whole JSON file when flushed."""
+
+    def __init__(self, cache_file_name):
+        self.cache_file_name = os.path.expanduser(cache_file_name)
+        self.cache = {}
+        self.dirty = False
+
+        self._load_hashes()
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, file_info):
+        self.cache[key] = file_info
+        self.dirty = True
+
+    def flush(self):
+        if self.dirty:
+            self._save_hashes()
+            self.dirty = False
+
+    def _load_hashes(self):
+        try:
+            with open(self.cache_file_name, 'rb') as file_object:
+                self.cache = json.load(file_object)
+
+        except ValueError:
+            raise HashCacheException('Cache file exists but does not contain valid data')
+
+        except IOError as e:
+            log.warning('Unable to load hash cache file (%s) (%s)' % (self.cache_file_name, e))
+
+    def _save_hashes(self):
+        # Written in full and renamed over the old file, so a crash never leaves a truncated cache
+        write_file_atomic(self.cache_file_name, json.dumps(self.cache).encode('utf-8'))
+
+
+class SQLiteCacheBackend(CacheBackendBase):
+    """Store one row per key, read on demand, with changes written in one transaction when flushed."""
+
+    def __init__(self, cache_file_name, migrate_file_name = None):
+        self.cache_file_name = os.path.expanduser(cache_file_name)
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        try:
+            # Connections are shared between sync threads, serialised by the lock
+            self._connection = sqlite3.connect(self.cache_file_name,
+                                               timeout = SQLITE_TIMEOUT,
+                                               check_same_thread = False)
+
+            with self._lock:
+                created = self._create_table()
+
+        except sqlite3.Error as e:
+            raise HashCacheException('Unable to open cache database (%s) (%s)' % (self.cache_file_name, e))
+
+        if created and migrate_file_name:
+            self._migrate(migrate_file_name)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+
+        try:
+            with self._lock:
+                row = self._connection.execute('SELECT file_info FROM file_hashes WHERE key = ?', (key,)).fetchone()
+
+        except sqlite3.Error as e:
+            raise HashCacheException('Unable to read cache database (%s) (%s)' % (self.cache_file_name, e))
+
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, file_info):
+        with self._lock:
+            self._pending[key] = file_info
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._write(self._pending)
+                self._pending = {}
+
+    def set_many(self, cache):
+        with self._lock:
+            self._write(cache)
+
+    def _write(self, cache):
+        try:
+            with self._connection:
+                self._connection.executemany('INSERT OR REPLACE INTO file_hashes (key, file_info) VALUES (?, ?)',
+                                             [(key, json.dumps(file_info)) for key, file_info in cache.items()])
+
+        except sqlite3.Error as e:
+            raise HashCacheException('Unable to write cache database (%s) (%s)' % (self.cache_file_name, e))
+
+    def close(self):
+        self.flush()
+
+        with self._lock:
+            self._connection.close()
+
+    def _create_table(self):
+        # Write-ahead logging lets other processes read while a sync is writing
+        self._connection.execute('PRAGMA journal_mode = WAL')
+
+        with self._connection:
+            created = self._connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'file_hashes'").fetchone() is None
+            self._connection.execute('CREATE TABLE IF NOT EXISTS file_hashes (key TEXT PRIMARY KEY, file_info TEXT NOT NULL)')
+
+        return created
+
+    def _migrate(self, migrate_file_name):
+        migrate_file_name = os.path.expanduser(migrate_file_name)
+        if not os.path.exists(migrate_file_name):
+            return
+
+        log.info('Migrating hash cache file (%s) to (%s)' % (migrate_file_name, self.cache_file_name))
+        self.set_many(JSONCacheBackend(migrate_file_name).cache)
+
+
+def create_cache_backend(cache_file_name):
+    cache_file_base, cache_file_extension = os.path.splitext(cache_file_name)
+    if cache_file_extension.lower() in SQLITE_EXTENSIONS:
+        # Pick up hashes from the JSON cache with the same name, e.g. ~/.keepuppy_cache.json
+        return SQLiteCacheBackend(cache_file_name, cache_file_base + '.json')
+
+    return JSONCacheBackend(cache_file_name)
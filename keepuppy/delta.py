@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+from .exceptions import FileException
+from hashlib import md5
+from operator import mul
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DELTA_BLOCK_SIZE = 2048
+DEFAULT_MAX_LITERAL_RATIO = 0.5
+
+# How much of a file is looked at before deciding a delta has too much new data
+DELTA_PROBE_SIZE = 256 * 1024
+
+CHECKSUM_MODULUS = 1 << 16
+
+INSTRUCTION_COPY = 'copy'
+INSTRUCTION_LITERAL = 'literal'
+
+
+def weak_checksum(data):
+    # The rsync rolling checksum, returned as its two halves so it can be rolled a byte at a time. Summed with map
+    # rather than a loop, as this is done for every block of every file sent with deltas enabled.
+    values = bytearray(data)
+    a = sum(values)
+    b = sum(map(mul, range(len(values), 0, -1), values))
+
+    return a % CHECKSUM_MODULUS, b % CHECKSUM_MODULUS
+
+
+def strong_checksum(data):
+    return md5(data).hexdigest()
+
+
+class SignatureBuilder(object):
+    """Build block signatures of data as it is streamed, without holding the whole file."""
+
+    def __init__(self, block_size = DEFAULT_DELTA_BLOCK_SIZE):
+        self._block_size = block_size
+        self._buffer = b''
+        self._blocks = []
+        self._file_size = 0
+        self._hash = md5()
+
+    def update(self, data):
+        self._file_size += len(data)
+        self._hash.update(data)
+
+        # Blocks are sliced from the buffer by offset, as cutting each off the front would copy the rest every time
+        self._buffer += data
+        offset = 0
+        while len(self._buffer) - offset >= self._block_size:
+            self._add_block(self._buffer[offset:offset + self._block_size])
+            offset += self._block_size
+
+        if offset:
+            self._buffer = self._buffer[offset:]
+
+    def signature(self):
+        blocks = list(self._blocks)
+        if self._buffer:
+            a, b = weak_checksum(self._buffer)
+            blocks.append([a | (b << 16), strong_checksum(self._buffer)])
+
+        return {
+            'block_size': self._block_size,
+            'file_size': self._file_size,
+            'file_hash': self._hash.hexdigest(),
+            'blocks': blocks
+        }
+
+    def _add_block(self, data):
+        a, b = weak_checksum(data)
+        self._blocks.append([a | (b << 16), strong_checksum(data)])
+
+
+def signature(chunks, block_size = DEFAULT_DELTA_BLOCK_SIZE):
+    signature_builder = SignatureBuilder(block_size)
+    for data in chunks:
+        signature_builder.update(data)
+
+    return signature_builder.signature()
+
+
+def block_length(file_signature, index):
+    block_size = file_signature['block_size']
+    return min(block_size, file_signature['file_size'] - index * block_size)
+
+
+def delta(file_signature, chunks):
+    """Yield copy and literal instructions that turn the signed data into the data from chunks."""
+    block_size = file_signature['block_size']
+
+    block_lookup = {}
+    for index, (weak, strong) in enumerate(file_signature['blocks']):
+        block_lookup.setdefault(weak, {}).setdefault(strong, index)
+
+    chunks = iter(chunks)
+    data = bytearray()
+    position = 0
+    literal_start = 0
+    checksum = None
+    eof = False
+
+    while True:
+        # Keep a block plus one byte ahead of the window so the checksum can roll
+        while not eof and len(data) - position <= block_size:
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+
+            else:
+                data.extend(chunk)
+
+        window_length = min(block_size, len(data) - position)
+        if window_length <= 0:
+            break
+
+        if checksum is None:
+            checksum = weak_checksum(data[position:position + window_length])
+
+        a, b = checksum
+        index = None
+        strong_lookup = block_lookup.get(a | (b << 16))
+        if strong_lookup:
+            window = bytes(data[position:position + window_length])
+            index = strong_lookup.get(strong_checksum(window))
+            if index is not None and block_length(file_signature, index) != window_length:
+                index = None
+
+        if index is not None:
+            if position > literal_start:
+                yield INSTRUCTION_LITERAL, bytes(data[literal_start:position])
+
+            yield INSTRUCTION_COPY, index
+
+            del data[:position + window_length]
+            position = 0
+            literal_start = 0
+            checksum = None
+            continue
+
+        if window_length == block_size and position + window_length < len(data):
+            # Roll the window on by one byte
+            byte_out = data[position]
+            byte_in = data[position + window_length]
+            a = (a - byte_out + byte_in) % CHECKSUM_MODULUS
+            b = (b - window_length * byte_out + a) % CHECKSUM_MODULUS
+            checksum = a, b
+
+        else:
+            checksum = None
+
+        position += 1
+
+        # Bound memory by sending literal data once a block of it has built up
+        if position - literal_start >= block_size:
+            yield INSTRUCTION_LITERAL, bytes(data[literal_start:position])
+
+            del data[:position]
+            position = 0
+            literal_start = 0
+
+    if len(data) > literal_start:
+        yield INSTRUCTION_LITERAL, bytes(data[literal_start:])
+
+
+def patch(file_signature, instructions, func_read_block):
+    """Yield the new data given the instructions and a function reading a block of the signed data."""
+    for instruction, value in instructions:
+        if instruction == INSTRUCTION_COPY:
+            yield func_read_block(value * file_signature['block_size'], block_length(file_signature, value))
+
+        else:
+            yield value
+
+
+def read_ranges(chunks, ranges):
+    """Yield the data at each of the increasing (offset, length) ranges of the streamed data."""
+    chunks = iter(chunks)
+    data = bytearray()
+    data_offset = 0
+    for offset, length in ranges:
+        while True:
+            # Drop what comes before the range as it is read, so little more than a chunk is held
+            skip = min(max(0, offset - data_offset), len(data))
+            del data[:skip]
+            data_offset += skip
+
+            if data_offset + len(data) >= offset + length:
+                break
+
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+
+            data.extend(chunk)
+
+        yield bytes(data[offset - data_offset:offset - data_offset + length])
+
+
+class DeltaTransfer(object):
+    """Update a destination that holds the signed data with only the blocks that have changed."""
+
+    def __init__(self,
+                 file_source,
+                 file_destination,
+                 file_signature,
+                 block_size,
+                 func_progress = None,
+                 max_literal_ratio = DEFAULT_MAX_LITERAL_RATIO):
+        self._file_source = file_source
+        self._file_destination = file_destination
+        self._file_signature = file_signature
+        self._block_size = block_size
+        self._func_progress = func_progress
+
+        # Beyond this share of new data a delta saves little, and finding it in Python costs more than sending the file
+        self._max_literal_ratio = max_literal_ratio
+
+        self.bytes_transferred = 0
+        self.file_hash = None
+        self.signature = None
+
+    def run(self):
+        # Returns None, leaving the destination untouched, if the server cannot confirm the result or too much of the
+        # data is new for a delta to be worthwhile
+        log.debug('Delta transfer (%s) to (%s)' % (self._file_source.key, self._file_destination.key))
+
+        # Check the destination is still the data the signature describes, and that the server can confirm the result
+        destination_hash = self._file_destination.server_hash()
+        if destination_hash is None:
+            log.debug('Delta transfer skipped, server cannot hash files (%s)' % self._file_destination.key)
+            return None
+
+        if destination_hash != self._file_signature['file_hash']:
+            raise FileException('Destination does not match delta signature (%s)' % self._file_destination.key)
+
+        signature_builder = SignatureBuilder(self._file_signature['block_size'])
+
+        def chunks():
+            for data in self._file_source.read_chunks(self._block_size):
+                signature_builder.update(data)
+                yield data
+
+        # Only the position of new data is kept, it is read again from the source as it is written, so memory use
+        # does not grow with the amount that has changed
+        instructions = []
+        literal_ranges = []
+        literal_size = 0
+        offset = 0
+        for instruction, value in delta(self._file_signature, chunks()):
+            if instruction == INSTRUCTION_COPY:
+                length = block_length(self._file_signature, value)
+                instructions.append((instruction, value))
+
+            else:
+                length = len(value)
+                instructions.append((instruction, length))
+                literal_ranges.append((offset, length))
+                literal_size += length
+
+                # Judged on what has been seen so far, after enough to be representative, so a file that is all new
+                # data is given up on early
+                if literal_size > self._max_literal_ratio * max(offset + length, DELTA_PROBE_SIZE):
+                    log.debug('Delta transfer abandoned, too much new data (%s)' % self._file_source.key)
+                    return None
+
+            offset += length
+
+        if literal_size > self._max_literal_ratio * offset:
+            log.debug('Delta transfer abandoned, too much new data (%s)' % self._file_source.key)
+            return None
+
+        self.signature = signature_builder.signature()
+        self.file_hash = self.signature['file_hash']
+
+        literal_data = read_ranges(self._file_source.read_chunks(self._block_size), literal_ranges)
+        self.bytes_transferred = self._file_destination.apply_delta(self._file_signature,
+                                                                    instructions,
+                                                                    self.signature['file_size'],
+                                                                    literal_data)
+        if self._func_progress:
+            self._func_progress(self._file_source, self._file_destination, self.bytes_transferred)
+
+        # Also catches the source changing between the two reads
+        if self._file_destination.server_hash() != self.file_hash:
+            raise FileException('Delta transfer verification failed (%s)' % self._file_destination.key)
+
+        return self.bytes_transferred
@@ -1,19 +1,113 @@
 # -*- coding: utf-8 -*-
 
 from .exceptions import FileException
+from .pool import connection_pool, load_paramiko, sftp_errors
+from .delta import INSTRUCTION_COPY, block_length
 import os
-import paramiko
-from datetime import datetime
-from shutil import copyfile
+import sys
+import errno
+import uuid
+import stat as stat_module
+from datetime import datetime, timedelta
+from shutil import copyfileobj
+from binascii import hexlify
+from collections import namedtuple
 import logging
 
+try:
+    import fcntl
+
+except ImportError:
+    fcntl = None
+
+try:
+    from shlex import quote
+
+except ImportError:
+    from pipes import quote
+
+try:
+    long
+
+except NameError:
+    long = int
+
 log = logging.getLogger(__name__)
 
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+
+FileStat = namedtuple('FileStat', ['size', 'mtime_ns', 'mode', 'inode'])
+
+
+def fingerprint_last_changed(fingerprint):
+    # Fingerprints are [mtime in nanoseconds, size, inode], kept as integers so they compare exactly
+    mtime_ns = fingerprint[0]
+    return datetime.fromtimestamp(mtime_ns // 1000000000) + timedelta(microseconds = (mtime_ns % 1000000000) // 1000)
+
+
+def replace_file(source_file_name, destination_file_name):
+    # os.rename will not replace an existing file on Windows, and os.replace is not available in Python 2
+    if hasattr(os, 'replace'):
+        os.replace(source_file_name, destination_file_name)
+
+    else:
+        if os.name == 'nt' and os.path.exists(destination_file_name):
+            os.unlink(destination_file_name)
+
+        os.rename(source_file_name, destination_file_name)
+
+
+def write_file_atomic(file_name, file_data):
+    write_chunks_atomic(file_name, [file_data])
+
+
+def write_chunks_atomic(file_name, chunks):
+    # Write a complete new file and rename it over the old one, so readers never see it partly written. A link is
+    # followed so the file it points to is replaced, and the new file keeps the old one's permissions, set before any
+    # data is written so it is never readable by more users than the old one.
+    file_name = os.path.realpath(file_name)
+    temp_file_name = '%s.%s.tmp' % (file_name, uuid.uuid4().hex)
+
+    try:
+        file_mode = stat_module.S_IMODE(os.stat(file_name).st_mode)
+
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+        file_mode = None
+
+    try:
+        file_descriptor = os.open(temp_file_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0),
+                                  0o666 if file_mode is None else file_mode)
+        with os.fdopen(file_descriptor, 'wb') as file_object:
+            # The umask applies to the mode given when creating it
+            if file_mode is not None:
+                os.chmod(temp_file_name, file_mode)
+
+            for file_data in chunks:
+                file_object.write(file_data)
+
+            file_object.flush()
+            os.fsync(file_object.fileno())
+
+        replace_file(temp_file_name, file_name)
+
+    finally:
+        if os.path.exists(temp_file_name):
+            os.unlink(temp_file_name)
+
 
 class FileBase(object):
 
     _source_type = 'unknown'
     _file_name = ''
+    _stat = None
+    _stat_valid = False
 
     def __init__(self, file_name):
         if not file_name:
@@ -29,11 +123,51 @@ class FileBase(object):
     def name(self):
         return self._file_name
 
+    def stat(self):
+        # One metadata lookup, reused until the file is written or renamed or invalidate_stat() is called
+        if not self._stat_valid:
+            self._stat = self._read_stat()
+            self._stat_valid = True
+
+        return self._stat
+
+    def invalidate_stat(self):
+        self._stat_valid = False
+        self._stat = None
+
+    def exists(self):
+        return self.stat() is not None
+
+    def last_changed(self):
+        stat = self.stat()
+        if stat:
+            return datetime.fromtimestamp(stat.mtime_ns // 1000000000)
+
+        return None
+
+    def fingerprint(self):
+        stat = self.stat()
+        if stat:
+            return [stat.mtime_ns, stat.size, stat.inode]
+
+        return None
+
+    def server_hash(self):
+        return None
+
+    def _read_stat(self):
+        raise NotImplementedError
+
 
 class FileLocal(FileBase):
 
     _source_type = 'local'
 
+    # Ways of copying a file, fastest first, the name of the one used is set as copy_method on the copy. Hard links
+    # are not used, as the copy is a backup and a delta transfer patches files in place, which would change both
+    copy_methods = ('_copy_clone', '_copy_file_range', '_copy_sendfile', '_copy_buffered')
+    copy_method = None
+
     def __init__(self, file_name):
         log.debug('FileLocal(%s)' % file_name)
         super(FileLocal, self).__init__(file_name)
@@ -48,15 +182,19 @@ class FileLocal(FileBase):
     def __exit__(self, *args, **kwargs):
         pass
 
-    def exists(self):
-        return os.path.exists(self.name)
+    def _read_stat(self):
+        try:
+            stat = os.stat(self.name)
 
-    def last_changed(self):
-        if self.exists():
-            timestamp = int(os.path.getmtime(self.name))
-            return datetime.fromtimestamp(timestamp)
+        except OSError:
+            return None
 
-        return None
+        # st_mtime_ns is not available in Python 2
+        mtime_ns = getattr(stat, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(stat.st_mtime * 1000000) * 1000
+
+        return FileStat(stat.st_size, mtime_ns, stat.st_mode, stat.st_ino)
 
     def read(self):
         try:
@@ -66,35 +204,174 @@ class FileLocal(FileBase):
         except IOError as e:
             raise FileException('Error reading local file (%s) (%s)' % (self.name, e))
 
+    def read_chunks(self, block_size = DEFAULT_BLOCK_SIZE):
+        try:
+            with open(self.name, 'rb') as file_object:
+                while True:
+                    file_data = file_object.read(block_size)
+                    if not file_data:
+                        break
+
+                    yield file_data
+
+        except IOError as e:
+            raise FileException('Error reading local file (%s) (%s)' % (self.name, e))
+
     def write(self, file_data):
+        self.write_chunks([file_data])
+
+    def write_chunks(self, chunks):
+        self.invalidate_stat()
+
+        try:
+            write_chunks_atomic(self.name, chunks)
+
+        except (IOError, OSError) as e:
+            raise FileException('Error writing local file (%s) (%s)' % (self.name, e))
+
+    def create(self, file_data):
+        # Returns False rather than replacing a file that already exists
+        self.invalidate_stat()
+
         try:
-            with open(self.name, 'wb') as file_object:
+            file_descriptor = os.open(self.name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0))
+
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+
+            raise FileException('Error creating local file (%s) (%s)' % (self.name, e))
+
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file_object:
                 file_object.write(file_data)
 
         except IOError as e:
-            raise FileException('Error writing local file (%s) (%s)' % (self.name, e))
+            raise FileException('Error creating local file (%s) (%s)' % (self.name, e))
+
+        return True
+
+    def remove(self):
+        self.invalidate_stat()
 
-    def rename(self, file_name):
         try:
-            os.rename(self.name, file_name)
+            os.unlink(self.name)
+
+        except OSError as e:
+            raise FileException('Error removing local file (%s) (%s)' % (self.name, e))
+
+    def rename(self, file_name, replace = False):
+        self.invalidate_stat()
+
+        try:
+            if replace:
+                replace_file(self.name, file_name)
+
+            else:
+                os.rename(self.name, file_name)
+
             self._file_name = file_name
 
         except OSError as e:
             raise FileException('Error renaming local file (%s) to (%s) (%s)' % (self.name, file_name, e))
 
+    def sibling(self, file_name):
+        return FileLocal(file_name)
+
     def copy(self, file_name):
-        file_object = FileLocal(file_name)
+        file_object = self.sibling(file_name)
 
-        copyfile(self.name, file_name)
+        try:
+            with open(self.name, 'rb') as file_source:
+                with open(file_name, 'wb') as file_destination:
+                    for method_name in self.copy_methods:
+                        if getattr(self, method_name)(file_source, file_destination):
+                            break
+
+                        # Start again from the beginning, in case the method failed part way through
+                        file_source.seek(0)
+                        file_destination.seek(0)
+                        file_destination.truncate()
+
+        except (IOError, OSError) as e:
+            raise FileException('Error copying local file (%s) to (%s) (%s)' % (self.name, file_name, e))
+
+        log.debug('Local copy (%s) to (%s) with (%s)' % (self.name, file_name, method_name))
+        file_object.copy_method = method_name
 
         return file_object
 
+    @staticmethod
+    def _copy_clone(file_source, file_destination):
+        # Share the data blocks on filesystems that support it, e.g. btrfs and xfs
+        if fcntl is None or not sys.platform.startswith('linux'):
+            return False
+
+        try:
+            fcntl.ioctl(file_destination.fileno(), FICLONE, file_source.fileno())
+
+        except (IOError, OSError) as e:
+            log.debug('Local clone failed (%s)' % e)
+            return False
+
+        return True
+
+    @staticmethod
+    def _copy_file_range(file_source, file_destination):
+        # Copy within the kernel, which some filesystems do without moving the data
+        if not hasattr(os, 'copy_file_range'):
+            return False
+
+        return FileLocal._copy_fd(os.copy_file_range, file_source, file_destination)
+
+    @staticmethod
+    def _copy_sendfile(file_source, file_destination):
+        if not hasattr(os, 'sendfile'):
+            return False
+
+        def sendfile(fd_source, fd_destination, size):
+            return os.sendfile(fd_destination, fd_source, None, size)
+
+        return FileLocal._copy_fd(sendfile, file_source, file_destination)
+
+    @staticmethod
+    def _copy_fd(func_copy, file_source, file_destination):
+        fd_source = file_source.fileno()
+        fd_destination = file_destination.fileno()
+        size = os.fstat(fd_source).st_size
+
+        try:
+            while size > 0:
+                bytes_copied = func_copy(fd_source, fd_destination, size)
+                if bytes_copied <= 0:
+                    break
+
+                size -= bytes_copied
+
+        except OSError as e:
+            log.debug('Local copy (%s) failed (%s)' % (func_copy.__name__, e))
+            return False
+
+        return size <= 0
+
+    @staticmethod
+    def _copy_buffered(file_source, file_destination):
+        copyfileobj(file_source, file_destination, DEFAULT_BLOCK_SIZE)
+        return True
+
 
 class FileSFTP(FileBase):
 
     _source_type = 'SFTP'
 
-    def __init__(self, file_name, user_name, password, host_name, host_port):
+    # Ways of asking the server for an MD5 without downloading the file, in order of preference
+    server_hash_methods = ('_server_hash_check_file', '_server_hash_exec')
+
+    # Ways of copying a file, the server copying it itself where it can. Hard links are not used, as the copy is a
+    # backup and files are written in place, which would change both
+    copy_methods = ('_copy_data', '_copy_exec', '_copy_stream')
+
+    def __init__(self, file_name, user_name, password, host_name, host_port, server_hash = True, pool = None, pipelined = True):
         log.debug('FileSFTP(%s)' % file_name)
         super(FileSFTP, self).__init__(file_name)
 
@@ -103,116 +380,428 @@ class FileSFTP(FileBase):
         self._host_name = host_name
         self._host_port = host_port
 
-        self._transport = None
-        self._sftp = None
-        self._with_count = 0
+        self._server_hash = server_hash
+        self._server_hash_methods = list(self.server_hash_methods) if server_hash else []
+
+        self._copy_methods = list(self.copy_methods)
+        self._posix_rename = True
+
+        # Keep several reads or writes in flight rather than waiting for each reply, which is slow on high latency links
+        self._pipelined = pipelined
+
+        # Connections borrowed from the pool, one per open() or nested with block
+        self._pool = pool or connection_pool
+        self._connections = []
 
     @property
     def key(self):
         return '%s|%s|%s' % (self._source_type, self.name, self.__user_name)
 
+    @property
+    def _transport(self):
+        return self._connections[-1].transport if self._connections else None
+
+    @property
+    def _sftp(self):
+        return self._connections[-1].sftp if self._connections else None
+
     def __enter__(self):
-        self.open()
-        self._with_count += 1
+        self._acquire()
         return self
 
     def __exit__(self, *args, **kwargs):
-        self._with_count -= 1
-        if self._with_count == 0:
-            self.close()
+        if self._connections:
+            self._pool.release(self._connections.pop())
+
+    def _acquire(self):
+        connection = self._pool.acquire(self._host_name, self._host_port, self.__user_name, self.__password)
+        self._connections.append(connection)
 
     def open(self):
-        if self._transport is None:
-            try:
-                self._transport = paramiko.Transport((self._host_name, self._host_port))
-                self._transport.connect(username = self.__user_name, password = self.__password)
+        if not self._connections:
+            self._acquire()
 
-                self._sftp = paramiko.SFTPClient.from_transport(self._transport)
+    def is_open(self):
+        return bool(self._connections) and self._connections[-1].is_active()
 
-            except paramiko.SSHException as e:
-                if self._sftp:
-                    self._sftp.close()
+    def close(self):
+        while self._connections:
+            self._pool.release(self._connections.pop())
 
-                self._sftp = None
+    def _read_stat(self):
+        try:
+            with self:
+                sftp_attr = self._sftp.stat(self.name)
 
-                if self._transport:
-                    self._transport.close()
+        except IOError:
+            return None
 
-                self._transport = None
+        # SFTP only reports whole seconds and has no inode
+        return FileStat(sftp_attr.st_size, int(sftp_attr.st_mtime) * 1000000000, sftp_attr.st_mode, 0)
 
-                raise FileException('Failed to connect to SFTP (%s)' % e, e)
+    def server_hash(self):
+        if not self._server_hash_methods:
+            return None
 
-    def is_open(self):
-        return self._transport and self._sftp and self._transport.is_active()
+        with self:
+            for method_name in list(self._server_hash_methods):
+                file_hash = getattr(self, method_name)()
+                if file_hash:
+                    log.debug('SFTP server hash (%s) from (%s)' % (file_hash, method_name))
+                    return file_hash
 
-    def close(self):
-        if self._sftp:
-            self._sftp.close()
+                # Do not retry a method the server has shown it does not support
+                log.debug('SFTP server hash method (%s) unavailable' % method_name)
+                self._server_hash_methods.remove(method_name)
 
-        if self._transport:
-            self._transport.close()
-
-        self._sftp = None
-        self._transport = None
+        return None
 
-    def exists(self):
+    def _server_hash_check_file(self):
         try:
-            with self:
-                sftp_attr = self._sftp.stat(self.name)
-                return sftp_attr is not None
+            with self._sftp.open(self.name, 'rb') as file_object:
+                hash_data = file_object.check('md5')
 
-        except IOError:
-            pass
+        except sftp_errors() as e:
+            log.debug('SFTP check-file failed (%s)' % e)
+            return None
 
-        return False
+        if len(hash_data) != 16:
+            return None
 
-    def last_changed(self):
+        return hexlify(hash_data).decode('ascii')
+
+    def _server_hash_exec(self):
+        # Report the size too, so a shell that resolves the path differently to SFTP (e.g. chroot) is detected
+        file_name = quote(self.name)
+        command = 'md5sum < %s && wc -c < %s' % (file_name, file_name)
+
+        file_stat = self.stat()
+        if file_stat is None:
+            return None
+
+        output = self._exec(command)
+        if output is None:
+            return None
+
+        fields = output.decode('ascii', 'replace').split()
+        if len(fields) != 3:
+            return None
+
+        file_hash = fields[0].lower()
+        if len(file_hash) != 32 or fields[2] != str(file_stat.size):
+            return None
+
+        return file_hash
+
+    def _exec(self, command):
+        # Returns the output of a successful command, or None if it failed or the server does not allow commands
         try:
-            with self:
-                sftp_attr = self._sftp.stat(self.name)
-                timestamp = int(sftp_attr.st_mtime)
-                return datetime.fromtimestamp(timestamp)
+            channel = self._transport.open_session()
+            try:
+                channel.exec_command(command)
+                output = channel.makefile('rb').read()
+                exit_status = channel.recv_exit_status()
 
-        except IOError:
-            pass
+            finally:
+                channel.close()
 
-        return None
+        except sftp_errors() as e:
+            log.debug('SFTP exec (%s) failed (%s)' % (command, e))
+            return None
+
+        if exit_status != 0:
+            log.debug('SFTP exec (%s) exit status (%d)' % (command, exit_status))
+            return None
+
+        return output
+
+    def _prefetch(self, file_object):
+        # Request the whole file up front, replies are buffered as they arrive and read from there
+        if self._pipelined:
+            file_object.prefetch()
 
     def read(self):
         try:
             with self:
                 with self._sftp.open(self.name, 'rb') as file_object:
+                    self._prefetch(file_object)
                     return file_object.read()
 
         except IOError as e:
             raise FileException('Error reading SFTP file (%s) (%s)' % (self.name, e))
 
+    def read_chunks(self, block_size = DEFAULT_BLOCK_SIZE):
+        try:
+            with self:
+                with self._sftp.open(self.name, 'rb') as file_object:
+                    self._prefetch(file_object)
+                    while True:
+                        file_data = file_object.read(block_size)
+                        if not file_data:
+                            break
+
+                        yield file_data
+
+        except IOError as e:
+            raise FileException('Error reading SFTP file (%s) (%s)' % (self.name, e))
+
     def write(self, file_data):
+        self.write_chunks([file_data])
+
+    def write_chunks(self, chunks):
+        # Written in full to a temporary file then renamed over the old one, so other clients never see it partly
+        # written, and it keeps the old one's permissions
+        self.invalidate_stat()
+
+        temp_file_name = '%s.%s.tmp' % (self.name, uuid.uuid4().hex)
         try:
             with self:
-                with self._sftp.open(self.name, 'wb') as file_object:
-                    file_object.write(file_data)
+                try:
+                    file_mode = self._sftp.stat(self.name).st_mode
+
+                except IOError:
+                    file_mode = None
+
+                try:
+                    with self._sftp.open(temp_file_name, 'wb') as file_object:
+                        # Before any data is written, so it is never readable by more users than the old file
+                        if file_mode is not None:
+                            self._sftp.chmod(temp_file_name, stat_module.S_IMODE(file_mode))
+
+                        file_object.set_pipelined(self._pipelined)
+                        for file_data in chunks:
+                            file_object.write(file_data)
+
+                    self._replace(temp_file_name, self.name)
+
+                except Exception:
+                    # Including the chunks failing to be read, e.g. from a local file
+                    try:
+                        self._sftp.remove(temp_file_name)
+
+                    except IOError:
+                        pass
+
+                    raise
 
         except IOError as e:
             raise FileException('Error writing SFTP file (%s) (%s)' % (self.name, e))
 
-    def rename(self, file_name):
+    def apply_delta(self, file_signature, instructions, file_size, literal_data = None):
+        # A literal may be given as its length, its data then read in turn from literal_data, so the new data need
+        # not all be held at once
+        self.invalidate_stat()
+        instructions = list(instructions)
+
+        # Work out where each moved block goes, skipping blocks that are already in place
+        block_size = file_signature['block_size']
+        moves = []
+        offset = 0
+        for instruction, value in instructions:
+            if instruction == INSTRUCTION_COPY:
+                length = block_length(file_signature, value)
+                if value * block_size != offset:
+                    moves.append((offset, value * block_size, length))
+
+            else:
+                length = len(value) if isinstance(value, bytes) else value
+
+            offset += length
+
+        literal_data = iter(literal_data or [])
+        bytes_written = 0
         try:
             with self:
-                self._sftp.rename(self.name, file_name)
+                with self._sftp.open(self.name, 'r+b') as file_object:
+                    file_object.set_pipelined(self._pipelined)
+
+                    # Read every moved block before anything is overwritten
+                    moved_data = {}
+                    if moves:
+                        moved_data = dict(zip([offset for offset, source_offset, length in moves],
+                                              file_object.readv([(source_offset, length) for offset, source_offset, length in moves])))
+
+                    offset = 0
+                    for instruction, value in instructions:
+                        if instruction == INSTRUCTION_COPY:
+                            length = block_length(file_signature, value)
+                            file_data = moved_data.pop(offset, None)
+
+                        elif isinstance(value, bytes):
+                            length = len(value)
+                            file_data = value
+
+                        else:
+                            length = value
+                            file_data = next(literal_data, None)
+                            if file_data is None or len(file_data) != length:
+                                raise FileException('Delta data ended early (%s)' % self.name)
+
+                        if file_data is not None:
+                            file_object.seek(offset)
+                            file_object.write(file_data)
+                            bytes_written += len(file_data)
+
+                        offset += length
+
+                    if file_size < file_signature['file_size']:
+                        file_object.truncate(file_size)
+
+        except IOError as e:
+            raise FileException('Error patching SFTP file (%s) (%s)' % (self.name, e))
+
+        return bytes_written
+
+    def create(self, file_data):
+        # Returns False rather than replacing a file that already exists. Plain SFTP rename fails if the destination
+        # exists, so the file is written in full beside it and renamed into place.
+        self.invalidate_stat()
+
+        temp_file = self.sibling('%s.%s.tmp' % (self.name, uuid.uuid4().hex))
+        temp_file.write(file_data)
+
+        try:
+            with self:
+                try:
+                    self._sftp.rename(temp_file.name, self.name)
+                    return True
+
+                except IOError as e:
+                    self._sftp.remove(temp_file.name)
+
+                    # The server does not say why a rename failed, so check that it was the file already existing
+                    try:
+                        self._sftp.stat(self.name)
+
+                    except IOError:
+                        raise e
+
+                    return False
+
+        except IOError as e:
+            raise FileException('Error creating SFTP file (%s) (%s)' % (self.name, e))
+
+    def remove(self):
+        self.invalidate_stat()
+
+        try:
+            with self:
+                self._sftp.remove(self.name)
+
+        except IOError as e:
+            raise FileException('Error removing SFTP file (%s) (%s)' % (self.name, e))
+
+    def rename(self, file_name, replace = False):
+        self.invalidate_stat()
+
+        try:
+            with self:
+                if replace:
+                    self._replace(self.name, file_name)
+
+                else:
+                    self._sftp.rename(self.name, file_name)
+
                 self._file_name = file_name
 
         except IOError as e:
             raise FileException('Error renaming SFTP file (%s) to (%s) (%s)' % (self.name, file_name, e))
 
+    def _replace(self, source_file_name, destination_file_name):
+        # Plain SFTP rename fails if the destination exists, OpenSSH's posix-rename extension replaces it in one step
+        if self._posix_rename and hasattr(self._sftp, 'posix_rename'):
+            try:
+                self._sftp.posix_rename(source_file_name, destination_file_name)
+                return
+
+            except IOError as e:
+                log.debug('SFTP posix-rename unavailable (%s)' % e)
+                self._posix_rename = False
+
+        # Without it there is a moment with no destination file
+        try:
+            self._sftp.remove(destination_file_name)
+
+        except IOError:
+            pass
+
+        self._sftp.rename(source_file_name, destination_file_name)
+
+    def sibling(self, file_name):
+        return FileSFTP(file_name,
+                        self.__user_name,
+                        self.__password,
+                        self._host_name,
+                        self._host_port,
+                        self._server_hash,
+                        self._pool,
+                        self._pipelined)
+
     def copy(self, file_name):
-        file_object = FileSFTP(file_name,
-                               self.__user_name,
-                               self.__password,
-                               self._host_name,
-                               self._host_port)
+        file_object = self.sibling(file_name)
+
+        try:
+            with self:
+                for method_name in list(self._copy_methods):
+                    if getattr(self, method_name)(file_name):
+                        log.debug('SFTP copy (%s) to (%s) with (%s)' % (self.name, file_name, method_name))
+                        break
 
-        data = self.read()
-        file_object.write(data)
+                    # Do not retry a method the server has shown it does not support
+                    log.debug('SFTP copy method (%s) unavailable' % method_name)
+                    self._copy_methods.remove(method_name)
+
+        except IOError as e:
+            raise FileException('Error copying SFTP file (%s) to (%s) (%s)' % (self.name, file_name, e))
 
         return file_object
+
+    def _copy_data(self, file_name):
+        sftp_module = load_paramiko().sftp
+        # Older paramiko packs longs as 64 bit integers
+        int64 = getattr(sftp_module, 'int64', None) or long
+
+        with self._sftp.open(self.name, 'rb') as file_source:
+            with self._sftp.open(file_name, 'wb') as file_destination:
+                try:
+                    # paramiko has no call for the copy-data extension, a length of 0 copies to the end of the file
+                    self._sftp._request(sftp_module.CMD_EXTENDED,
+                                        'copy-data',
+                                        file_source.handle,
+                                        int64(0),
+                                        int64(0),
+                                        file_destination.handle,
+                                        int64(0))
+
+                except sftp_errors() as e:
+                    log.debug('SFTP copy-data failed (%s)' % e)
+                    return False
+
+        return True
+
+    def _copy_exec(self, file_name):
+        # Names starting with '-' would otherwise be read as options
+        if self._exec('cp -- %s %s' % (quote(self.name), quote(file_name))) is None:
+            return False
+
+        # Check the copy is where SFTP expects it, as the shell may resolve paths differently (e.g. chroot)
+        try:
+            return self._sftp.stat(file_name).st_size == self._sftp.stat(self.name).st_size
+
+        except IOError:
+            return False
+
+    def _copy_stream(self, file_name):
+        # Stream between two handles on the same session rather than holding the data or opening a second connection
+        with self._sftp.open(self.name, 'rb') as file_source:
+            self._prefetch(file_source)
+            with self._sftp.open(file_name, 'wb') as file_destination:
+                file_destination.set_pipelined(self._pipelined)
+                while True:
+                    file_data = file_source.read(DEFAULT_BLOCK_SIZE)
+                    if not file_data:
+                        break
+
+                    file_destination.write(file_data)
+
+        return True
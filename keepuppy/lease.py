@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+from .exceptions import FileException, SyncException
+from time import time, sleep
+import json
+import os
+import random
+import socket
+import uuid
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LEASE_DURATION = 120.0
+DEFAULT_LEASE_TIMEOUT = 60.0
+LEASE_SUFFIX = '.lock'
+
+# The wait between attempts doubles up to the maximum, with a random part so waiting clients do not retry together
+LEASE_RETRY_DELAY = 0.1
+LEASE_RETRY_DELAY_MAX = 5.0
+
+
+class RemoteLease(object):
+    """An advisory lock on a remote file, held by a lock file next to it until released or expired."""
+
+    def __init__(self, file_object, owner, duration = DEFAULT_LEASE_DURATION, timeout = DEFAULT_LEASE_TIMEOUT):
+        self.lock_file = file_object.sibling(file_object.name + LEASE_SUFFIX)
+        self.owner = owner
+
+        # Expiry times come from each client's clock, so the duration should allow for clocks differing
+        self.duration = duration
+        self.timeout = timeout
+
+        self._token = None
+        self._expires = None
+
+    @property
+    def held(self):
+        return self._token is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.release()
+
+    def acquire(self):
+        time_give_up = time() + self.timeout
+        attempt = 0
+
+        while True:
+            token = uuid.uuid4().hex
+            expires = time() + self.duration
+            created = self.lock_file.create(self._encode(token, expires))
+
+            # Some servers let a rename replace an existing file, so two clients can both create the lock file, and
+            # only the one whose token is in it holds the lease
+            lease_info = self._read()
+            if created and lease_info and lease_info['token'] == token:
+                self._token = token
+                self._expires = expires
+                return
+
+            if created:
+                log.debug('Lease created by another client at the same time (%s)' % self.lock_file.name)
+
+            if lease_info and lease_info['expires'] <= time():
+                log.warning('Breaking expired lease held by (%s) (%s)' % (lease_info['owner'], self.lock_file.name))
+                self._break(lease_info)
+
+            elif time() >= time_give_up:
+                raise SyncException('Remote file is locked by another client (%s) (%s)' % (
+                    lease_info['owner'] if lease_info else None, self.lock_file.name))
+
+            else:
+                log.debug('Waiting for lease held by (%s) (%s)' % (lease_info['owner'] if lease_info else None,
+                                                                   self.lock_file.name))
+                sleep(self._retry_delay(attempt, time_give_up))
+                attempt += 1
+
+    def release(self):
+        if not self.held:
+            return
+
+        token = self._token
+        self._token = None
+
+        if time() > self._expires:
+            log.warning('Lease expired before it was released, another client may have taken it (%s)' %
+                        self.lock_file.name)
+
+        # The lease has to be given up whatever happens here, so a failure is only logged
+        try:
+            lease_info = self._read()
+            if lease_info and lease_info['token'] == token:
+                self.lock_file.remove()
+
+        except FileException as e:
+            log.warning('Failed to release lease (%s)' % e)
+
+    def _encode(self, token, expires):
+        return json.dumps({'owner': self.owner, 'token': token, 'expires': expires}, sort_keys = True).encode('utf-8')
+
+    def _read(self):
+        self.lock_file.invalidate_stat()
+        if not self.lock_file.exists():
+            return None
+
+        try:
+            lease_info = json.loads(self.lock_file.read().decode('utf-8'))
+            return {'owner': lease_info['owner'], 'token': lease_info['token'], 'expires': float(lease_info['expires'])}
+
+        except FileException:
+            # Released between the two calls
+            return None
+
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # Still being written, or written by something else, so it lasts as long as a lease from when it changed
+            stat = self.lock_file.stat()
+            return {'owner': None, 'token': None, 'expires': stat.mtime_ns / 1e9 + self.duration if stat else 0}
+
+    def _break(self, lease_info):
+        # Only removed if unchanged since it was read. Another client could take the lease between the two, it is
+        # advisory and at worst both upload as they would without it
+        try:
+            if self._read() == lease_info:
+                self.lock_file.remove()
+
+        except FileException as e:
+            log.debug('Expired lease already gone (%s)' % e)
+
+    @staticmethod
+    def _retry_delay(attempt, time_give_up):
+        delay = min(LEASE_RETRY_DELAY_MAX, LEASE_RETRY_DELAY * 2 ** attempt)
+        return max(0, min(time_give_up - time(), random.uniform(delay / 2, delay)))
+
+
+class RemoteLocker(object):
+    """Creates leases on remote files for one client, so two syncing the same file take turns."""
+
+    def __init__(self, owner = None, duration = DEFAULT_LEASE_DURATION, timeout = DEFAULT_LEASE_TIMEOUT):
+        self.owner = owner or '%s.%d' % (socket.gethostname(), os.getpid())
+        self.duration = duration
+        self.timeout = timeout
+
+    def lease(self, file_object):
+        return RemoteLease(file_object, self.owner, self.duration, self.timeout)
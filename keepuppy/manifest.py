@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from time import time
+import json
+import socket
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MANIFEST_MAX_AGE = 5.0
+
+
+class RemoteManifest(object):
+    """A small file kept next to the synced files, recording the hash of each as last uploaded, so other clients need not hash them."""
+
+    def __init__(self, file_object, writer_id = None, max_age = DEFAULT_MANIFEST_MAX_AGE):
+        self.file_object = file_object
+        self.writer_id = writer_id or socket.gethostname()
+
+        # Reread at most this often, so a sync list reads it once rather than once per file
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._entries = None
+        self._read_time = 0
+
+    def refresh(self):
+        with self._lock:
+            self._entries = None
+
+    def lookup(self, file_object):
+        # Only used while the file has the size and time recorded, so changes by anything else are still noticed
+        fingerprint = file_object.fingerprint()
+        if not fingerprint:
+            return None
+
+        entry = self._get_entries().get(file_object.key)
+        if not entry or entry.get('mtime_ns') != fingerprint[0] or entry.get('size') != fingerprint[1]:
+            return None
+
+        return entry
+
+    def update(self, file_object, file_hash):
+        fingerprint = file_object.fingerprint()
+        if not fingerprint:
+            return
+
+        with self._lock:
+            # Read again first to keep entries written by other clients. If two write at once one entry may be
+            # lost, which only means its file is hashed as it would be without a manifest
+            entries = self._read()
+            entries[file_object.key] = {
+                'file_hash': file_hash,
+                'mtime_ns': fingerprint[0],
+                'size': fingerprint[1],
+                'writer': self.writer_id,
+                'time': int(time())
+            }
+            self._write(entries)
+
+            self._entries = entries
+            self._read_time = time()
+
+    def _get_entries(self):
+        with self._lock:
+            if self._entries is None or time() - self._read_time > self.max_age:
+                self._entries = self._read()
+                self._read_time = time()
+
+            return self._entries
+
+    def _read(self):
+        self.file_object.invalidate_stat()
+        if not self.file_object.exists():
+            return {}
+
+        try:
+            entries = json.loads(self.file_object.read().decode('utf-8')).get('files')
+
+        except (ValueError, AttributeError):
+            log.warning('Manifest does not contain valid data, ignoring it (%s)' % self.file_object.name)
+            return {}
+
+        return entries if isinstance(entries, dict) else {}
+
+    def _write(self, entries):
+        # Writes replace the whole file in one step, so readers never see it partly written
+        self.file_object.write(json.dumps({'files': entries}, sort_keys = True).encode('utf-8'))
+        self.file_object.invalidate_stat()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+from .files import write_file_atomic
+from .pool import connection_pool
+from timeit import default_timer
+from contextlib import contextmanager
+from collections import defaultdict
+from time import time
+import json
+import os
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class SyncMetrics(object):
+    """Totals of the time spent in each phase of syncing, bytes moved per backend and hash cache use."""
+
+    def __init__(self, pool = None):
+        self._pool = pool or connection_pool
+        self._lock = threading.Lock()
+
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._phase_seconds = defaultdict(float)
+            self._phase_count = defaultdict(int)
+            self._bytes_read = defaultdict(int)
+            self._bytes_written = defaultdict(int)
+            self._counters = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name):
+        time_start = default_timer()
+        try:
+            yield
+
+        finally:
+            self.add_phase_time(name, default_timer() - time_start)
+
+    def add_phase_time(self, name, seconds):
+        with self._lock:
+            self._phase_seconds[name] += seconds
+            self._phase_count[name] += 1
+
+    def add_bytes_read(self, source_type, byte_count):
+        with self._lock:
+            self._bytes_read[source_type] += byte_count
+
+    def add_bytes_written(self, source_type, byte_count):
+        with self._lock:
+            self._bytes_written[source_type] += byte_count
+
+    def increment(self, name, count = 1):
+        with self._lock:
+            self._counters[name] += count
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'phase_seconds': dict(self._phase_seconds),
+                'phase_count': dict(self._phase_count),
+                'bytes_read': dict(self._bytes_read),
+                'bytes_written': dict(self._bytes_written),
+                'counters': dict(self._counters),
+                # Connecting happens inside whichever phase first needs the server, so is timed by the pool
+                'connections': {
+                    'connect_count': self._pool.connect_count,
+                    'connect_seconds': self._pool.connect_seconds,
+                    'reuse_count': self._pool.reuse_count
+                }
+            }
+
+
+def subtract_snapshot(snapshot, snapshot_previous):
+    if isinstance(snapshot, dict):
+        snapshot_previous = snapshot_previous or {}
+        return dict((key, subtract_snapshot(value, snapshot_previous.get(key))) for key, value in snapshot.items())
+
+    return snapshot - (snapshot_previous or 0)
+
+
+class JSONLinesExporter(object):
+    """Append one JSON object per export, holding what changed since the previous export."""
+
+    def __init__(self, file_name):
+        self.file_name = os.path.expanduser(file_name)
+        self._snapshot_previous = None
+
+    def export(self, metrics):
+        snapshot = metrics.snapshot()
+
+        record = subtract_snapshot(snapshot, self._snapshot_previous)
+        record['time'] = time()
+        self._snapshot_previous = snapshot
+
+        with open(self.file_name, 'ab') as file_object:
+            file_object.write((json.dumps(record, sort_keys = True) + '\n').encode('utf-8'))
+
+
+class PrometheusTextfileExporter(object):
+    """Write running totals in the Prometheus text format, for the node exporter's textfile collector."""
+
+    def __init__(self, file_name, prefix = 'keepuppy'):
+        self.file_name = os.path.expanduser(file_name)
+        self.prefix = prefix
+
+    def export(self, metrics):
+        snapshot = metrics.snapshot()
+
+        lines = []
+        self._add_metric(lines, 'phase_seconds_total', 'Time spent in each sync phase', 'phase', snapshot['phase_seconds'])
+        self._add_metric(lines, 'phase_count_total', 'Times each sync phase ran', 'phase', snapshot['phase_count'])
+        self._add_metric(lines, 'bytes_read_total', 'Bytes read from each backend', 'backend', snapshot['bytes_read'])
+        self._add_metric(lines, 'bytes_written_total', 'Bytes written to each backend', 'backend', snapshot['bytes_written'])
+        self._add_metric(lines, 'events_total', 'Sync events, e.g. hash cache hits and misses', 'event', snapshot['counters'])
+        self._add_metric(lines, 'sftp_connections_total', 'SFTP connections made', None, snapshot['connections']['connect_count'])
+        self._add_metric(lines, 'sftp_connect_seconds_total', 'Time spent making SFTP connections', None, snapshot['connections']['connect_seconds'])
+        self._add_metric(lines, 'sftp_connection_reuses_total', 'SFTP connections reused from the pool', None, snapshot['connections']['reuse_count'])
+        self._add_metric(lines, 'last_export_timestamp_seconds', 'Time metrics were last written', None, time(), 'gauge')
+
+        # The collector may read at any time, so never leave a partly written file
+        write_file_atomic(self.file_name, ('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def _add_metric(self, lines, name, help_text, label_name, values, metric_type = 'counter'):
+        name = '%s_%s' % (self.prefix, name)
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+
+        if label_name is None:
+            lines.append('%s %r' % (name, float(values)))
+            return
+
+        for label_value, value in sorted(values.items()):
+            label_value = str(label_value).replace('\\', '\\\\').replace('"', '\\"')
+            lines.append('%s{%s="%s"} %r' % (name, label_name, label_value, float(value)))
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+from .exceptions import FileException
+import threading
+import atexit
+from time import time
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_IDLE_TIMEOUT = 60
+
+
+def load_paramiko():
+    # paramiko and its crypto libraries take longer to import than the rest of keepuppy, so wait until a connection is needed
+    import paramiko
+    return paramiko
+
+
+def sftp_errors():
+    # Only evaluated once an SFTP call has failed, by which point paramiko is loaded
+    return (IOError, EOFError, load_paramiko().SSHException)
+
+
+class SFTPConnection(object):
+
+    def __init__(self, key, transport, sftp):
+        self.key = key
+        self.transport = transport
+
+        self.ref_count = 0
+        self.last_used = time()
+
+        # SFTPClient is not safe to share between threads, so each thread holding the connection borrows a session on
+        # the one transport. It is returned for another thread to use once that thread's last hold is released, so the
+        # number of sessions is at most the number of threads using the connection at once.
+        self._sftp_list = [sftp]
+        self._sftp_idle = [sftp]
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def sftp(self):
+        thread_id = threading.current_thread().ident
+        with self._lock:
+            session = self._sessions.setdefault(thread_id, [None, 0])
+            if session[0] is None and self.transport is not None:
+                if self._sftp_idle:
+                    session[0] = self._sftp_idle.pop()
+
+                else:
+                    session[0] = load_paramiko().SFTPClient.from_transport(self.transport)
+                    self._sftp_list.append(session[0])
+
+            return session[0]
+
+    def hold(self):
+        thread_id = threading.current_thread().ident
+        with self._lock:
+            self._sessions.setdefault(thread_id, [None, 0])[1] += 1
+
+    def unhold(self, released):
+        thread_id = threading.current_thread().ident
+        with self._lock:
+            session = self._sessions.get(thread_id)
+            if session is not None:
+                session[1] -= 1
+                if session[1] <= 0:
+                    self._return_session(thread_id)
+
+            # Sessions used by threads that did not take a hold themselves are returned once nothing holds the connection
+            if released:
+                for thread_id in list(self._sessions):
+                    self._return_session(thread_id)
+
+    def _return_session(self, thread_id):
+        sftp = self._sessions.pop(thread_id)[0]
+        if sftp is not None:
+            self._sftp_idle.append(sftp)
+
+    def is_active(self):
+        return self.transport is not None and self.transport.is_active()
+
+    def close(self):
+        with self._lock:
+            for sftp in self._sftp_list:
+                sftp.close()
+
+            self._sftp_list = []
+            self._sftp_idle = []
+            self._sessions = {}
+
+        if self.transport:
+            self.transport.close()
+
+        self.transport = None
+
+
+class SFTPConnectionPool(object):
+    """Share one SFTP session per host, port and credentials between file objects."""
+
+    def __init__(self, idle_timeout = DEFAULT_IDLE_TIMEOUT, keepalive = 0, window_size = None, max_packet_size = None):
+        # An idle timeout of None keeps released connections open until close_all()
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+
+        # SSH flow control for new connections, None leaves paramiko's default
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+
+        self.connect_count = 0
+        self.connect_seconds = 0.0
+        self.reuse_count = 0
+
+        self._connections = {}
+        self._connecting = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host_name, host_port, user_name, password):
+        key = (host_name, host_port, user_name, password)
+
+        # Connecting is slow, so is done without the lock, and other threads wanting the same server wait for it
+        while True:
+            with self._lock:
+                self._evict_idle()
+
+                connection = self._connections.get(key)
+                if connection is not None and not connection.is_active():
+                    log.debug('Discarding inactive SFTP connection (%s:%s)' % (host_name, host_port))
+                    self._remove(connection)
+                    connection = None
+
+                if connection is not None:
+                    self.reuse_count += 1
+                    return self._hold(connection)
+
+                connecting = self._connecting.get(key)
+                if connecting is None:
+                    connecting = self._connecting[key] = threading.Event()
+                    break
+
+            # If that connection failed, this thread tries again
+            connecting.wait()
+
+        connection = None
+        try:
+            connection = self._connect(key)
+
+        finally:
+            with self._lock:
+                del self._connecting[key]
+                connecting.set()
+
+                if connection is not None:
+                    self._connections[key] = connection
+                    self._hold(connection)
+
+        return connection
+
+    @staticmethod
+    def _hold(connection):
+        connection.ref_count += 1
+        connection.last_used = time()
+        connection.hold()
+
+        return connection
+
+    def release(self, connection):
+        with self._lock:
+            connection.ref_count -= 1
+            connection.last_used = time()
+            connection.unhold(connection.ref_count <= 0)
+
+            if not connection.is_active() or self._connections.get(connection.key) is not connection:
+                self._remove(connection)
+
+            self._evict_idle()
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_idle()
+
+    def close_all(self):
+        with self._lock:
+            for connection in list(self._connections.values()):
+                self._remove(connection)
+
+    def _connect(self, key):
+        host_name, host_port, user_name, password = key
+        log.debug('Connecting to SFTP (%s@%s:%s)' % (user_name, host_name, host_port))
+
+        paramiko = load_paramiko()
+
+        transport = None
+        sftp = None
+        time_start = time()
+        try:
+            # Channels opened on the transport, including each SFTP session, use its default window and packet sizes
+            transport = paramiko.Transport((host_name, host_port),
+                                           default_window_size = self.window_size or paramiko.common.DEFAULT_WINDOW_SIZE,
+                                           default_max_packet_size = self.max_packet_size or paramiko.common.DEFAULT_MAX_PACKET_SIZE)
+            transport.connect(username = user_name, password = password)
+            if self.keepalive:
+                transport.set_keepalive(self.keepalive)
+
+            sftp = paramiko.SFTPClient.from_transport(transport)
+
+        except paramiko.SSHException as e:
+            if sftp:
+                sftp.close()
+
+            if transport:
+                transport.close()
+
+            raise FileException('Failed to connect to SFTP (%s)' % e, e)
+
+        with self._lock:
+            self.connect_count += 1
+            self.connect_seconds += time() - time_start
+
+        return SFTPConnection(key, transport, sftp)
+
+    def _evict_idle(self):
+        if self.idle_timeout is None:
+            return
+
+        time_now = time()
+        for connection in list(self._connections.values()):
+            if connection.ref_count <= 0 and time_now - connection.last_used >= self.idle_timeout:
+                log.debug('Closing idle SFTP connection (%s:%s)' % connection.key[:2])
+                self._remove(connection)
+
+    def _remove(self, connection):
+        if self._connections.get(connection.key) is connection:
+            del self._connections[connection.key]
+
+        # Connections still borrowed are closed by their last release
+        if connection.ref_count <= 0:
+            connection.close()
+
+
+connection_pool = SFTPConnectionPool()
+atexit.register(connection_pool.close_all)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import cProfile
+import pstats
+import subprocess
+import threading
+import sys
+import os
+from collections import defaultdict
+from timeit import default_timer
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TOP_COUNT = 30
+DEFAULT_SAMPLE_INTERVAL = 0.005
+IMPORT_TIME_MODULES = ('keepuppy', 'paramiko', 'psutil')
+IMPORT_TIME_REPEAT = 3
+
+
+class StackSampler(threading.Thread):
+    """Record the stack of every other thread at a regular interval, for flame graphs."""
+
+    def __init__(self, interval = DEFAULT_SAMPLE_INTERVAL):
+        super(StackSampler, self).__init__()
+        self.daemon = True
+
+        self.interval = interval
+        self.sample_count = 0
+        self._stacks = defaultdict(int)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        thread_id_self = threading.current_thread().ident
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == thread_id_self:
+                    continue
+
+                self._stacks[self._collapse(frame)] += 1
+
+            self.sample_count += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    @staticmethod
+    def _collapse(frame):
+        frame_names = []
+        while frame is not None:
+            code = frame.f_code
+            frame_names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+
+        # Outermost frame first, separated by semicolons, as flamegraph.pl and speedscope expect
+        return ';'.join(reversed(frame_names))
+
+    def collapsed_lines(self):
+        return ['%s %d' % (stack, count) for stack, count in sorted(self._stacks.items())]
+
+
+def parse_import_times(output):
+    # Lines from -X importtime are "import time: self [us] | cumulative | imported package", nested imports indented
+    import_times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or fields[2].startswith('  ') or not fields[1].strip().isdigit():
+            continue
+
+        import_times[fields[2].strip()] = int(fields[1])
+
+    return import_times
+
+
+def measure_import_times(module_names = IMPORT_TIME_MODULES, trace = None):
+    # The modules are already loaded here, so import each in a fresh interpreter where nothing is cached. Before
+    # Python 3.7 there is no -X importtime, so the time is that of starting an interpreter to import it, less one
+    # that does nothing.
+    if trace is None:
+        trace = sys.version_info >= (3, 7)
+
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([package_dir] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+
+    if trace:
+        return dict((module_name, _trace_import_time(module_name, env)) for module_name in module_names)
+
+    time_start_up = _run_interpreter('pass', env)
+    return dict((module_name, _wall_import_time(module_name, env, time_start_up)) for module_name in module_names)
+
+
+def _trace_import_time(module_name, env):
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import %s' % module_name],
+                               stdout = subprocess.PIPE,
+                               stderr = subprocess.PIPE,
+                               env = env)
+    output = process.communicate()[1].decode('utf-8', 'replace')
+
+    return parse_import_times(output).get(module_name) if process.returncode == 0 else None
+
+
+def _wall_import_time(module_name, env, time_start_up):
+    time_import = _run_interpreter('import %s' % module_name, env)
+    if time_import is None or time_start_up is None:
+        return None
+
+    return max(0, int((time_import - time_start_up) * 1000000))
+
+
+def _run_interpreter(command, env, repeat = IMPORT_TIME_REPEAT):
+    # The quickest of a few runs, as the least disturbed by anything else running
+    times = []
+    for index in range(repeat):
+        time_start = default_timer()
+        process = subprocess.Popen([sys.executable, '-c', command],
+                                   stdout = subprocess.PIPE,
+                                   stderr = subprocess.PIPE,
+                                   env = env)
+        process.communicate()
+        if process.returncode != 0:
+            return None
+
+        times.append(default_timer() - time_start)
+
+    return min(times)
+
+
+class ProfileSession(object):
+    """Profile the code run inside it and write the results to files starting with a prefix."""
+
+    def __init__(self, file_prefix, top_count = DEFAULT_TOP_COUNT, collapsed = False):
+        self.file_prefix = os.path.expanduser(file_prefix)
+        self.top_count = top_count
+        self.collapsed = collapsed
+
+        self._profile = None
+        self._sampler = None
+
+    def __enter__(self):
+        if self.collapsed:
+            self._sampler = StackSampler()
+            self._sampler.start()
+
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self._profile.disable()
+        if self._sampler:
+            self._sampler.stop()
+
+        # A failure to write the results should not hide how the run itself ended
+        try:
+            self.write()
+
+        except (IOError, OSError) as e:
+            log.error('Failed to write profile (%s) (%s)' % (self.file_prefix, e))
+
+    def write(self):
+        pstats_file_name = self.file_prefix + '.pstats'
+        self._profile.dump_stats(pstats_file_name)
+
+        summary_file_name = self.file_prefix + '.txt'
+        with open(summary_file_name, 'w') as summary_file:
+            import_times = measure_import_times()
+            if import_times:
+                print('Import time in a new interpreter, including the modules each imports', file = summary_file)
+                for module_name in sorted(import_times):
+                    import_time = import_times[module_name]
+                    print('  %-12s %s' % (module_name, '%.1f ms' % (import_time / 1000.0) if import_time is not None else 'not installed'),
+                          file = summary_file)
+
+                print(file = summary_file)
+
+            stats = pstats.Stats(self._profile, stream = summary_file)
+            for sort_key in ('cumulative', 'tottime'):
+                print('Top %d functions by %s time' % (self.top_count, sort_key), file = summary_file)
+                stats.sort_stats(sort_key).print_stats(self.top_count)
+
+        file_names = [pstats_file_name, summary_file_name]
+        if self._sampler:
+            collapsed_file_name = self.file_prefix + '.collapsed'
+            with open(collapsed_file_name, 'w') as collapsed_file:
+                for line in self._sampler.collapsed_lines():
+                    print(line, file = collapsed_file)
+
+            file_names.append(collapsed_file_name)
+
+        log.info('Profile written to (%s)' % ', '.join(file_names))
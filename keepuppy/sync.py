@@ -1,78 +1,223 @@
 # -*- coding: utf-8 -*-
 
 from .exceptions import FileException, HashCacheException, SyncException
-import json
+from .files import DEFAULT_BLOCK_SIZE, fingerprint_last_changed
+from .transfer import Transfer
+from .delta import DeltaTransfer, DEFAULT_DELTA_BLOCK_SIZE
+from .cache import create_cache_backend
+from .metrics import SyncMetrics
 from hashlib import md5
 from datetime import datetime
 import os
+import threading
+from contextlib import contextmanager
+from collections import namedtuple
 import logging
 
 log = logging.getLogger(__name__)
 
+DEFAULT_WORKERS = 4
+
 
 class HashCache(object):
 
-    def __init__(self, cache_file_name):
+    def __init__(self, cache_file_name, block_size = DEFAULT_BLOCK_SIZE, backend = None):
         self.cache_file_name = os.path.expanduser(cache_file_name)
-        self.cache = {}
+        self.block_size = block_size
+        self.backend = backend or create_cache_backend(self.cache_file_name)
+
+        # Guards the cache when several syncs run at once, files are hashed outside it
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+
+    # Cache changes are written when the outermost batch ends, rather than after every hash
+    @contextmanager
+    def batch(self):
+        self.begin_batch()
+
+        try:
+            yield self
+
+        finally:
+            self.end_batch()
+
+    def begin_batch(self):
+        with self._lock:
+            self._batch_depth += 1
+
+    def end_batch(self, flush = True):
+        # Returns whether the outermost batch ended, when not flushing here the caller should call flush()
+        with self._lock:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and flush:
+                self.backend.flush()
+
+            return self._batch_depth == 0
 
-        self._load_hashes()
+    def flush(self):
+        with self._lock:
+            self.backend.flush()
 
-    def get_hash(self, file_object):
+    def get_hash(self, file_object, file_hash = None):
+        # A hash already known from elsewhere, e.g. a remote manifest, is used rather than reading a changed file
         with file_object:
-            last_changed = file_object.last_changed()
-            log.debug('File key (%s) last_changed (%s)' % (file_object.key, last_changed))
+            fingerprint = file_object.fingerprint()
+            log.debug('File key (%s) fingerprint (%s)' % (file_object.key, fingerprint))
 
-            if last_changed:
-                return self._read_or_calculate_hash(file_object, file_object.key, last_changed)
+            if fingerprint:
+                return self._read_or_calculate_hash(file_object, file_object.key, fingerprint, file_hash)
 
         return None
 
-    def _read_or_calculate_hash(self, file_object, key, last_changed):
-        file_info = self.cache.setdefault(key, {})
-        last_changed_cached = file_info.get('last_changed')
-        file_hash_cached = file_info.get('file_hash')
+    def unchanged(self, *file_objects):
+        # Checked in order, so put the cheapest first: nothing more is looked up once a file differs from its entry
+        file_hashes = set()
+        for file_object in file_objects:
+            fingerprint = file_object.fingerprint()
+            with self._lock:
+                file_info = self.backend.get(file_object.key) or {}
+
+            if not fingerprint or file_info.get('fingerprint') != list(fingerprint):
+                return False
+
+            file_hashes.add(file_info.get('file_hash'))
+
+        return len(file_hashes) == 1
+
+    def set_hash(self, file_object, file_hash, signature = None):
+        with file_object:
+            fingerprint = file_object.fingerprint()
+            log.debug('File key (%s) fingerprint (%s) set hash (%s)' % (file_object.key, fingerprint, file_hash))
+
+            if fingerprint:
+                file_info = {
+                    'fingerprint': fingerprint,
+                    'file_hash': file_hash
+                }
+                if signature:
+                    file_info['signature'] = signature
+
+                self._set_file_info(file_object.key, file_info)
 
-        last_changed_str = last_changed.strftime('%Y-%m-%d %H:%M:%S')
+    # Delta signatures are kept with the hash, so they are dropped as soon as the file is seen to change
+    def get_signature(self, file_object):
+        with file_object:
+            fingerprint = file_object.fingerprint()
+
+        with self._lock:
+            file_info = self.backend.get(file_object.key) or {}
+
+        if fingerprint and file_info.get('fingerprint') == list(fingerprint):
+            return file_info.get('signature')
+
+        return None
+
+    def set_signature(self, file_object, signature):
+        with file_object:
+            fingerprint = file_object.fingerprint()
+
+        with self._lock:
+            file_info = self.backend.get(file_object.key)
+            if fingerprint and file_info and file_info.get('fingerprint') == list(fingerprint):
+                file_info = dict(file_info)
+                file_info['signature'] = signature
+
+                self._set_file_info(file_object.key, file_info)
+
+    def _read_or_calculate_hash(self, file_object, key, fingerprint, file_hash_known = None):
+        with self._lock:
+            file_info = dict(self.backend.get(key) or {})
+        fingerprint_cached = file_info.get('fingerprint')
+        file_hash_cached = file_info.get('file_hash')
 
         created = not file_info
-        calculate_hash = last_changed_cached != last_changed_str
+        # Entries from older versions have no fingerprint, so are rehashed once
+        calculate_hash = fingerprint_cached != list(fingerprint)
+        bytes_read = 0
         if calculate_hash:
-            file_hash = self.calculate_hash(file_object.read())
-            file_info['last_changed'] = last_changed_str
-            file_info['file_hash'] = file_hash
-
-            self._save_hashes()
+            # Let the server calculate the hash if it can, to avoid reading the whole file
+            file_hash = file_hash_known or file_object.server_hash()
+            if not file_hash:
+                file_hash = self.calculate_hash_chunks(file_object.read_chunks(self.block_size))
+                bytes_read = fingerprint[1]
+            file_info = {
+                'fingerprint': list(fingerprint),
+                'file_hash': file_hash
+            }
+
+            self._set_file_info(key, file_info)
 
         return {
-            'last_changed': datetime.strptime(file_info['last_changed'], '%Y-%m-%d %H:%M:%S'),
+            'last_changed': fingerprint_last_changed(fingerprint),
+            'fingerprint': file_info['fingerprint'],
             'file_hash': file_info['file_hash'],
             'file_hash_previous': file_hash_cached,
             'created': created,
             'calculated': calculate_hash,
+            'bytes_read': bytes_read,
             'updated': not created and calculate_hash and file_hash_cached != file_info['file_hash']
         }
 
+    def _set_file_info(self, key, file_info):
+        with self._lock:
+            self.backend.set(key, file_info)
+
+            if self._batch_depth == 0:
+                self.backend.flush()
+
     @staticmethod
     def calculate_hash(data):
         m = md5()
         m.update(data)
         return m.hexdigest()
 
-    def _load_hashes(self):
-        try:
-            with open(self.cache_file_name, 'rb') as file_object:
-                self.cache = json.load(file_object)
+    @staticmethod
+    def calculate_hash_chunks(chunks):
+        m = md5()
+        for data in chunks:
+            m.update(data)
+        return m.hexdigest()
+
+
+SyncResult = namedtuple('SyncResult', ['file_local', 'file_remote', 'status', 'error'])
+SyncPlan = namedtuple('SyncPlan', ['copy', 'backup', 'conflict', 'status'])
+
+COPY_TO_REMOTE = 'to_remote'
+COPY_FROM_REMOTE = 'from_remote'
+
+
+def plan_sync(info_local, info_remote):
+    # Decide what a sync does from the two files' hash cache info, so every way of running a sync behaves the same
+    if not info_local and not info_remote:
+        raise SyncException('No files found locally or remotely')
+
+    elif not info_local:
+        return SyncPlan(COPY_FROM_REMOTE, False, False, 'Local file missing, copied from remote')
+
+    elif not info_remote:
+        return SyncPlan(COPY_TO_REMOTE, False, False, 'Remote file missing, copied to remote')
+
+    if info_local.get('file_hash') == info_remote.get('file_hash'):
+        return SyncPlan(None, False, False, 'Files are up to date')
 
-        except ValueError:
-            raise HashCacheException('Cache file exists but does not contain valid data')
+    # The local file is backed up before it is overwritten, and whenever both files have changed
+    file_new_local = info_local.get('created') or info_local.get('updated')
+    file_new_remote = info_remote.get('created') or info_remote.get('updated')
+    conflict = bool(file_new_local and file_new_remote)
 
-        except IOError as e:
-            log.warning('Unable to load hash cache file (%s) (%s)' % (self.cache_file_name, e))
+    last_changed_local = info_local.get('last_changed')
+    last_changed_remote = info_remote.get('last_changed')
 
-    def _save_hashes(self):
-        with open(self.cache_file_name, 'wb') as file_object:
-            json.dump(self.cache, file_object)
+    # SFTP only gives times to the second, so compare at the precision both have. Changes in the same second count
+    # as the remote being newer, which backs up the local file before it is overwritten.
+    if not last_changed_local.microsecond or not last_changed_remote.microsecond:
+        last_changed_local = last_changed_local.replace(microsecond = 0)
+        last_changed_remote = last_changed_remote.replace(microsecond = 0)
+
+    if last_changed_local > last_changed_remote:
+        return SyncPlan(COPY_TO_REMOTE, conflict, conflict, 'Local file most recent, copied to remote')
+
+    return SyncPlan(COPY_FROM_REMOTE, True, conflict, 'Remote file most recent, copied from remote')
 
 
 class Syncer(object):
@@ -80,83 +225,368 @@ class Syncer(object):
     conflict_suffix = '_conflict'
     _hash_cache = None
     _func_local_update = None
-
-    def __init__(self, hash_cache, func_local_update = None):
+    _func_progress = None
+    _delta = False
+
+    def __init__(self,
+                 hash_cache,
+                 func_local_update = None,
+                 func_progress = None,
+                 delta = False,
+                 delta_block_size = DEFAULT_DELTA_BLOCK_SIZE,
+                 backup_store = None,
+                 metrics = None,
+                 manifest = None,
+                 locker = None):
         self._hash_cache = hash_cache
         self._func_local_update = func_local_update
+        self._func_progress = func_progress
+        self._delta = delta
+        self._delta_block_size = delta_block_size
+
+        # Without a store, backups are timestamped copies next to the file
+        self._backup_store = backup_store
+
+        self._metrics = metrics or SyncMetrics()
+
+        # Remote hashes recorded by whichever client last uploaded each file
+        self._manifest = manifest
+
+        # Leases on remote files, taken while uploading
+        self._locker = locker
 
     @property
     def hash_cache(self):
         return self._hash_cache
 
+    @property
+    def metrics(self):
+        return self._metrics
+
     def sync(self, file_local, file_remote):
+        # Look up each file's metadata once per sync, as it may have changed since the last one
+        for file_object in (file_local, file_remote):
+            if file_object:
+                file_object.invalidate_stat()
+
         try:
-            info_local = self._hash_cache.get_hash(file_local) if file_local else None
+            with self._metrics.phase('sync'):
+                with self._hash_cache.batch():
+                    status = self._sync(file_local, file_remote)
 
-        except (FileException, HashCacheException) as e:
-            raise SyncException('Local file error', e)
+        except SyncException:
+            self._metrics.increment('sync_errors')
+            raise
 
-        try:
-            info_remote = self._hash_cache.get_hash(file_remote) if file_remote else None
+        self._metrics.increment('syncs')
+        return status
 
-        except (FileException, HashCacheException) as e:
-            raise SyncException('Remote file error', e)
+    def _sync(self, file_local, file_remote):
+        info_local, info_remote = self._get_hashes(file_local, file_remote)
 
         log.debug('File info local (%s)' % info_local)
         log.debug('File info remote (%s)' % info_remote)
 
-        if not info_local and not info_remote:
-            raise SyncException('No files found locally or remotely')
+        sync_plan = plan_sync(info_local, info_remote)
 
-        elif not info_local:
-            self._copy_file(file_remote, file_local)
+        if self.needs_lease(sync_plan):
+            return self.sync_leased(file_local, file_remote, info_local, info_remote)
 
-            self._local_update(file_local)
+        return self._apply_sync_plan(sync_plan, file_local, file_remote, info_local)
+
+    def needs_lease(self, sync_plan):
+        return self._locker is not None and sync_plan.copy == COPY_TO_REMOTE
+
+    def sync_leased(self, file_local, file_remote, info_local, info_remote):
+        # Clients uploading the same file take turns, and each decides again once it is its turn, so one that finds
+        # the other's upload matches its own has nothing left to copy
+        with self._lease(file_remote):
+            info_remote = self._recheck_remote(file_remote, info_remote)
+
+            return self._apply_sync_plan(plan_sync(info_local, info_remote), file_local, file_remote, info_local)
+
+    @contextmanager
+    def _lease(self, file_object):
+        lease = self._locker.lease(file_object)
+
+        try:
+            with self._metrics.phase('lease'):
+                lease.acquire()
+
+        except FileException as e:
+            raise SyncException('Remote file error', e)
 
-            return 'Local file missing, copied from remote'
+        try:
+            yield lease
+
+        finally:
+            lease.release()
+
+    def _recheck_remote(self, file_remote, info_remote):
+        file_remote.invalidate_stat()
+        fingerprint = file_remote.fingerprint()
+        if info_remote and fingerprint and list(fingerprint) == info_remote.get('fingerprint'):
+            return info_remote
+
+        self._metrics.increment('lease_rechecks')
+
+        try:
+            info_remote_new = self.get_file_info(file_remote, True)
+
+        except (FileException, HashCacheException) as e:
+            raise SyncException('Remote file error', e)
 
-        elif not info_remote:
-            self._copy_file(file_local, file_remote)
+        # Changes seen by the first look still count towards a conflict
+        if info_remote and info_remote_new:
+            for key in ('created', 'updated'):
+                info_remote_new[key] = info_remote_new.get(key) or info_remote.get(key)
 
-            return 'Remote file missing, copied to remote'
+        return info_remote_new
 
-        if info_local.get('file_hash') == info_remote.get('file_hash'):
-            return 'Files are up to date'
+    def _apply_sync_plan(self, sync_plan, file_local, file_remote, info_local):
+        self.run_backup(sync_plan, file_local, info_local)
+        file_hash = self.run_copy(sync_plan, file_local, file_remote)
+        self.run_finish(sync_plan, file_local, file_remote, file_hash)
 
-        backed_up = False
-        file_new_local = info_local.get('created') or info_local.get('updated')
-        file_new_remote = info_remote.get('created') or info_remote.get('updated')
-        if file_new_local and file_new_remote:
+        return sync_plan.status
+
+    # The steps of carrying out a sync plan, each run separately by AsyncSyncer so a sync can be cancelled between them
+    def run_backup(self, sync_plan, file_local, info_local):
+        if sync_plan.conflict:
             log.warning('Local and remote files have both been modified so creating backup')
-            self._create_backup(file_local, True)
-            backed_up = True
+            self._metrics.increment('conflicts')
+            self._create_backup(file_local, True, file_hash = info_local.get('file_hash'))
+
+        elif sync_plan.backup:
+            self._create_backup(file_local, file_hash = info_local.get('file_hash'))
 
-        if info_local.get('last_changed') > info_remote.get('last_changed'):
-            self._copy_file(file_local, file_remote)
+    def run_copy(self, sync_plan, file_local, file_remote):
+        # Returns the hash of the data copied
+        if sync_plan.copy == COPY_TO_REMOTE:
+            return self._copy_file(file_local, file_remote)
 
-            return 'Local file most recent, copied to remote'
+        elif sync_plan.copy == COPY_FROM_REMOTE:
+            return self._copy_file(file_remote, file_local)
 
-        else:
-            if not backed_up:
-                self._create_backup(file_local)
+        return None
 
-            self._copy_file(file_remote, file_local)
+    def run_finish(self, sync_plan, file_local, file_remote, file_hash):
+        if sync_plan.copy == COPY_TO_REMOTE:
+            self._update_manifest(file_remote, file_hash)
 
+        elif sync_plan.copy == COPY_FROM_REMOTE:
             self._local_update(file_local)
 
-            return 'Remote file most recent, copied from remote'
+    def sync_many(self, file_pairs, workers = DEFAULT_WORKERS):
+        def sync_pair(file_pair):
+            file_local, file_remote = file_pair
+            try:
+                return SyncResult(file_local, file_remote, self.sync(file_local, file_remote), None)
+
+            except Exception as e:
+                # Report the failure with its pair rather than abandoning the rest of the batch
+                log.error('Failed to sync (%s) (%s) (%s)' % (file_local.name if file_local else None,
+                                                            file_remote.name if file_remote else None,
+                                                            e))
+                return SyncResult(file_local, file_remote, None, e)
+
+        file_pairs = list(file_pairs)
+        if not file_pairs:
+            return []
+
+        # multiprocessing is slow to import and only needed for a sync list
+        from multiprocessing.pool import ThreadPool
+
+        thread_pool = ThreadPool(max(1, min(workers, len(file_pairs))))
+        try:
+            with self._hash_cache.batch():
+                return thread_pool.map(sync_pair, file_pairs, 1)
+
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+    def _get_hashes(self, file_local, file_remote):
+        # Reading and hashing the local file overlaps the remote round trips, as both release the GIL. The remote
+        # lookup stays on this thread so the SFTP session it opens is the one used to copy afterwards.
+        result_local = {}
+
+        def get_hash_local():
+            try:
+                result_local['file_info'] = self.get_file_info(file_local)
+
+            except Exception as e:
+                result_local['error'] = e
+
+        thread_local = None
+        if file_local and file_remote:
+            thread_local = threading.Thread(target = get_hash_local)
+            thread_local.daemon = True
+            thread_local.start()
+
+        elif file_local:
+            get_hash_local()
+
+        info_remote = None
+        error_remote = None
+        try:
+            info_remote = self.get_file_info(file_remote, True) if file_remote else None
+
+        except (FileException, HashCacheException) as e:
+            error_remote = e
+
+        finally:
+            if thread_local:
+                thread_local.join()
+
+        # Local errors are reported first, as when the files were looked up one after the other
+        error_local = result_local.get('error')
+        if isinstance(error_local, (FileException, HashCacheException)):
+            raise SyncException('Local file error', error_local)
+
+        elif error_local:
+            raise error_local
+
+        if error_remote:
+            raise SyncException('Remote file error', error_remote)
+
+        return result_local.get('file_info'), info_remote
+
+    def get_file_info(self, file_object, remote = False):
+        # The metadata is cached on the file, so looking it up first separates its cost from hashing
+        with self._metrics.phase('stat'):
+            file_object.stat()
+
+        # The manifest is only needed for a remote file that has changed since its hash was cached
+        file_hash = None
+        if remote and self._manifest and not self._hash_cache.unchanged(file_object):
+            file_hash = self._manifest_hash(file_object)
+
+        with self._metrics.phase('hash'):
+            file_info = self._hash_cache.get_hash(file_object, file_hash)
+
+        if file_info:
+            self._metrics.increment('cache_misses' if file_info.get('calculated') else 'cache_hits')
+            if file_info.get('bytes_read'):
+                self._metrics.add_bytes_read(file_object.source_type, file_info['bytes_read'])
+
+        return file_info
+
+    def _manifest_hash(self, file_object):
+        if not self._manifest:
+            return None
+
+        # Without the manifest the file is hashed as usual, so a problem reading it is not worth failing the sync
+        try:
+            with self._metrics.phase('manifest'):
+                entry = self._manifest.lookup(file_object)
+
+        except FileException as e:
+            log.warning('Failed to read manifest (%s)' % e)
+            return None
+
+        self._metrics.increment('manifest_hits' if entry else 'manifest_misses')
+        return entry['file_hash'] if entry else None
+
+    def _update_manifest(self, file_object, file_hash):
+        if not self._manifest or not file_hash:
+            return
+
+        try:
+            with self._metrics.phase('manifest'):
+                self._manifest.update(file_object, file_hash)
+
+        except FileException as e:
+            log.warning('Failed to update manifest (%s)' % e)
 
     def _copy_file(self, file_source, file_destination):
+        with self._metrics.phase('transfer'):
+            return self._copy_file_timed(file_source, file_destination)
+
+    def _copy_file_timed(self, file_source, file_destination):
+        # Returns the hash of the data copied
         try:
-            file_data = file_source.read()
-            file_destination.write(file_data)
+            file_hash = self._copy_file_delta(file_source, file_destination) if self._delta else None
+            if file_hash:
+                return file_hash
+
+            transfer_object = Transfer(file_source,
+                                       file_destination,
+                                       self._hash_cache.block_size,
+                                       self._func_progress,
+                                       self._delta_block_size if self._delta else None)
+            transfer_object.run()
+            self._add_transfer_bytes(file_source, file_destination, transfer_object.bytes_transferred, transfer_object.bytes_transferred)
+
+            # Record the hash calculated in transit rather than reading the destination back
+            self._hash_cache.set_hash(file_destination,
+                                      transfer_object.file_hash,
+                                      self._remote_signature(file_destination, transfer_object.signature))
 
-            self._hash_cache.get_hash(file_destination)
+            # The remote source is unchanged, so what was downloaded describes it too
+            if self._remote_signature(file_source, transfer_object.signature):
+                self._hash_cache.set_signature(file_source, transfer_object.signature)
+
+            return transfer_object.file_hash
 
         except FileException as e:
             raise SyncException('Failed to copy file', e)
 
-    def _create_backup(self, file_object, conflict = False):
+    def _copy_file_delta(self, file_source, file_destination):
+        if not self._can_patch(file_destination):
+            return None
+
+        file_signature = self._hash_cache.get_signature(file_destination)
+        if not file_signature:
+            return None
+
+        try:
+            transfer_object = DeltaTransfer(file_source,
+                                            file_destination,
+                                            file_signature,
+                                            self._hash_cache.block_size,
+                                            self._func_progress)
+            if transfer_object.run() is None:
+                self._metrics.increment('delta_fallbacks')
+                return None
+
+        except FileException as e:
+            log.warning('Delta transfer failed, copying whole file (%s)' % e)
+            return None
+
+        # The whole source is read to find the changes, only they are written
+        self._add_transfer_bytes(file_source, file_destination, transfer_object.signature['file_size'], transfer_object.bytes_transferred)
+        self._metrics.increment('delta_transfers')
+
+        self._hash_cache.set_hash(file_destination, transfer_object.file_hash, transfer_object.signature)
+        return transfer_object.file_hash
+
+    def _add_transfer_bytes(self, file_source, file_destination, bytes_read, bytes_written):
+        self._metrics.add_bytes_read(file_source.source_type, bytes_read)
+        self._metrics.add_bytes_written(file_destination.source_type, bytes_written)
+
+    @staticmethod
+    def _can_patch(file_object):
+        # Only files that can be patched in place keep signatures, local files are simply rewritten
+        return hasattr(file_object, 'apply_delta')
+
+    def _remote_signature(self, file_object, signature):
+        return signature if self._can_patch(file_object) else None
+
+    def _create_backup(self, file_object, conflict = False, file_hash = None):
+        self._metrics.increment('backups')
+        with self._metrics.phase('backup'):
+            self._create_backup_timed(file_object, conflict, file_hash)
+
+    def _create_backup_timed(self, file_object, conflict, file_hash):
+        if self._backup_store:
+            try:
+                self._backup_store.backup(file_object, file_hash, conflict)
+                return
+
+            except FileException as e:
+                raise SyncException('Failed to create file backup', e)
+
         try:
             time_now = datetime.utcnow()
             file_name = file_object.name + '.' + time_now.strftime('%Y%m%d_%H%M%S')
@@ -171,4 +601,5 @@ class Syncer(object):
 
     def _local_update(self, file_object):
         if self._func_local_update:
-            self._func_local_update(file_object)
+            with self._metrics.phase('restart'):
+                self._func_local_update(file_object)
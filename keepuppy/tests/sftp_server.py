@@ -3,12 +3,18 @@
 import os
 import tempfile
 import threading
-from time import sleep
+from time import time, sleep
 import paramiko
-from sftpserver.stub_sftp import StubSFTPServer
+from sftpserver.stub_sftp import StubSFTPServer, StubSFTPHandle
 import socket
 import select
 
+try:
+    from queue import Queue
+
+except ImportError:
+    from Queue import Queue
+
 CONNECT_DELAY = 0.1
 TRANSPORT_DELAY = 0.1
 
@@ -59,6 +65,18 @@ class SFTPAuth(paramiko.ServerInterface):
         return paramiko.OPEN_SUCCEEDED
 
 
+class ResizingStubSFTPHandle(StubSFTPHandle):
+
+    def chattr(self, attr):
+        # The stub resizes a file by reopening it for writing, which empties it first
+        if attr._flags & attr.FLAG_SIZE:
+            self.writefile.flush()
+            self.writefile.truncate(attr.st_size)
+            attr._flags &= ~attr.FLAG_SIZE
+
+        return super(ResizingStubSFTPHandle, self).chattr(attr)
+
+
 def create_stub_sftp_server_class(root_path):
 
     # Default class ROOT is set early, so lazily construct the class with our own ROOT
@@ -66,6 +84,30 @@ def create_stub_sftp_server_class(root_path):
 
         ROOT = root_path
 
+        def open(self, path, flags, attr):
+            handle = super(CustomStubSFTPServer, self).open(path, flags, attr)
+            if isinstance(handle, StubSFTPHandle):
+                handle.__class__ = ResizingStubSFTPHandle
+
+            return handle
+
+        # The stub server replaces an existing file, where OpenSSH's rename fails as in the SFTP specification
+        def rename(self, oldpath, newpath):
+            if os.path.lexists(self._realpath(newpath)):
+                return paramiko.SFTP_FAILURE
+
+            return super(CustomStubSFTPServer, self).rename(oldpath, newpath)
+
+        # The stub server does not support OpenSSH's posix-rename extension
+        def posix_rename(self, oldpath, newpath):
+            try:
+                os.rename(self._realpath(oldpath), self._realpath(newpath))
+
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+            return paramiko.SFTP_OK
+
     return CustomStubSFTPServer
 
 
@@ -84,7 +126,7 @@ class SFTPServer(threading.Thread):
 
     def run(self):
         key_file = tempfile.NamedTemporaryFile(delete = False)
-        key_file.write(SFTP_SERVER_KEY)
+        key_file.write(SFTP_SERVER_KEY.encode('ascii'))
         key_file.close()
 
         host_key = paramiko.RSAKey.from_private_key_file(key_file.name)
@@ -102,24 +144,107 @@ class SFTPServer(threading.Thread):
             if server_socket in readable:
                 conn, addr = server_socket.accept()
 
-                transport = paramiko.Transport(conn)
-                transport.add_server_key(host_key)
-                transport.set_subsystem_handler('sftp',
-                                                paramiko.SFTPServer,
-                                                create_stub_sftp_server_class(self.root_path))
-                server = SFTPAuth()
-                try:
-                    transport.start_server(server = server)
-                    channel = transport.accept()
-                    while transport.is_active():
-                        sleep(TRANSPORT_DELAY)
+                # Serve each connection on its own thread so pooled clients can stay connected
+                connection_thread = threading.Thread(target = self.serve_connection, args = (conn, host_key))
+                connection_thread.daemon = True
+                connection_thread.start()
+
+        server_socket.close()
 
-                except (socket.error, EOFError):
-                    pass
+    def serve_connection(self, conn, host_key):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler('sftp',
+                                        paramiko.SFTPServer,
+                                        create_stub_sftp_server_class(self.root_path))
+        server = SFTPAuth()
+        try:
+            transport.start_server(server = server)
+            channel = transport.accept()
+            while self.running and transport.is_active():
+                sleep(TRANSPORT_DELAY)
 
-                transport.close()
+        except (socket.error, EOFError, paramiko.SSHException):
+            pass
 
-        server_socket.close()
+        transport.close()
+
+    def stop(self):
+        self.running = False
+
+
+class LatencyProxy(threading.Thread):
+    """Forward connections to a server, delaying the data in each direction to simulate a slow link."""
+
+    host_name = '127.0.0.1'
+    host_port = 11338
+    backlog = 10
+    buffer_size = 64 * 1024
+
+    running = True
+
+    def __init__(self, server_host_name, server_host_port, delay):
+        super(LatencyProxy, self).__init__()
+        self.daemon = True
+
+        self.server_address = (server_host_name, server_host_port)
+        self.delay = delay
+
+    def run(self):
+        proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        proxy_socket.bind((self.host_name, self.host_port))
+        proxy_socket.listen(self.backlog)
+
+        while self.running:
+            readable, writable, errored = select.select([proxy_socket], [], [], CONNECT_DELAY)
+
+            if proxy_socket in readable:
+                client_socket, addr = proxy_socket.accept()
+                server_socket = socket.create_connection(self.server_address)
+
+                for socket_from, socket_to in [(client_socket, server_socket), (server_socket, client_socket)]:
+                    self.start_forward(socket_from, socket_to)
+
+        proxy_socket.close()
+
+    def start_forward(self, socket_from, socket_to):
+        # Data is queued with the time it is due, so delaying it does not stop more being read
+        data_queue = Queue()
+
+        for target, args in [(self.receive, (socket_from, data_queue)), (self.send, (socket_to, data_queue))]:
+            forward_thread = threading.Thread(target = target, args = args)
+            forward_thread.daemon = True
+            forward_thread.start()
+
+    def receive(self, socket_from, data_queue):
+        while True:
+            try:
+                data = socket_from.recv(self.buffer_size)
+
+            except socket.error:
+                data = b''
+
+            data_queue.put((time() + self.delay, data))
+            if not data:
+                break
+
+    def send(self, socket_to, data_queue):
+        while True:
+            time_due, data = data_queue.get()
+            time_wait = time_due - time()
+            if time_wait > 0:
+                sleep(time_wait)
+
+            try:
+                if not data:
+                    socket_to.shutdown(socket.SHUT_WR)
+                    break
+
+                socket_to.sendall(data)
+
+            except socket.error:
+                break
 
     def stop(self):
         self.running = False
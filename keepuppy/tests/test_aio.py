@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+from keepuppy.sync import HashCache
+from keepuppy.exceptions import FileException, SyncException
+import os
+import sys
+import shutil
+import tempfile
+import threading
+from time import sleep
+from datetime import datetime
+from nose.tools import eq_, assert_true, assert_raises
+from nose.plugins.skip import SkipTest
+from mock import MagicMock
+import logging
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from keepuppy.aio import AsyncFileLocal, AsyncSyncer
+
+log = logging.getLogger(__name__)
+
+
+class AsyncTestBase(object):
+
+    def setup(self):
+        if sys.version_info < (3, 5):
+            raise SkipTest('asyncio support needs Python 3.5 or later')
+
+        self.loop = asyncio.new_event_loop()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        self.loop.close()
+        shutil.rmtree(self.temp_dir)
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+
+class TestAsyncFileLocal(AsyncTestBase):
+
+    def test_read_write(self):
+        file_object = AsyncFileLocal(os.path.join(self.temp_dir, 'test.dat'))
+
+        eq_(self.run(file_object.exists()), False)
+
+        self.run(file_object.write(b'0123'))
+        file_object.invalidate_stat()
+
+        eq_(self.run(file_object.read()), b'0123')
+        eq_(self.run(file_object.fingerprint())[1], 4)
+
+
+class TestAsyncSyncer(AsyncTestBase):
+
+    def setup(self):
+        super(TestAsyncSyncer, self).setup()
+
+        self.hash_cache = HashCache(os.path.join(self.temp_dir, 'cache.json'))
+        self.syncer = AsyncSyncer(self.hash_cache, sessions = 2)
+
+    def teardown(self):
+        self.syncer.close()
+        super(TestAsyncSyncer, self).teardown()
+
+    def create_files(self, name):
+        file_local = AsyncFileLocal(os.path.join(self.temp_dir, name + '.local'))
+        file_remote = AsyncFileLocal(os.path.join(self.temp_dir, name + '.remote'))
+        file_local.file_object.write(name.encode('ascii'))
+
+        return file_local, file_remote
+
+    def test_sync(self):
+        file_local, file_remote = self.create_files('test')
+
+        eq_(self.run(self.syncer.sync(file_local, file_remote)), 'Remote file missing, copied to remote')
+        eq_(file_remote.file_object.read(), b'test')
+        eq_(self.run(self.syncer.sync(file_local, file_remote)), 'Files are up to date')
+        eq_(self.syncer.metrics.snapshot()['counters']['syncs'], 2)
+
+    def test_sync_many(self):
+        file_pairs = [self.create_files('test%d' % index) for index in range(10)]
+        file_pairs.append((AsyncFileLocal(os.path.join(self.temp_dir, 'missing.local')),
+                           AsyncFileLocal(os.path.join(self.temp_dir, 'missing.remote'))))
+
+        sync_results = self.run(self.syncer.sync_many(file_pairs))
+
+        eq_([sync_result.status for sync_result in sync_results[:-1]], ['Remote file missing, copied to remote'] * 10)
+        assert_true(isinstance(sync_results[-1].error, SyncException))
+
+    def test_local_error(self):
+        file_local, file_remote = self.create_files('test')
+        os.chmod(file_local.name, 0)
+        if os.access(file_local.name, os.R_OK):
+            raise SkipTest('Files can be read without permission')
+
+        with assert_raises(SyncException) as context:
+            self.run(self.syncer.sync(file_local, file_remote))
+
+        eq_(context.exception.args[0], 'Local file error')
+
+
+class TestAsyncSyncerMocked(AsyncTestBase):
+
+    def setup(self):
+        super(TestAsyncSyncerMocked, self).setup()
+
+        self.hash_cache = MagicMock()
+        self.syncer = AsyncSyncer(self.hash_cache, sessions = 8, concurrency = 2)
+        self.syncer._syncer._copy_file = MagicMock()
+
+    def teardown(self):
+        self.syncer.close()
+        super(TestAsyncSyncerMocked, self).teardown()
+
+    @staticmethod
+    def hash_result(file_hash):
+        return {'last_changed': datetime.utcnow(), 'file_hash': file_hash, 'created': False, 'updated': False}
+
+    def test_concurrency(self):
+        file_pairs = [(MagicMock(name = 'local'), MagicMock(name = 'remote')) for index in range(10)]
+        file_locals = set(file_local for file_local, file_remote in file_pairs)
+        lock = threading.Lock()
+        state = {'active': 0, 'most_active': 0}
+
+        def get_hash(file_object, file_hash = None):
+            if file_object in file_locals:
+                with lock:
+                    state['active'] += 1
+                    state['most_active'] = max(state['most_active'], state['active'])
+
+                sleep(0.01)
+                with lock:
+                    state['active'] -= 1
+
+            return self.hash_result('abcd')
+
+        self.hash_cache.get_hash.side_effect = get_hash
+
+        sync_results = self.run(self.syncer.sync_many(file_pairs))
+
+        eq_([sync_result.status for sync_result in sync_results], ['Files are up to date'] * 10)
+        eq_(state['most_active'], 2)
+
+    def test_flush_off_loop(self):
+        self.hash_cache.get_hash.return_value = self.hash_result('abcd')
+        flush_threads = []
+        self.hash_cache.flush.side_effect = lambda: flush_threads.append(threading.current_thread())
+
+        self.run(self.syncer.sync_many([(MagicMock(), MagicMock())]))
+
+        eq_(len(flush_threads), 2)
+        assert_true(threading.current_thread() not in flush_threads)
+        eq_(self.hash_cache.batch.call_count, 0)
+
+    def test_remote_error(self):
+        file_local = MagicMock()
+
+        def get_hash(file_object, file_hash = None):
+            if file_object is file_local:
+                return self.hash_result('abcd')
+
+            raise FileException('Connection failed')
+
+        self.hash_cache.get_hash.side_effect = get_hash
+
+        with assert_raises(SyncException) as context:
+            self.run(self.syncer.sync(file_local, MagicMock()))
+
+        eq_(context.exception.args[0], 'Remote file error')
+
+    def test_cancel(self):
+        file_local = MagicMock()
+        started = threading.Event()
+        release = threading.Event()
+
+        def get_hash(file_object, file_hash = None):
+            if file_object is file_local:
+                started.set()
+                assert_true(release.wait(5))
+                return self.hash_result('abcd')
+
+            return None
+
+        self.hash_cache.get_hash.side_effect = get_hash
+
+        task = self.loop.create_task(self.syncer.sync(file_local, MagicMock()))
+        assert_true(self.run(self.loop.run_in_executor(None, started.wait, 5)))
+
+        task.cancel()
+        release.set()
+
+        assert_raises(asyncio.CancelledError, self.run, task)
+
+        # The remote file is missing, so the local file would have been copied had the sync carried on
+        eq_(self.syncer._syncer._copy_file.call_count, 0)
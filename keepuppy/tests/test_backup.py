@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+from keepuppy.backup import BackupStore, BACKUP_TIME_FORMAT
+from keepuppy.files import FileLocal
+from keepuppy.sync import HashCache
+from keepuppy.exceptions import FileException
+import os
+import json
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from nose.tools import eq_, assert_true, raises
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TestBackupStore(object):
+
+    file_data = b'0123456789' * 100
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.temp_dir, 'backups')
+
+        self.file_object = FileLocal(os.path.join(self.temp_dir, 'test.kdbx'))
+        self.file_object.write(self.file_data)
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def blob_count(self):
+        return sum(len(file_names) for dir_name, dir_names, file_names in os.walk(os.path.join(self.store_dir, 'blobs')))
+
+    def test_backup(self):
+        backup_store = BackupStore(self.store_dir)
+
+        entry = backup_store.backup(self.file_object)
+
+        eq_(entry['file_hash'], HashCache.calculate_hash(self.file_data))
+        eq_(entry['conflict'], False)
+        eq_(backup_store.versions(self.file_object), [entry])
+        eq_(self.blob_count(), 1)
+
+    def test_restore(self):
+        backup_store = BackupStore(self.store_dir)
+        entry = backup_store.backup(self.file_object)
+
+        file_restore = FileLocal(os.path.join(self.temp_dir, 'restore.kdbx'))
+        backup_store.restore(entry['file_hash'], file_restore)
+
+        eq_(file_restore.read(), self.file_data)
+
+    def test_compressed(self):
+        BackupStore(self.store_dir).backup(self.file_object)
+
+        for dir_name, dir_names, file_names in os.walk(os.path.join(self.store_dir, 'blobs')):
+            for file_name in file_names:
+                assert_true(os.path.getsize(os.path.join(dir_name, file_name)) < len(self.file_data))
+
+    def test_zlib(self):
+        backup_store = BackupStore(self.store_dir, compression = 'zlib')
+        entry = backup_store.backup(self.file_object)
+
+        # Blobs are read whatever the current compression setting
+        backup_store = BackupStore(self.store_dir)
+        file_restore = FileLocal(os.path.join(self.temp_dir, 'restore.kdbx'))
+        backup_store.restore(entry['file_hash'], file_restore)
+
+        eq_(file_restore.read(), self.file_data)
+
+    def test_deduplicated(self):
+        backup_store = BackupStore(self.store_dir)
+
+        backup_store.backup(self.file_object)
+        backup_store.backup(self.file_object, HashCache.calculate_hash(self.file_data), True)
+
+        eq_([entry['conflict'] for entry in backup_store.versions(self.file_object)], [False, True])
+        eq_(self.blob_count(), 1)
+
+    def test_known_hash_not_read(self):
+        backup_store = BackupStore(self.store_dir)
+        backup_store.backup(self.file_object)
+
+        os.unlink(self.file_object.name)
+        backup_store.backup(self.file_object, HashCache.calculate_hash(self.file_data))
+
+        eq_(len(backup_store.versions(self.file_object)), 2)
+
+    def test_index_reloaded(self):
+        entry = BackupStore(self.store_dir).backup(self.file_object)
+
+        eq_(BackupStore(self.store_dir).versions(self.file_object), [entry])
+
+    def test_max_count(self):
+        backup_store = BackupStore(self.store_dir, max_count = 2)
+
+        for index in range(4):
+            self.file_object.write(self.file_data + str(index).encode('ascii'))
+            backup_store.backup(self.file_object)
+
+        eq_([entry['file_hash'] for entry in backup_store.versions(self.file_object)],
+            [HashCache.calculate_hash(self.file_data + str(index).encode('ascii')) for index in [2, 3]])
+        eq_(self.blob_count(), 2)
+
+    def test_max_age(self):
+        backup_store = BackupStore(self.store_dir, max_age_days = 30)
+        backup_store.backup(self.file_object)
+
+        with open(backup_store.index_file_name, 'rb') as index_file:
+            index = json.loads(index_file.read().decode('utf-8'))
+
+        index[self.file_object.key][0]['time'] = (datetime.utcnow() - timedelta(days = 31)).strftime(BACKUP_TIME_FORMAT)
+        with open(backup_store.index_file_name, 'wb') as index_file:
+            index_file.write(json.dumps(index).encode('utf-8'))
+
+        backup_store.prune()
+
+        eq_(backup_store.versions(self.file_object), [])
+        eq_(self.blob_count(), 0)
+
+    def test_shared_blob_kept(self):
+        backup_store = BackupStore(self.store_dir, max_count = 1)
+        file_other = FileLocal(os.path.join(self.temp_dir, 'other.kdbx'))
+        file_other.write(self.file_data)
+
+        backup_store.backup(self.file_object)
+        backup_store.backup(file_other)
+        self.file_object.write(b'changed')
+        backup_store.backup(self.file_object)
+
+        eq_(self.blob_count(), 2)
+
+    def test_shared_store(self):
+        # As for two processes, e.g. the daemon and a sync run from cron
+        backup_store = BackupStore(self.store_dir, max_count = 2)
+        backup_store_other = BackupStore(self.store_dir, max_count = 2)
+        file_other = FileLocal(os.path.join(self.temp_dir, 'other.kdbx'))
+        file_other.write(b'other')
+
+        entry = backup_store.backup(self.file_object)
+        entry_other = backup_store_other.backup(file_other)
+        backup_store.backup(self.file_object)
+
+        eq_(BackupStore(self.store_dir).versions(file_other), [entry_other])
+        eq_(backup_store.versions(self.file_object), [entry, entry])
+        eq_(self.blob_count(), 2)
+
+    def test_unrecorded_blob_kept(self):
+        backup_store = BackupStore(self.store_dir, max_count = 1)
+        backup_store.backup(self.file_object)
+
+        # A blob written after the index, by a process yet to record it
+        blob_dir = os.path.join(self.store_dir, 'blobs', 'ab')
+        os.makedirs(blob_dir)
+        blob_file_name = os.path.join(blob_dir, 'ab' + '0' * 30 + '.xz')
+        with open(blob_file_name, 'wb') as blob_file:
+            blob_file.write(b'blob')
+
+        index_time = os.stat(backup_store.index_file_name).st_mtime
+        os.utime(blob_file_name, (index_time + 10, index_time + 10))
+
+        backup_store.prune()
+
+        assert_true(os.path.exists(blob_file_name))
+
+    @raises(FileException)
+    def test_backup_missing(self):
+        os.unlink(self.file_object.name)
+
+        BackupStore(self.store_dir).backup(self.file_object)
+
+    @raises(FileException)
+    def test_restore_missing(self):
+        BackupStore(self.store_dir).restore(HashCache.calculate_hash(b'missing'), self.file_object)
+
+    @raises(FileException)
+    def test_unsupported_compression(self):
+        BackupStore(self.store_dir, compression = 'rar')
+
+    @raises(FileException)
+    def test_invalid_index(self):
+        os.makedirs(self.store_dir)
+        with open(os.path.join(self.store_dir, 'index.json'), 'wb') as index_file:
+            index_file.write(b'not json')
+
+        BackupStore(self.store_dir)
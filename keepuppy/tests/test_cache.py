@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from keepuppy.cache import JSONCacheBackend, SQLiteCacheBackend, create_cache_backend
+from keepuppy.exceptions import HashCacheException
+import os
+import tempfile
+import shutil
+import json
+from nose.tools import eq_, assert_true, raises
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class CacheTestBase(object):
+
+    file_info = {'last_changed': '2015-01-01 00:00:00', 'file_hash': '0123456789abcdef0123456789abcdef'}
+
+    temp_dir = None
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def temp_file_name(self, file_name):
+        return os.path.join(self.temp_dir, file_name)
+
+
+class TestJSONCacheBackend(CacheTestBase):
+
+    def test_missing(self):
+        backend = JSONCacheBackend(self.temp_file_name('cache.json'))
+
+        eq_(backend.get('key'), None)
+
+    def test_set(self):
+        cache_file_name = self.temp_file_name('cache.json')
+        backend = JSONCacheBackend(cache_file_name)
+        backend.set('key', self.file_info)
+
+        eq_(backend.get('key'), self.file_info)
+        eq_(JSONCacheBackend(cache_file_name).get('key'), None)
+
+        backend.flush()
+
+        eq_(JSONCacheBackend(cache_file_name).get('key'), self.file_info)
+        eq_(os.listdir(self.temp_dir), ['cache.json'])
+
+
+class TestSQLiteCacheBackend(CacheTestBase):
+
+    def test_missing(self):
+        backend = SQLiteCacheBackend(self.temp_file_name('cache.sqlite'))
+
+        eq_(backend.get('key'), None)
+        backend.close()
+
+    def test_set(self):
+        cache_file_name = self.temp_file_name('cache.sqlite')
+        backend = SQLiteCacheBackend(cache_file_name)
+        backend.set('key', self.file_info)
+        backend.set('key_other', {})
+
+        eq_(backend.get('key'), self.file_info)
+        eq_(SQLiteCacheBackend(cache_file_name).get('key'), None)
+
+        backend.close()
+
+        backend = SQLiteCacheBackend(cache_file_name)
+        eq_(backend.get('key'), self.file_info)
+        eq_(backend.get('key_other'), {})
+        backend.close()
+
+    def test_migrate(self):
+        json_file_name = self.temp_file_name('cache.json')
+        with open(json_file_name, 'w') as file_object:
+            json.dump({'key': self.file_info}, file_object)
+
+        backend = create_cache_backend(self.temp_file_name('cache.sqlite'))
+        assert_true(isinstance(backend, SQLiteCacheBackend))
+        eq_(backend.get('key'), self.file_info)
+
+        # Only migrated when the database is first created
+        backend.set('key', {})
+        backend.close()
+
+        backend = SQLiteCacheBackend(self.temp_file_name('cache.sqlite'), json_file_name)
+        eq_(backend.get('key'), {})
+        backend.close()
+
+    @raises(HashCacheException)
+    def test_invalid_data(self):
+        cache_file_name = self.temp_file_name('cache.sqlite')
+        with open(cache_file_name, 'wb') as file_object:
+            file_object.write(b'stuff' * 100)
+
+        SQLiteCacheBackend(cache_file_name)
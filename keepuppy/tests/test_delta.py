@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+from keepuppy.delta import weak_checksum, signature, delta, patch, read_ranges, DeltaTransfer, INSTRUCTION_COPY, INSTRUCTION_LITERAL
+from keepuppy.sync import HashCache
+from keepuppy.exceptions import FileException
+from nose.tools import eq_, assert_true, raises
+from mock import MagicMock
+import random
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def chunked(data, chunk_size):
+    return [data[offset:offset + chunk_size] for offset in range(0, len(data), chunk_size)]
+
+
+class TestDelta(object):
+
+    block_size = 16
+
+    def setup(self):
+        random.seed(0)
+        self.file_data = bytes(bytearray(random.randint(0, 255) for index in range(1000)))
+
+    def apply(self, file_data_old, file_data_new, chunk_size = 7):
+        file_signature = signature(chunked(file_data_old, chunk_size), self.block_size)
+        instructions = list(delta(file_signature, chunked(file_data_new, chunk_size)))
+
+        def read_block(offset, length):
+            return file_data_old[offset:offset + length]
+
+        eq_(b''.join(patch(file_signature, instructions, read_block)), file_data_new)
+        return instructions
+
+    def literal_size(self, instructions):
+        return sum(len(value) for instruction, value in instructions if instruction == INSTRUCTION_LITERAL)
+
+    def test_weak_checksum_rolls(self):
+        a, b = weak_checksum(self.file_data[:self.block_size])
+        for offset in range(1, 100):
+            byte_out = bytearray(self.file_data)[offset - 1]
+            byte_in = bytearray(self.file_data)[offset + self.block_size - 1]
+            a = (a - byte_out + byte_in) % 65536
+            b = (b - self.block_size * byte_out + a) % 65536
+
+            eq_((a, b), weak_checksum(self.file_data[offset:offset + self.block_size]))
+
+    def test_signature(self):
+        file_signature = signature(chunked(self.file_data, 7), self.block_size)
+
+        eq_(file_signature['block_size'], self.block_size)
+        eq_(file_signature['file_size'], len(self.file_data))
+        eq_(file_signature['file_hash'], HashCache.calculate_hash(self.file_data))
+        eq_(len(file_signature['blocks']), 63)
+
+    def test_unchanged(self):
+        instructions = self.apply(self.file_data, self.file_data)
+
+        eq_(self.literal_size(instructions), 0)
+        eq_([value for instruction, value in instructions], list(range(63)))
+
+    def test_changed_middle(self):
+        file_data_new = self.file_data[:500] + b'changed' + self.file_data[507:]
+
+        instructions = self.apply(self.file_data, file_data_new)
+
+        assert_true(self.literal_size(instructions) <= self.block_size * 2)
+
+    def test_inserted(self):
+        file_data_new = self.file_data[:100] + b'inserted' + self.file_data[100:]
+
+        instructions = self.apply(self.file_data, file_data_new)
+
+        assert_true(self.literal_size(instructions) <= self.block_size + len(b'inserted'))
+
+    def test_deleted(self):
+        instructions = self.apply(self.file_data, self.file_data[:300] + self.file_data[333:])
+
+        assert_true(self.literal_size(instructions) <= self.block_size * 2)
+
+    def test_moved(self):
+        instructions = self.apply(self.file_data, self.file_data[500:] + self.file_data[:500])
+
+        assert_true(self.literal_size(instructions) <= self.block_size * 2)
+
+    def test_appended(self):
+        file_data_old = self.file_data[:992]
+        instructions = self.apply(file_data_old, file_data_old + b'appended')
+
+        eq_(instructions[-1], (INSTRUCTION_LITERAL, b'appended'))
+
+    def test_truncated(self):
+        self.apply(self.file_data, self.file_data[:123])
+
+    def test_empty(self):
+        eq_(self.apply(b'', self.file_data), [(INSTRUCTION_LITERAL, self.file_data[offset:offset + self.block_size])
+                                              for offset in range(0, len(self.file_data), self.block_size)])
+        eq_(self.apply(self.file_data, b''), [])
+
+    def test_short_last_block(self):
+        instructions = self.apply(self.file_data, self.file_data)
+
+        eq_(instructions[-1], (INSTRUCTION_COPY, 62))
+
+
+class TestReadRanges(object):
+
+    def test_read_ranges(self):
+        file_data = bytes(bytearray(range(100)))
+
+        eq_(list(read_ranges(chunked(file_data, 7), [(0, 3), (5, 10), (15, 2), (60, 30), (99, 5)])),
+            [file_data[0:3], file_data[5:15], file_data[15:17], file_data[60:90], file_data[99:]])
+
+
+class TestDeltaTransfer(object):
+
+    file_data_old = b'0123456789' * 10
+    file_data_new = b'0123456789' * 5 + b'changed' + b'0123456789' * 5
+
+    def setup(self):
+        self.file_signature = signature([self.file_data_old], 16)
+
+        self.file_source = MagicMock()
+        self.file_source.read_chunks.return_value = [self.file_data_new]
+
+        self.file_destination = MagicMock()
+        self.file_destination.apply_delta.return_value = 7
+
+    def test_run(self):
+        self.file_destination.server_hash.side_effect = [self.file_signature['file_hash'],
+                                                         HashCache.calculate_hash(self.file_data_new)]
+
+        transfer_object = DeltaTransfer(self.file_source, self.file_destination, self.file_signature, 64)
+
+        eq_(transfer_object.run(), 7)
+        eq_(transfer_object.file_hash, HashCache.calculate_hash(self.file_data_new))
+        eq_(transfer_object.signature, signature([self.file_data_new], 16))
+
+        file_signature, instructions, file_size, literal_data = self.file_destination.apply_delta.call_args[0]
+        eq_(file_signature, self.file_signature)
+        eq_(file_size, len(self.file_data_new))
+
+    def test_literal_data_streamed(self):
+        self.file_destination.server_hash.side_effect = [self.file_signature['file_hash'],
+                                                         HashCache.calculate_hash(self.file_data_new)]
+        self.file_source.read_chunks.side_effect = lambda block_size: iter(chunked(self.file_data_new, 8))
+        patched = []
+
+        def apply_delta(file_signature, instructions, file_size, literal_data):
+            # New data is passed by its length, and read from the source as it is needed
+            literal_data = iter(literal_data)
+            for instruction, value in instructions:
+                if instruction == INSTRUCTION_LITERAL:
+                    eq_(type(value), int)
+                    patched.append(next(literal_data))
+
+                else:
+                    patched.append(self.file_data_old[value * 16:value * 16 + 16])
+
+            return 7
+
+        self.file_destination.apply_delta.side_effect = apply_delta
+
+        DeltaTransfer(self.file_source, self.file_destination, self.file_signature, 64).run()
+
+        eq_(b''.join(patched), self.file_data_new)
+
+    def test_too_much_new_data(self):
+        self.file_destination.server_hash.return_value = self.file_signature['file_hash']
+        self.file_source.read_chunks.return_value = [b'abcdefghij' * 10]
+
+        transfer_object = DeltaTransfer(self.file_source, self.file_destination, self.file_signature, 64)
+
+        eq_(transfer_object.run(), None)
+        eq_(self.file_destination.apply_delta.call_count, 0)
+
+    def test_too_much_new_data_early(self):
+        self.file_destination.server_hash.return_value = self.file_signature['file_hash']
+        chunks_read = []
+
+        def read_chunks(block_size):
+            for index in range(1000):
+                chunks_read.append(index)
+                yield bytes(bytearray(random.randint(0, 255) for index in range(1024)))
+
+        self.file_source.read_chunks.side_effect = read_chunks
+
+        eq_(DeltaTransfer(self.file_source, self.file_destination, self.file_signature, 64).run(), None)
+
+        # Given up on without reading the whole source
+        assert_true(len(chunks_read) < 200)
+
+    @raises(FileException)
+    def test_destination_changed(self):
+        self.file_destination.server_hash.return_value = HashCache.calculate_hash(b'something else')
+
+        try:
+            DeltaTransfer(self.file_source, self.file_destination, self.file_signature, 64).run()
+
+        finally:
+            eq_(self.file_destination.apply_delta.call_count, 0)
+
+    def test_server_hash_unavailable(self):
+        self.file_destination.server_hash.return_value = None
+
+        eq_(DeltaTransfer(self.file_source, self.file_destination, self.file_signature, 64).run(), None)
+        eq_(self.file_destination.apply_delta.call_count, 0)
+
+    @raises(FileException)
+    def test_verify_failed(self):
+        self.file_destination.server_hash.side_effect = [self.file_signature['file_hash'], None]
+
+        DeltaTransfer(self.file_source, self.file_destination, self.file_signature, 64).run()
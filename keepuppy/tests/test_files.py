@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
-from keepuppy.files import FileLocal, FileSFTP
+from keepuppy.files import FileLocal, FileSFTP, fingerprint_last_changed
 from keepuppy.exceptions import FileException
 import os
+import sys
+import stat
+import subprocess
 import tempfile
 from nose.tools import eq_, assert_true, assert_false, raises
 from datetime import datetime
 from sftp_server import SFTPAuth, SFTPServer
+from mock import MagicMock
 import logging
 
 log = logging.getLogger(__name__)
@@ -22,6 +26,15 @@ def test_sftp_no_file_name():
     FileSFTP(None, None, None, None, None)
 
 
+def test_paramiko_not_imported():
+    # Checked in a new interpreter, as the SFTP tests load paramiko here
+    package_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    output = subprocess.check_output([sys.executable, '-c', 'import sys, keepuppy; print("paramiko" in sys.modules)'],
+                                     cwd = package_dir)
+
+    eq_(output.strip(), b'False')
+
+
 class TestFileBase(object):
 
     file_name = 'test.txt'
@@ -52,6 +65,9 @@ class TestFileLocalMissing(TestFileBase):
         with self.file_object as f:
             assert_true(f.last_changed() is None)
 
+    def test_fingerprint(self):
+        assert_true(self.file_object.fingerprint() is None)
+
     def test_key(self):
         assert_true(isinstance(self.file_object.key, str))
 
@@ -64,6 +80,10 @@ class TestFileLocalMissing(TestFileBase):
         with self.file_object as f:
             f.read()
 
+    @raises(FileException)
+    def test_read_chunks(self):
+        list(self.file_object.read_chunks())
+
     @raises(FileException)
     def test_write(self):
         self.file_object.write(self.file_data)
@@ -73,6 +93,10 @@ class TestFileLocalMissing(TestFileBase):
         with self.file_object as f:
             f.write(self.file_data)
 
+    @raises(FileException)
+    def test_write_chunks(self):
+        self.file_object.write_chunks([self.file_data])
+
     @raises(FileException)
     def test_rename(self):
         new_file_name = self.file_object.name + self.rename_suffix
@@ -104,7 +128,7 @@ class TestFileLocal(TestFileBase):
             return f.read()
 
     def delete_file_data(self):
-        for file_name in [self.temp_file.name, self.temp_file.name + self.rename_suffix]:
+        for file_name in [self.temp_file.name, self.temp_file.name + self.rename_suffix, self.temp_file.name + '.copy']:
             try:
                 os.unlink(file_name)
 
@@ -128,6 +152,32 @@ class TestFileLocal(TestFileBase):
         with self.file_object as f:
             assert_true(isinstance(f.last_changed(), datetime))
 
+    def test_stat(self):
+        file_stat = self.file_object.stat()
+        eq_(file_stat.size, len(self.file_data))
+
+        # Changes made behind the object's back are only seen once the snapshot is invalidated
+        with open(self.temp_file.name, 'ab') as f:
+            f.write(self.file_data)
+
+        eq_(self.file_object.stat(), file_stat)
+
+        self.file_object.invalidate_stat()
+        eq_(self.file_object.stat().size, len(self.file_data) * 2)
+
+    def test_stat_write(self):
+        self.file_object.stat()
+        self.file_object.write(self.file_data * 2)
+
+        eq_(self.file_object.stat().size, len(self.file_data) * 2)
+
+    def test_fingerprint(self):
+        mtime_ns, file_size, inode = self.file_object.fingerprint()
+
+        eq_(file_size, len(self.file_data))
+        eq_(inode, os.stat(self.file_object.name).st_ino)
+        eq_(fingerprint_last_changed([mtime_ns]).replace(microsecond = 0), self.file_object.last_changed())
+
     def test_key(self):
         assert_true(isinstance(self.file_object.key, str))
 
@@ -138,6 +188,14 @@ class TestFileLocal(TestFileBase):
         with self.file_object as f:
             eq_(f.read(), self.file_data)
 
+    def test_server_hash(self):
+        eq_(self.file_object.server_hash(), None)
+
+    def test_read_chunks(self):
+        chunks = list(self.file_object.read_chunks(4))
+
+        eq_(chunks, [self.file_data[:4], self.file_data[4:]])
+
     def test_write(self):
         self.file_object.write(self.file_data)
 
@@ -149,6 +207,11 @@ class TestFileLocal(TestFileBase):
 
         eq_(self.read_file_data(), self.file_data)
 
+    def test_write_chunks(self):
+        self.file_object.write_chunks(iter([self.file_data[:4], self.file_data[4:]]))
+
+        eq_(self.read_file_data(), self.file_data)
+
     def test_rename(self):
         new_file_name = self.file_object.name + self.rename_suffix
         self.file_object.rename(new_file_name)
@@ -164,6 +227,61 @@ class TestFileLocal(TestFileBase):
         eq_(self.file_object.name, new_file_name)
         assert_true(self.file_object.exists())
 
+    def test_write_keeps_mode(self):
+        os.chmod(self.temp_file.name, 0o600)
+
+        self.file_object.write(b'new')
+
+        eq_(stat.S_IMODE(os.stat(self.temp_file.name).st_mode), 0o600)
+        eq_(self.file_object.read(), b'new')
+
+    def test_write_mode_before_data(self):
+        os.chmod(self.temp_file.name, 0o600)
+        temp_dir = os.path.dirname(self.temp_file.name)
+        file_modes = []
+
+        def chunks():
+            yield b'new'
+            for file_name in os.listdir(temp_dir):
+                if file_name.startswith(os.path.basename(self.temp_file.name) + '.'):
+                    file_modes.append(stat.S_IMODE(os.stat(os.path.join(temp_dir, file_name)).st_mode))
+
+            yield b' data'
+
+        self.file_object.write_chunks(chunks())
+
+        eq_(file_modes, [0o600])
+        eq_(self.file_object.read(), b'new data')
+
+    def test_write_link(self):
+        link_name = self.temp_file.name + '.copy'
+        os.symlink(self.temp_file.name, link_name)
+
+        FileLocal(link_name).write(b'new')
+
+        assert_true(os.path.islink(link_name))
+        eq_(self.file_object.read(), b'new')
+
+    def test_write_no_temp_file(self):
+        temp_dir = os.path.dirname(self.temp_file.name)
+        file_names = set(os.listdir(temp_dir))
+
+        self.file_object.write(b'new')
+
+        eq_(set(os.listdir(temp_dir)), file_names)
+
+    def test_create(self):
+        file_object = FileLocal(self.file_object.name + '.copy')
+
+        assert_true(file_object.create(b'new'))
+        assert_false(file_object.create(b'newer'))
+        eq_(file_object.read(), b'new')
+
+    def test_remove(self):
+        self.file_object.remove()
+
+        assert_false(self.file_object.exists())
+
     def test_copy(self):
         file_name = self.file_object.name + '.copy'
         copy_object = self.file_object.copy(file_name)
@@ -179,6 +297,46 @@ class TestFileLocal(TestFileBase):
         assert_true(self.file_object.name != copy_object.name)
         eq_(copy_object.read(), self.file_data)
 
+    def test_copy_method(self):
+        copy_object = self.file_object.copy(self.file_object.name + '.copy')
+
+        assert_true(copy_object.copy_method in FileLocal.copy_methods)
+
+    def test_copy_fallback(self):
+        for method_name in FileLocal.copy_methods[:-1]:
+            setattr(self.file_object, method_name, MagicMock(return_value = False))
+
+        copy_object = self.file_object.copy(self.file_object.name + '.copy')
+
+        eq_(copy_object.copy_method, '_copy_buffered')
+        eq_(copy_object.read(), self.file_data)
+
+    def test_copy_fallback_partial(self):
+        def copy_partial(file_source, file_destination):
+            file_destination.write(b'partial')
+            return False
+
+        self.file_object._copy_clone = copy_partial
+        copy_object = self.file_object.copy(self.file_object.name + '.copy')
+
+        eq_(copy_object.read(), self.file_data)
+
+    def test_copy_fd(self):
+        for method_name in ['_copy_file_range', '_copy_sendfile']:
+            file_name = self.file_object.name + '.copy'
+            with open(self.file_object.name, 'rb') as file_source:
+                with open(file_name, 'wb') as file_destination:
+                    copied = getattr(FileLocal, method_name)(file_source, file_destination)
+
+            if copied:
+                eq_(FileLocal(file_name).read(), self.file_data)
+
+    @raises(FileException)
+    def test_copy_missing(self):
+        os.unlink(self.file_object.name)
+
+        self.file_object.copy(self.file_object.name + '.copy')
+
 
 class TestFileSFTPUnconnected(TestFileBase):
 
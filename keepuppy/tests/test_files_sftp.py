@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 
-from keepuppy.files import FileSFTP
+from keepuppy.files import FileSFTP, FileLocal
+from keepuppy.sync import Syncer, HashCache
+from keepuppy.delta import signature, delta
+from keepuppy.pool import SFTPConnectionPool, connection_pool, load_paramiko
 from keepuppy.exceptions import FileException
 from test_files import TestFileBase
 from sftp_server import SFTPAuth, SFTPServer
 import os
+import stat
 import tempfile
-from nose.tools import eq_, assert_true, assert_false, raises
-from time import sleep
+import threading
+import socket
+from nose.tools import eq_, assert_true, assert_false, assert_raises, raises
+from time import sleep, time
+from mock import MagicMock
 import shutil
 import logging
 
@@ -34,6 +41,8 @@ def setup():
 
 
 def teardown():
+    connection_pool.close_all()
+
     sftp_server.stop()
     sftp_server.join()
 
@@ -67,7 +76,7 @@ class TestFileSFTP(TestFileBase):
 
     def delete_file_data(self):
         file_name_full = os.path.join(temp_dir, self.file_name)
-        for file_name in [file_name_full, file_name_full + self.rename_suffix]:
+        for file_name in [file_name_full, file_name_full + self.rename_suffix, file_name_full + '.copy', file_name_full + '.copy2']:
             try:
                 os.unlink(file_name)
 
@@ -107,6 +116,38 @@ class TestFileSFTP(TestFileBase):
         assert_true(isinstance(self.file_object.key, str))
         assert_false(self.file_object.is_open())
 
+    def test_fingerprint_missing(self):
+        eq_(self.file_object.fingerprint(), None)
+        assert_false(self.file_object.is_open())
+
+    def test_stat(self):
+        self.write_file_data()
+
+        eq_(self.file_object.stat().size, len(self.file_data))
+        assert_false(self.file_object.is_open())
+
+        self.delete_file_data()
+        assert_true(self.file_object.exists())
+
+        self.file_object.invalidate_stat()
+        assert_false(self.file_object.exists())
+
+    def test_stat_write(self):
+        eq_(self.file_object.stat(), None)
+
+        self.file_object.write(self.file_data)
+
+        eq_(self.file_object.stat().size, len(self.file_data))
+
+    def test_fingerprint(self):
+        self.write_file_data()
+
+        mtime_ns, file_size, inode = self.file_object.fingerprint()
+
+        eq_(file_size, len(self.file_data))
+        eq_(mtime_ns // 1000000000, int(os.path.getmtime(os.path.join(temp_dir, self.file_name))))
+        assert_false(self.file_object.is_open())
+
     @raises(FileException)
     def test_read_missing(self):
         self.file_object.read()
@@ -129,6 +170,25 @@ class TestFileSFTP(TestFileBase):
             eq_(f.read(), self.file_data)
         assert_false(self.file_object.is_open())
 
+    @raises(FileException)
+    def test_read_chunks_missing(self):
+        list(self.file_object.read_chunks())
+
+    def test_read_chunks(self):
+        self.write_file_data()
+
+        chunks = list(self.file_object.read_chunks(4))
+
+        eq_(chunks, [self.file_data[:4], self.file_data[4:]])
+        assert_false(self.file_object.is_open())
+
+    def test_server_hash_unsupported(self):
+        self.write_file_data()
+
+        eq_(self.file_object.server_hash(), None)
+        eq_(self.file_object.server_hash(), None)
+        assert_false(self.file_object.is_open())
+
     def test_write(self):
         self.file_object.write(self.file_data)
 
@@ -142,6 +202,12 @@ class TestFileSFTP(TestFileBase):
         eq_(self.read_file_data(), self.file_data)
         assert_false(self.file_object.is_open())
 
+    def test_write_chunks(self):
+        self.file_object.write_chunks(iter([self.file_data[:4], self.file_data[4:]]))
+
+        eq_(self.read_file_data(), self.file_data)
+        assert_false(self.file_object.is_open())
+
     @raises(FileException)
     def test_rename_missing(self):
         new_file_name = self.file_object.name + self.rename_suffix
@@ -180,6 +246,92 @@ class TestFileSFTP(TestFileBase):
         server_file_name = os.path.join(temp_dir, self.file_object.name)
         os.unlink(server_file_name)
 
+    def check_rename_replace(self):
+        self.write_file_data()
+        new_file_name = self.file_object.name + self.rename_suffix
+        with open(os.path.join(temp_dir, new_file_name), 'wb') as f:
+            f.write(b'old')
+
+        self.file_object.rename(new_file_name, replace = True)
+
+        eq_(self.file_object.name, new_file_name)
+        eq_(self.file_object.read(), self.file_data)
+
+        os.unlink(os.path.join(temp_dir, new_file_name))
+
+    def test_rename_replace(self):
+        self.check_rename_replace()
+
+    def test_rename_replace_fallback(self):
+        # As for servers without the posix-rename extension
+        self.file_object._posix_rename = False
+
+        self.check_rename_replace()
+
+    def test_write_replace(self):
+        self.write_file_data()
+        os.chmod(os.path.join(temp_dir, self.file_name), 0o600)
+
+        self.file_object.write(b'new')
+
+        eq_(self.file_object.read(), b'new')
+        eq_(stat.S_IMODE(os.stat(os.path.join(temp_dir, self.file_name)).st_mode), 0o600)
+        eq_(os.listdir(temp_dir), [self.file_name])
+
+    def test_write_mode_before_data(self):
+        self.write_file_data()
+        os.chmod(os.path.join(temp_dir, self.file_name), 0o600)
+        file_modes = []
+
+        def chunks():
+            yield b'new'
+            for file_name in os.listdir(temp_dir):
+                if file_name != self.file_name:
+                    file_modes.append(stat.S_IMODE(os.stat(os.path.join(temp_dir, file_name)).st_mode))
+
+            yield b' data'
+
+        self.file_object.write_chunks(chunks())
+
+        eq_(file_modes, [0o600])
+        eq_(self.file_object.read(), b'new data')
+
+    def test_write_chunks_error(self):
+        self.write_file_data()
+
+        def chunks():
+            yield b'new'
+            raise FileException('Error reading local file')
+
+        assert_raises(FileException, self.file_object.write_chunks, chunks())
+
+        eq_(self.file_object.read(), self.file_data)
+        eq_(os.listdir(temp_dir), [self.file_name])
+
+    def test_write_replace_fallback(self):
+        self.file_object._posix_rename = False
+        self.write_file_data()
+
+        self.file_object.write(b'new')
+
+        eq_(self.file_object.read(), b'new')
+        eq_(os.listdir(temp_dir), [self.file_name])
+
+    def test_create(self):
+        file_object = self.file_object.sibling(self.file_name + '.copy')
+
+        assert_true(file_object.create(b'new'))
+        assert_false(file_object.create(b'newer'))
+        eq_(file_object.read(), b'new')
+        eq_(sorted(os.listdir(temp_dir)), [self.file_name + '.copy'])
+
+    def test_remove(self):
+        self.write_file_data()
+
+        self.file_object.remove()
+
+        assert_false(self.file_object.exists())
+
     def test_copy(self):
         self.write_file_data()
 
@@ -191,18 +343,320 @@ class TestFileSFTP(TestFileBase):
         assert_false(self.file_object.is_open())
         assert_false(copy_object.is_open())
 
-    #TODO Enable once test SFTP server supports multiple open files
-    # def test_copy_with(self):
-    #     self.write_file_data()
-    #
-    #     with self.file_object as f:
-    #         file_name = f.name + '.copy'
-    #         copy_object = f.copy(file_name)
-    #
-    #     assert_true(self.file_object.name != copy_object.name)
-    #     eq_(copy_object.read(), self.file_data)
-    #     assert_false(self.file_object.is_open())
-    #     assert_false(copy_object.is_open())
+    def test_copy_with(self):
+        self.write_file_data()
+
+        with self.file_object as f:
+            file_name = f.name + '.copy'
+            copy_object = f.copy(file_name)
+
+        assert_true(self.file_object.name != copy_object.name)
+        eq_(copy_object.read(), self.file_data)
+        assert_false(self.file_object.is_open())
+        assert_false(copy_object.is_open())
+
+    def test_copy_fallback(self):
+        self.write_file_data()
+
+        # The test server supports neither copy-data nor commands
+        self.file_object.copy(self.file_object.name + '.copy')
+        eq_(self.file_object._copy_methods, ['_copy_stream'])
+
+        copy_object = self.file_object.copy(self.file_object.name + '.copy2')
+        eq_(copy_object.read(), self.file_data)
+
+    def test_copy_data_without_int64(self):
+        self.write_file_data()
+        sftp_module = load_paramiko().sftp
+        int64 = getattr(sftp_module, 'int64', None)
+        sftp_module.int64 = None
+
+        try:
+            # The test server does not support copy-data, so it falls back rather than failing
+            with self.file_object:
+                assert_false(self.file_object._copy_data(self.file_object.name + '.copy'))
+
+        finally:
+            sftp_module.int64 = int64
+
+    def test_copy_server_side(self):
+        self.file_object._copy_data = MagicMock(return_value = False)
+        self.file_object._copy_exec = MagicMock(return_value = True)
+        self.file_object._copy_stream = MagicMock(return_value = True)
+
+        self.file_object.copy(self.file_object.name + '.copy')
+        self.file_object.copy(self.file_object.name + '.copy')
+
+        eq_(self.file_object._copy_data.call_count, 1)
+        eq_(self.file_object._copy_exec.call_count, 2)
+        eq_(self.file_object._copy_stream.call_count, 0)
+
+    def test_copy_exec_options(self):
+        self.file_object._exec = MagicMock(return_value = None)
+
+        assert_false(self.file_object._copy_exec('-n'))
+        eq_(self.file_object._exec.call_args[0][0], 'cp -- %s -n' % self.file_object.name)
+
+    @raises(FileException)
+    def test_copy_missing(self):
+        self.file_object.copy(self.file_object.name + '.copy')
+
+    def test_apply_delta(self):
+        file_data_old = b'abcdefgh01234567' * 8 + b'tail'
+        file_data_new = file_data_old[64:] + b'new data' + file_data_old[:64]
+        file_name_full = os.path.join(temp_dir, self.file_name)
+        with open(file_name_full, 'wb') as f:
+            f.write(file_data_old)
+
+        file_signature = signature([file_data_old], 8)
+        bytes_transferred = self.file_object.apply_delta(file_signature,
+                                                         list(delta(file_signature, [file_data_new])),
+                                                         len(file_data_new))
+
+        with open(file_name_full, 'rb') as f:
+            eq_(f.read(), file_data_new)
+        assert_true(bytes_transferred < len(file_data_new))
+        assert_false(self.file_object.is_open())
+
+    def test_apply_delta_literal_data(self):
+        file_data_old = b'abcdefgh01234567' * 8
+        file_data_new = b'new data' + file_data_old[:64] + b'more'
+        file_name_full = os.path.join(temp_dir, self.file_name)
+        with open(file_name_full, 'wb') as f:
+            f.write(file_data_old)
+
+        file_signature = signature([file_data_old], 8)
+        instructions = list(delta(file_signature, [file_data_new]))
+        self.file_object.apply_delta(file_signature,
+                                     [(instruction, len(value) if instruction == 'literal' else value)
+                                      for instruction, value in instructions],
+                                     len(file_data_new),
+                                     [value for instruction, value in instructions if instruction == 'literal'])
+
+        with open(file_name_full, 'rb') as f:
+            eq_(f.read(), file_data_new)
+
+    @raises(FileException)
+    def test_apply_delta_literal_data_missing(self):
+        self.write_file_data()
+
+        file_signature = signature([b'abcdefgh'], 8)
+        self.file_object.apply_delta(file_signature, [('literal', 8)], 8, [])
+
+    def test_apply_delta_truncate(self):
+        file_data_old = b'abcdefgh01234567' * 8
+        file_name_full = os.path.join(temp_dir, self.file_name)
+        with open(file_name_full, 'wb') as f:
+            f.write(file_data_old)
+
+        file_signature = signature([file_data_old], 8)
+        eq_(self.file_object.apply_delta(file_signature, list(delta(file_signature, [file_data_old[:20]])), 20), 4)
+
+        with open(file_name_full, 'rb') as f:
+            eq_(f.read(), file_data_old[:20])
+
+    @raises(FileException)
+    def test_apply_delta_missing(self):
+        file_signature = signature([b'abcdefgh'], 8)
+        self.file_object.apply_delta(file_signature, [('literal', b'abcdefgh')], 8)
+
+    def test_lock_step(self):
+        file_object = FileSFTP(self.file_name,
+                               SFTPAuth.user_name,
+                               SFTPAuth.password,
+                               SFTPServer.host_name,
+                               SFTPServer.host_port,
+                               pipelined = False)
+
+        file_object.write_chunks(iter([self.file_data[:4], self.file_data[4:]]))
+
+        eq_(self.read_file_data(), self.file_data)
+        eq_(file_object.read(), self.file_data)
+        eq_(list(file_object.read_chunks(4)), [self.file_data[:4], self.file_data[4:]])
+
+
+class TestFileSFTPPool(TestFileBase):
+
+    pool = None
+
+    def setup(self):
+        self.pool = SFTPConnectionPool()
+
+    def teardown(self):
+        self.pool.close_all()
+
+    def create_file_object(self, file_name, password = SFTPAuth.password):
+        return FileSFTP(file_name,
+                        SFTPAuth.user_name,
+                        password,
+                        SFTPServer.host_name,
+                        SFTPServer.host_port,
+                        pool = self.pool)
+
+    def test_shared(self):
+        file_object = self.create_file_object(self.file_name)
+        file_object_other = self.create_file_object(self.file_name + '.other')
+
+        with file_object:
+            with file_object_other:
+                assert_true(file_object._sftp is file_object_other._sftp)
+
+            assert_false(file_object_other.is_open())
+            assert_true(file_object.is_open())
+
+        eq_(self.pool.connect_count, 1)
+        eq_(self.pool.reuse_count, 1)
+
+    def test_idle(self):
+        file_object = self.create_file_object(self.file_name)
+
+        with file_object:
+            sftp = file_object._sftp
+
+        # Released connections stay open until the idle timeout
+        with file_object:
+            assert_true(file_object._sftp is sftp)
+
+        self.pool.idle_timeout = 0
+        self.pool.evict_idle()
+
+        with file_object:
+            assert_true(file_object._sftp is not sftp)
+
+        eq_(self.pool.connect_count, 2)
+
+    def test_inactive(self):
+        file_object = self.create_file_object(self.file_name)
+
+        with file_object:
+            file_object._transport.close()
+
+        with file_object:
+            assert_true(file_object.is_open())
+
+        eq_(self.pool.connect_count, 2)
+
+    def test_copy(self):
+        file_object = self.create_file_object(self.file_name)
+        file_object.write(self.file_data)
+
+        copy_object = file_object.copy(self.file_name + '.copy')
+        eq_(copy_object.read(), self.file_data)
+
+        copy_object.rename(self.file_name + self.rename_suffix)
+        eq_(self.pool.connect_count, 1)
+
+        for file_name in [self.file_name, self.file_name + self.rename_suffix]:
+            os.unlink(os.path.join(temp_dir, file_name))
+
+    def test_sessions_reused(self):
+        local_dir = tempfile.mkdtemp()
+        syncer = Syncer(HashCache(os.path.join(local_dir, 'cache.json')))
+        file_pairs = []
+        for index in range(4):
+            file_local = FileLocal(os.path.join(local_dir, 'local%d' % index))
+            file_local.write(b'0123')
+            file_pairs.append((file_local, self.create_file_object('%s.%d' % (self.file_name, index))))
+
+        try:
+            # Each call runs on new threads, which borrow the sessions the last call's threads returned
+            for index in range(5):
+                syncer.sync_many(file_pairs, workers = 4)
+
+            connection, = self.pool._connections.values()
+            assert_true(len(connection._sftp_list) <= 4)
+
+        finally:
+            shutil.rmtree(local_dir)
+            for index in range(4):
+                os.unlink(os.path.join(temp_dir, '%s.%d' % (self.file_name, index)))
+
+    def test_sessions_per_thread(self):
+        file_object = self.create_file_object(self.file_name)
+        sessions = []
+
+        def use_session():
+            with file_object:
+                sessions.append(file_object._sftp)
+
+        with file_object:
+            sftp = file_object._sftp
+
+            thread = threading.Thread(target = use_session)
+            thread.start()
+            thread.join()
+
+        eq_(len(sessions), 1)
+        assert_true(sessions[0] is not sftp)
+
+    def test_connect_same_server(self):
+        file_objects = [self.create_file_object('%s.%d' % (self.file_name, index)) for index in range(4)]
+        threads = [threading.Thread(target = file_object.open) for file_object in file_objects]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        eq_(self.pool.connect_count, 1)
+        eq_(self.pool.reuse_count, 3)
+
+        for file_object in file_objects:
+            file_object.close()
+
+    def test_connect_slow_server(self):
+        # Accepts connections but never answers, so connecting to it waits
+        slow_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        slow_socket.bind((SFTPServer.host_name, 0))
+        slow_socket.listen(1)
+
+        file_slow = FileSFTP(self.file_name,
+                             SFTPAuth.user_name,
+                             SFTPAuth.password,
+                             SFTPServer.host_name,
+                             slow_socket.getsockname()[1],
+                             pool = self.pool)
+        errors = []
+
+        def open_slow():
+            try:
+                file_slow.open()
+
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target = open_slow)
+        thread.start()
+        sleep(0.2)
+
+        try:
+            time_start = time()
+            with self.create_file_object(self.file_name) as file_object:
+                assert_true(file_object.is_open())
+
+            assert_true(time() - time_start < 5)
+
+        finally:
+            slow_socket.close()
+            thread.join()
+
+        eq_(len(errors), 1)
+
+    def test_window_size(self):
+        self.pool.window_size = 4 * 1024 * 1024
+        self.pool.max_packet_size = 16 * 1024
+
+        with self.create_file_object(self.file_name) as file_object:
+            eq_(file_object._transport.default_window_size, 4 * 1024 * 1024)
+            eq_(file_object._transport.default_max_packet_size, 16 * 1024)
+
+    @raises(FileException)
+    def test_bad_password(self):
+        with self.create_file_object(self.file_name):
+            pass
+
+        with self.create_file_object(self.file_name, SFTPAuth.password + 'bad'):
+            pass
 
 
 class TestFileSFTPBadPassword(TestFileBase):
@@ -250,3 +704,7 @@ class TestFileSFTPBadWrite(TestFileBase):
     def test_write_with(self):
         with self.file_object as f:
             f.write(self.file_data)
+
+    @raises(FileException)
+    def test_write_chunks(self):
+        self.file_object.write_chunks([self.file_data])
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+from keepuppy.lease import RemoteLease, RemoteLocker
+from keepuppy.files import FileLocal
+from keepuppy.sync import Syncer, HashCache
+from keepuppy.exceptions import SyncException
+import os
+import json
+import shutil
+import tempfile
+import threading
+from time import sleep, time
+from nose.tools import eq_, assert_true, assert_false, assert_raises, raises
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TestRemoteLease(object):
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_object = FileLocal(os.path.join(self.temp_dir, 'test.kdbx'))
+        self.lock_file_name = self.file_object.name + '.lock'
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_lease(self, owner, duration = 60, timeout = 0.2):
+        return RemoteLease(self.file_object, owner, duration, timeout)
+
+    def test_acquire_release(self):
+        lease = self.create_lease('client1')
+
+        with lease:
+            assert_true(lease.held)
+            with open(self.lock_file_name) as file_object:
+                eq_(json.load(file_object)['owner'], 'client1')
+
+        assert_false(lease.held)
+        assert_false(os.path.exists(self.lock_file_name))
+
+    @raises(SyncException)
+    def test_held_elsewhere(self):
+        with self.create_lease('client1'):
+            self.create_lease('client2').acquire()
+
+    def test_wait_for_release(self):
+        lease = self.create_lease('client1')
+        lease.acquire()
+
+        release_thread = threading.Timer(0.2, lease.release)
+        release_thread.start()
+
+        with self.create_lease('client2', timeout = 5) as lease_other:
+            assert_true(lease_other.held)
+
+        release_thread.join()
+
+    def test_replaced_by_other(self):
+        lease = self.create_lease('client1')
+        lease_other = self.create_lease('client2')
+
+        def create(file_data):
+            # As on a server where rename replaces the file, the other client's lock file lands on top of this one's
+            lease_other.lock_file.write(lease_other._encode('token2', time() + 60))
+            return True
+
+        lease.lock_file.create = create
+
+        assert_raises(SyncException, lease.acquire)
+        assert_false(lease.held)
+        with open(self.lock_file_name) as file_object:
+            eq_(json.load(file_object)['owner'], 'client2')
+
+    def test_expired(self):
+        lease = self.create_lease('client1', duration = 0)
+        lease.acquire()
+
+        with self.create_lease('client2'):
+            # The first lease is no longer held, so releasing it leaves the second in place
+            lease.release()
+
+            with open(self.lock_file_name) as file_object:
+                eq_(json.load(file_object)['owner'], 'client2')
+
+    @raises(SyncException)
+    def test_invalid(self):
+        with open(self.lock_file_name, 'w') as file_object:
+            file_object.write('not json')
+
+        self.create_lease('client1').acquire()
+
+    def test_invalid_expired(self):
+        with open(self.lock_file_name, 'w') as file_object:
+            file_object.write('not json')
+
+        with self.create_lease('client1', duration = 0) as lease:
+            assert_true(lease.held)
+
+    def test_locker(self):
+        lease = RemoteLocker('client1', duration = 10, timeout = 1).lease(self.file_object)
+
+        eq_(lease.lock_file.name, self.lock_file_name)
+        eq_(lease.owner, 'client1')
+
+
+class TestSyncLease(object):
+
+    file_data = b'0123456789' * 100
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_remote = FileLocal(os.path.join(self.temp_dir, 'remote.kdbx'))
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_client(self, name, timeout = 5):
+        syncer = Syncer(HashCache(os.path.join(self.temp_dir, name + '.json')),
+                        locker = RemoteLocker(name, timeout = timeout))
+        file_local = FileLocal(os.path.join(self.temp_dir, name + '.kdbx'))
+        file_local.write(self.file_data)
+
+        return syncer, file_local
+
+    def test_upload(self):
+        syncer, file_local = self.create_client('client1')
+
+        eq_(syncer.sync(file_local, self.file_remote), 'Remote file missing, copied to remote')
+        eq_(self.file_remote.read(), self.file_data)
+        eq_(sorted(os.listdir(self.temp_dir)), ['client1.json', 'client1.kdbx', 'remote.kdbx'])
+
+    def test_upload_by_other_client(self):
+        syncer, file_local = self.create_client('client1')
+        lease = RemoteLocker('client2').lease(self.file_remote)
+        lease.acquire()
+
+        def upload():
+            sleep(0.2)
+            self.file_remote.write(self.file_data)
+            lease.release()
+
+        upload_thread = threading.Thread(target = upload)
+        upload_thread.start()
+
+        # The other client uploaded the same data while this one waited, so there is nothing to copy
+        eq_(syncer.sync(file_local, self.file_remote), 'Files are up to date')
+        upload_thread.join()
+
+        snapshot = syncer.metrics.snapshot()
+        eq_(snapshot['counters']['lease_rechecks'], 1)
+        eq_(snapshot['bytes_written'], {})
+
+    @raises(SyncException)
+    def test_timeout(self):
+        syncer, file_local = self.create_client('client1', timeout = 0.2)
+
+        with RemoteLocker('client2').lease(self.file_remote):
+            syncer.sync(file_local, self.file_remote)
+
+    def test_no_lease_when_up_to_date(self):
+        syncer, file_local = self.create_client('client1', timeout = 0.2)
+        syncer.sync(file_local, self.file_remote)
+
+        with RemoteLocker('client2').lease(self.file_remote):
+            eq_(syncer.sync(file_local, self.file_remote), 'Files are up to date')
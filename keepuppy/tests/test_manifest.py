@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+from keepuppy.manifest import RemoteManifest
+from keepuppy.files import FileLocal
+from keepuppy.sync import Syncer, HashCache
+import os
+import json
+import shutil
+import tempfile
+from nose.tools import eq_, assert_false
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TestRemoteManifest(object):
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.manifest_file = FileLocal(os.path.join(self.temp_dir, 'manifest.json'))
+
+        self.file_object = FileLocal(os.path.join(self.temp_dir, 'test.kdbx'))
+        self.file_object.write(b'0123')
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_lookup(self):
+        RemoteManifest(self.manifest_file, 'client1').update(self.file_object, 'abcd')
+
+        entry = RemoteManifest(self.manifest_file, 'client2').lookup(self.file_object)
+
+        eq_(entry['file_hash'], 'abcd')
+        eq_(entry['writer'], 'client1')
+        eq_(entry['size'], 4)
+
+    def test_missing(self):
+        eq_(RemoteManifest(self.manifest_file).lookup(self.file_object), None)
+
+    def test_changed(self):
+        RemoteManifest(self.manifest_file).update(self.file_object, 'abcd')
+
+        self.file_object.write(b'01234')
+
+        eq_(RemoteManifest(self.manifest_file).lookup(self.file_object), None)
+
+    def test_entries_kept(self):
+        file_other = FileLocal(os.path.join(self.temp_dir, 'other.kdbx'))
+        file_other.write(b'4567')
+
+        manifest = RemoteManifest(self.manifest_file, 'client1')
+        manifest.lookup(self.file_object)
+        RemoteManifest(self.manifest_file, 'client2').update(file_other, 'efgh')
+        manifest.update(self.file_object, 'abcd')
+
+        with open(self.manifest_file.name) as file_object:
+            eq_(sorted(json.load(file_object)['files']), sorted([self.file_object.key, file_other.key]))
+
+    def test_max_age(self):
+        manifest = RemoteManifest(self.manifest_file, max_age = 60)
+        eq_(manifest.lookup(self.file_object), None)
+
+        RemoteManifest(self.manifest_file).update(self.file_object, 'abcd')
+        eq_(manifest.lookup(self.file_object), None)
+
+        manifest.refresh()
+        eq_(manifest.lookup(self.file_object)['file_hash'], 'abcd')
+
+    def test_invalid(self):
+        self.manifest_file.write(b'not json')
+
+        eq_(RemoteManifest(self.manifest_file).lookup(self.file_object), None)
+
+    def test_no_temp_file(self):
+        RemoteManifest(self.manifest_file).update(self.file_object, 'abcd')
+
+        eq_(sorted(os.listdir(self.temp_dir)), ['manifest.json', 'test.kdbx'])
+
+
+class TestSyncManifest(object):
+
+    file_data = b'0123456789' * 100
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.manifest_file = FileLocal(os.path.join(self.temp_dir, 'manifest.json'))
+        self.file_remote = FileLocal(os.path.join(self.temp_dir, 'remote.kdbx'))
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_client(self, name):
+        syncer = Syncer(HashCache(os.path.join(self.temp_dir, name + '.json')),
+                        manifest = RemoteManifest(self.manifest_file, name))
+        file_local = FileLocal(os.path.join(self.temp_dir, name + '.kdbx'))
+
+        return syncer, file_local
+
+    def test_remote_not_read(self):
+        syncer_upload, file_upload = self.create_client('client1')
+        file_upload.write(self.file_data)
+        syncer_upload.sync(file_upload, self.file_remote)
+
+        syncer, file_local = self.create_client('client2')
+        file_local.write(self.file_data)
+
+        eq_(syncer.sync(file_local, self.file_remote), 'Files are up to date')
+
+        snapshot = syncer.metrics.snapshot()
+        eq_(snapshot['counters']['manifest_hits'], 1)
+        eq_(snapshot['bytes_read'], {'local': len(self.file_data)})
+
+    def test_remote_changed_elsewhere(self):
+        syncer_upload, file_upload = self.create_client('client1')
+        file_upload.write(self.file_data)
+        syncer_upload.sync(file_upload, self.file_remote)
+
+        self.file_remote.write(b'changed')
+
+        syncer, file_local = self.create_client('client2')
+        file_local.write(self.file_data)
+        syncer.sync(file_local, self.file_remote)
+
+        eq_(syncer.metrics.snapshot()['counters']['manifest_misses'], 1)
+
+    def test_not_read_when_cached(self):
+        syncer, file_local = self.create_client('client1')
+        file_local.write(self.file_data)
+        syncer.sync(file_local, self.file_remote)
+
+        os.unlink(self.manifest_file.name)
+        syncer.metrics.reset()
+
+        eq_(syncer.sync(file_local, self.file_remote), 'Files are up to date')
+
+        snapshot = syncer.metrics.snapshot()
+        assert_false('manifest' in snapshot['phase_count'])
+        eq_(snapshot['counters'].get('manifest_misses'), None)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from keepuppy.metrics import SyncMetrics, JSONLinesExporter, PrometheusTextfileExporter, subtract_snapshot
+from keepuppy.pool import SFTPConnectionPool
+import os
+import json
+import shutil
+import tempfile
+from nose.tools import eq_, assert_true, assert_false, raises
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class PhaseError(Exception):
+    pass
+
+
+class TestSyncMetrics(object):
+
+    def setup(self):
+        self.pool = SFTPConnectionPool()
+        self.metrics = SyncMetrics(self.pool)
+
+    def test_phase(self):
+        with self.metrics.phase('hash'):
+            pass
+
+        with self.metrics.phase('hash'):
+            pass
+
+        snapshot = self.metrics.snapshot()
+        eq_(snapshot['phase_count'], {'hash': 2})
+        assert_true(snapshot['phase_seconds']['hash'] >= 0)
+
+    @raises(PhaseError)
+    def test_phase_exception(self):
+        try:
+            with self.metrics.phase('transfer'):
+                raise PhaseError()
+
+        finally:
+            eq_(self.metrics.snapshot()['phase_count'], {'transfer': 1})
+
+    def test_bytes(self):
+        self.metrics.add_bytes_read('local', 10)
+        self.metrics.add_bytes_read('local', 5)
+        self.metrics.add_bytes_written('SFTP', 15)
+
+        snapshot = self.metrics.snapshot()
+        eq_(snapshot['bytes_read'], {'local': 15})
+        eq_(snapshot['bytes_written'], {'SFTP': 15})
+
+    def test_connections(self):
+        self.pool.connect_count = 1
+        self.pool.reuse_count = 3
+
+        connections = self.metrics.snapshot()['connections']
+        eq_(connections['connect_count'], 1)
+        eq_(connections['reuse_count'], 3)
+
+    def test_reset(self):
+        self.metrics.increment('cache_hits')
+        self.metrics.reset()
+
+        eq_(self.metrics.snapshot()['counters'], {})
+
+    def test_subtract_snapshot(self):
+        eq_(subtract_snapshot({'counters': {'syncs': 3, 'backups': 1}}, {'counters': {'syncs': 1}}),
+            {'counters': {'syncs': 2, 'backups': 1}})
+
+
+class TestExporters(object):
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.metrics = SyncMetrics(SFTPConnectionPool())
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_json_lines(self):
+        file_name = os.path.join(self.temp_dir, 'metrics.jsonl')
+        exporter = JSONLinesExporter(file_name)
+
+        self.metrics.increment('syncs')
+        self.metrics.add_bytes_written('SFTP', 100)
+        exporter.export(self.metrics)
+        self.metrics.increment('syncs')
+        exporter.export(self.metrics)
+
+        with open(file_name) as file_object:
+            records = [json.loads(line) for line in file_object]
+
+        eq_([record['counters']['syncs'] for record in records], [1, 1])
+        eq_([record['bytes_written']['SFTP'] for record in records], [100, 0])
+        assert_true('time' in records[0])
+
+    def test_prometheus(self):
+        file_name = os.path.join(self.temp_dir, 'keepuppy.prom')
+        exporter = PrometheusTextfileExporter(file_name)
+
+        self.metrics.increment('cache_hits', 2)
+        self.metrics.add_bytes_read('local', 100)
+        exporter.export(self.metrics)
+
+        with open(file_name) as file_object:
+            lines = file_object.read().splitlines()
+
+        assert_true('# TYPE keepuppy_events_total counter' in lines)
+        assert_true('keepuppy_events_total{event="cache_hits"} 2.0' in lines)
+        assert_true('keepuppy_bytes_read_total{backend="local"} 100.0' in lines)
+        assert_true('keepuppy_sftp_connections_total 0.0' in lines)
+        assert_false(os.path.exists(file_name + '.%d.tmp' % os.getpid()))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from keepuppy.profiling import ProfileSession, StackSampler, parse_import_times, measure_import_times
+import os
+import sys
+import shutil
+import pstats
+import tempfile
+from time import sleep
+from nose.tools import eq_, assert_true, assert_false
+import logging
+
+log = logging.getLogger(__name__)
+
+IMPORT_TIME_OUTPUT = '''import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _socket
+import time:       310 |        430 | socket
+import time:       250 |       1680 |   paramiko.transport
+import time:       900 |       2580 | paramiko
+'''
+
+
+def busy_function():
+    # Long enough to be seen by both cProfile and the sampler
+    total = 0
+    for index in range(200):
+        total += sum(range(1000))
+        sleep(0.0005)
+
+    return total
+
+
+class TestProfiling(object):
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_prefix = os.path.join(self.temp_dir, 'profile')
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_parse_import_times(self):
+        eq_(parse_import_times(IMPORT_TIME_OUTPUT), {'socket': 430, 'paramiko': 2580})
+
+    def test_import_times_untraced(self):
+        # As on Python before 3.7, without -X importtime
+        import_times = measure_import_times(['json', 'keepuppy_missing_module'], trace = False)
+
+        assert_true(import_times['json'] >= 0)
+        eq_(import_times['keepuppy_missing_module'], None)
+
+    def test_sampler(self):
+        sampler = StackSampler(0.001)
+        sampler.start()
+        busy_function()
+        sampler.stop()
+
+        assert_true(sampler.sample_count > 0)
+        assert_true(any('busy_function' in line for line in sampler.collapsed_lines()))
+
+    def test_profile(self):
+        with ProfileSession(self.file_prefix, 10):
+            busy_function()
+
+        stats = pstats.Stats(self.file_prefix + '.pstats')
+        assert_true(any(function_name == 'busy_function' for file_name, line, function_name in stats.stats))
+
+        with open(self.file_prefix + '.txt') as summary_file:
+            summary = summary_file.read()
+
+        assert_true('Top 10 functions by cumulative time' in summary)
+        if sys.version_info >= (3, 7):
+            assert_true('paramiko' in summary)
+
+        assert_false(os.path.exists(self.file_prefix + '.collapsed'))
+
+    def test_profile_collapsed(self):
+        with ProfileSession(self.file_prefix, collapsed = True):
+            busy_function()
+
+        with open(self.file_prefix + '.collapsed') as collapsed_file:
+            lines = collapsed_file.read().splitlines()
+
+        assert_true(any('busy_function' in line for line in lines))
+        assert_true(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 
-from keepuppy.sync import Syncer, HashCache
+from keepuppy.sync import Syncer, HashCache, SyncResult, plan_sync, COPY_TO_REMOTE, COPY_FROM_REMOTE
+from keepuppy.files import FileLocal
+from keepuppy.delta import signature
+from keepuppy.metrics import SyncMetrics
 from keepuppy.exceptions import FileException, HashCacheException, SyncException
 import os
 import tempfile
-from nose.tools import eq_, assert_true, raises, assert_raises
+import shutil
+from nose.tools import eq_, assert_true, assert_false, raises, assert_raises
 from datetime import datetime, timedelta
+from time import mktime
 import json
+import threading
 from mock import MagicMock
 from collections import namedtuple
 import logging
@@ -26,6 +32,8 @@ class FileMockGenerator(object):
 
         mock_file.name = file_name
         mock_file.key = 'mock|%s' % file_name
+        mock_file.server_hash.return_value = None
+        mock_file.fingerprint.side_effect = lambda: FileMockGenerator.fingerprint(mock_file)
 
         self.set_time(mock_file, datetime.utcnow())
         self.set_data(mock_file, HashCache.calculate_hash(file_name))
@@ -45,9 +53,15 @@ class FileMockGenerator(object):
         file_time = file_object.last_changed() + time_offset
         file_object.last_changed.return_value = FileMockGenerator.format_time(file_time)
 
+    @staticmethod
+    def fingerprint(file_object):
+        mtime_ns = int(mktime(file_object.last_changed.return_value.timetuple())) * 1000000000
+        return [mtime_ns, len(file_object.read.return_value), 0]
+
     @staticmethod
     def set_data(file_object, file_data):
         file_object.read.return_value = file_data
+        file_object.read_chunks.side_effect = lambda *args, **kwargs: iter([file_data])
 
 
 class TestHashCache(object):
@@ -77,12 +91,9 @@ class TestHashCache(object):
     def calculate_cache_data(file_object_list):
         cache_data = {}
         for file_object in file_object_list:
-            file_time = file_object.last_changed()
-            file_time_str = file_time.strftime('%Y-%m-%d %H:%M:%S')
-
             cache_key = file_object.key
             cache_data[cache_key] = {
-                'last_changed': file_time_str,
+                'fingerprint': file_object.fingerprint(),
                 'file_hash': HashCache.calculate_hash(file_object.read())
             }
 
@@ -199,10 +210,185 @@ class TestHashCache(object):
 
         self.compare_cache_data(mock_file_list)
 
+    def test_cache_set(self):
+        mock_file = self.file_mock_generator.get()
+
+        hash_cache = HashCache(self.file_cache.name)
+
+        hash_cache.set_hash(mock_file, HashCache.calculate_hash(mock_file.read()))
+
+        self.compare_cache_data([mock_file])
+
+        cache_data = hash_cache.get_hash(mock_file)
+
+        self.check_cache_result(cache_data,
+                                mock_file,
+                                False,
+                                False,
+                                False)
+        eq_(mock_file.read_chunks.call_count, 0)
+
+    def test_cache_signature(self):
+        mock_file = self.file_mock_generator.get()
+
+        hash_cache = HashCache(self.file_cache.name)
+
+        hash_cache.set_hash(mock_file, HashCache.calculate_hash(mock_file.read()), {'block_size': 16})
+        eq_(hash_cache.get_signature(mock_file), {'block_size': 16})
+
+        hash_cache.set_signature(mock_file, {'block_size': 32})
+        eq_(hash_cache.get_signature(mock_file), {'block_size': 32})
+
+        # A changed file no longer matches its signature
+        self.file_mock_generator.offset_time(mock_file, timedelta(seconds = 1))
+        eq_(hash_cache.get_signature(mock_file), None)
+
+        hash_cache.set_signature(mock_file, {'block_size': 64})
+        hash_cache.get_hash(mock_file)
+        eq_(hash_cache.get_signature(mock_file), None)
+
+    def test_cache_server_hash(self):
+        mock_file = self.file_mock_generator.get()
+        mock_file.server_hash.return_value = HashCache.calculate_hash(mock_file.read())
+
+        hash_cache = HashCache(self.file_cache.name)
+
+        cache_data = hash_cache.get_hash(mock_file)
+
+        self.check_cache_result(cache_data,
+                                mock_file,
+                                True,
+                                True,
+                                False)
+        eq_(mock_file.read_chunks.call_count, 0)
+
+    def test_cache_batch(self):
+        mock_file_list = [self.file_mock_generator.get(), self.file_mock_generator.get()]
+
+        hash_cache = HashCache(self.file_cache.name)
+
+        with hash_cache.batch():
+            with hash_cache.batch():
+                hash_cache.get_hash(mock_file_list[0])
+
+            hash_cache.get_hash(mock_file_list[1])
+
+            # Nothing is written until the outermost batch ends
+            assert_false(os.path.exists(self.file_cache.name))
+
+        self.compare_cache_data(mock_file_list)
+
+    def test_cache_batch_exception(self):
+        mock_file = self.file_mock_generator.get()
+
+        hash_cache = HashCache(self.file_cache.name)
+
+        try:
+            with hash_cache.batch():
+                hash_cache.get_hash(mock_file)
+                raise SyncException('')
+
+        except SyncException:
+            pass
+
+        self.compare_cache_data([mock_file])
+
+    def test_cache_replaced(self):
+        mock_file_list = [self.file_mock_generator.get(), self.file_mock_generator.get()]
+        self.write_cache_data(mock_file_list[:1])
+
+        hash_cache = HashCache(self.file_cache.name)
+        hash_cache.get_hash(mock_file_list[1])
+
+        self.compare_cache_data(mock_file_list)
+        assert_false(os.path.exists(self.file_cache.name + '.%d.tmp' % os.getpid()))
+
+    def test_calculate_hash_chunks(self):
+        file_data = b'0123456789' * 100
+        chunks = [file_data[offset:offset + 64] for offset in range(0, len(file_data), 64)]
+
+        eq_(HashCache.calculate_hash_chunks(chunks), HashCache.calculate_hash(file_data))
+        eq_(HashCache.calculate_hash_chunks([]), HashCache.calculate_hash(b''))
+
+    def test_cache_legacy(self):
+        mock_file = self.file_mock_generator.get()
+        with open(self.file_cache.name, 'w') as cache_file:
+            json.dump({mock_file.key: {'last_changed': '2015-01-01 00:00:00', 'file_hash': 'abcd'}}, cache_file)
+
+        hash_cache = HashCache(self.file_cache.name)
+
+        cache_data = hash_cache.get_hash(mock_file)
+
+        self.check_cache_result(cache_data,
+                                mock_file,
+                                False,
+                                True,
+                                True)
+
+        self.compare_cache_data([mock_file])
+
+    def test_cache_subsecond(self):
+        local_file = FileLocal(self.file_cache.name + '.local')
+        local_file.write(b'0123')
+        time_base = int(mktime(datetime.now().timetuple())) - 60
+        os.utime(local_file.name, (time_base, time_base + 0.25))
+
+        try:
+            hash_cache = HashCache(self.file_cache.name)
+            cache_data = hash_cache.get_hash(local_file)
+            eq_(cache_data.get('calculated'), True)
+
+            # Same size and second, but a later save
+            local_file.write(b'4567')
+            os.utime(local_file.name, (time_base, time_base + 0.5))
+
+            cache_data = hash_cache.get_hash(local_file)
+            eq_(cache_data.get('calculated'), True)
+            eq_(cache_data.get('updated'), True)
+            eq_(cache_data.get('file_hash'), HashCache.calculate_hash(b'4567'))
+
+            cache_data = hash_cache.get_hash(local_file)
+            eq_(cache_data.get('calculated'), False)
+
+        finally:
+            self.delete_file(local_file.name)
+
+    def test_unchanged(self):
+        file_list = [FileLocal(self.file_cache.name + suffix) for suffix in ('.local', '.remote')]
+        for file_object in file_list:
+            file_object.write(b'0123')
+
+        try:
+            hash_cache = HashCache(self.file_cache.name)
+            assert_false(hash_cache.unchanged(*file_list))
+
+            for file_object in file_list:
+                hash_cache.get_hash(file_object)
+
+            assert_true(hash_cache.unchanged(*file_list))
+
+            # Both files match their cache entries, but not each other
+            file_list[1].write(b'4567')
+            os.utime(file_list[1].name, (0, 60))
+            hash_cache.get_hash(file_list[1])
+            assert_false(hash_cache.unchanged(*file_list))
+
+        finally:
+            for file_object in file_list:
+                self.delete_file(file_object.name)
+
+    def test_unchanged_stops_early(self):
+        file_first = self.file_mock_generator.get()
+        file_first.fingerprint.side_effect = lambda: None
+        file_second = self.file_mock_generator.get()
+
+        assert_false(HashCache(self.file_cache.name).unchanged(file_first, file_second))
+        eq_(file_second.fingerprint.call_count, 0)
+
     @raises(FileException)
-    def test_exception_on_last_changed(self):
+    def test_exception_on_fingerprint(self):
         mock_file = self.file_mock_generator.get()
-        mock_file.last_changed.side_effect = FileException('')
+        mock_file.fingerprint.side_effect = FileException('')
 
         hash_cache = HashCache(self.file_cache.name)
 
@@ -212,6 +398,7 @@ class TestHashCache(object):
     def test_exception_on_read(self):
         mock_file = self.file_mock_generator.get()
         mock_file.read.side_effect = FileException('')
+        mock_file.read_chunks.side_effect = FileException('')
 
         hash_cache = HashCache(self.file_cache.name)
 
@@ -241,10 +428,10 @@ class TestSyncLogic(object):
 
     hash_lookup = {}
     syncer = None
-    local = 'local'
-    remote = 'remote'
+    local = MagicMock()
+    remote = MagicMock()
 
-    def hash_cache_lookup(self, file_key):
+    def hash_cache_lookup(self, file_key, file_hash = None):
         return self.hash_lookup.get(file_key)
 
     def setup(self):
@@ -316,6 +503,55 @@ class TestSyncLogic(object):
 
         self.check_calls(tp.copy_file_args, tp.backup_args, tp.update_func)
 
+    def test_invalidate_stat(self):
+        local = MagicMock()
+        remote = MagicMock()
+        self.hash_lookup[local] = self.generate_hash_result(datetime.utcnow(), 'abcd', False, False)
+        self.hash_lookup[remote] = self.generate_hash_result(datetime.utcnow(), 'abcd', False, False)
+
+        self.syncer.sync(local, remote)
+
+        eq_(local.invalidate_stat.call_count, 1)
+        eq_(remote.invalidate_stat.call_count, 1)
+
+    def test_concurrent_hashes(self):
+        # The local lookup only completes once the remote one has started, so this needs both to run at once
+        started = threading.Event()
+
+        def get_hash(file_object, file_hash = None):
+            if file_object is self.local:
+                assert_true(started.wait(5))
+
+            else:
+                started.set()
+
+            return self.generate_hash_result(datetime.utcnow(), 'abcd', False, False)
+
+        self.syncer.hash_cache.get_hash.side_effect = get_hash
+
+        eq_(self.syncer.sync(self.local, self.remote), 'Files are up to date')
+
+    def check_hash_error(self, local_error, remote_error, message):
+        def get_hash(file_object, file_hash = None):
+            error = local_error if file_object is self.local else remote_error
+            if error:
+                raise error
+
+            return self.generate_hash_result(datetime.utcnow(), 'abcd', False, False)
+
+        self.syncer.hash_cache.get_hash.side_effect = get_hash
+
+        with assert_raises(SyncException) as context:
+            self.syncer.sync(self.local, self.remote)
+
+        eq_(context.exception.args[0], message)
+
+    def test_hash_errors(self):
+        self.check_hash_error(FileException('Read failed'), None, 'Local file error')
+        self.check_hash_error(HashCacheException('Bad cache'), None, 'Local file error')
+        self.check_hash_error(None, FileException('Connection failed'), 'Remote file error')
+        self.check_hash_error(FileException('Read failed'), FileException('Connection failed'), 'Local file error')
+
     def test_logic(self):
         copy_from_remote = (self.remote, self.local)
         copy_to_remote = (self.local, self.remote)
@@ -342,3 +578,223 @@ class TestSyncLogic(object):
 
         for check_logic_args in check_logic_arg_list:
             yield self.check_logic, self.TestParams(*check_logic_args)
+
+
+class TestPlanSync(object):
+
+    @staticmethod
+    def file_info(file_hash, last_changed):
+        return {'file_hash': file_hash, 'last_changed': last_changed, 'created': False, 'updated': True}
+
+    def test_same_second(self):
+        # The remote change came later, but SFTP only has the second it was in
+        sync_plan = plan_sync(self.file_info('abcd', datetime(2020, 1, 1, 12, 0, 0, 500000)),
+                              self.file_info('efgh', datetime(2020, 1, 1, 12, 0, 0)))
+
+        eq_(sync_plan.copy, COPY_FROM_REMOTE)
+        assert_true(sync_plan.backup)
+        assert_true(sync_plan.conflict)
+
+    def test_later_second(self):
+        sync_plan = plan_sync(self.file_info('abcd', datetime(2020, 1, 1, 12, 0, 1, 500)),
+                              self.file_info('efgh', datetime(2020, 1, 1, 12, 0, 0)))
+
+        eq_(sync_plan.copy, COPY_TO_REMOTE)
+
+    def test_both_precise(self):
+        sync_plan = plan_sync(self.file_info('abcd', datetime(2020, 1, 1, 12, 0, 0, 500000)),
+                              self.file_info('efgh', datetime(2020, 1, 1, 12, 0, 0, 400000)))
+
+        eq_(sync_plan.copy, COPY_TO_REMOTE)
+
+
+class TestSyncMany(object):
+
+    syncer = None
+
+    def setup(self):
+        self.syncer = Syncer(MagicMock())
+
+    @staticmethod
+    def create_file_pairs(count):
+        return [(FileLocal('local%d' % index), FileLocal('remote%d' % index)) for index in range(count)]
+
+    def test_empty(self):
+        eq_(self.syncer.sync_many([]), [])
+
+    def test_results(self):
+        error = SyncException('Remote file error')
+
+        def sync(file_local, file_remote):
+            if file_local.name == 'local1':
+                raise error
+
+            return 'synced %s' % file_local.name
+
+        self.syncer.sync = MagicMock(side_effect = sync)
+
+        file_pairs = self.create_file_pairs(3)
+        sync_results = self.syncer.sync_many(file_pairs, 2)
+
+        eq_(sync_results, [SyncResult(file_pairs[0][0], file_pairs[0][1], 'synced local0', None),
+                           SyncResult(file_pairs[1][0], file_pairs[1][1], None, error),
+                           SyncResult(file_pairs[2][0], file_pairs[2][1], 'synced local2', None)])
+
+    def test_concurrent(self):
+        # The first pair only completes once the second has started, so this needs both to run at once
+        started = threading.Event()
+
+        def sync(file_local, file_remote):
+            if file_local.name == 'local0':
+                assert_true(started.wait(5))
+
+            else:
+                started.set()
+
+            return file_local.name
+
+        self.syncer.sync = MagicMock(side_effect = sync)
+
+        sync_results = self.syncer.sync_many(self.create_file_pairs(2), 2)
+
+        eq_([sync_result.error for sync_result in sync_results], [None, None])
+
+
+class TestSyncDelta(object):
+
+    file_data_old = b'0123456789' * 10
+    file_data_new = b'0123456789' * 5 + b'changed' + b'0123456789' * 5
+
+    def setup(self):
+        self.hash_cache = MagicMock()
+        self.hash_cache.block_size = 64
+        self.hash_cache.get_signature.return_value = signature([self.file_data_old], 16)
+
+        self.file_local = MagicMock(spec = FileLocal)
+        self.file_local.read_chunks.side_effect = lambda *args, **kwargs: iter([self.file_data_new])
+
+        self.file_remote = MagicMock()
+        self.file_remote.apply_delta.return_value = 7
+
+        self.syncer = Syncer(self.hash_cache, delta = True, delta_block_size = 16)
+
+    def test_delta(self):
+        self.file_remote.server_hash.side_effect = [HashCache.calculate_hash(self.file_data_old),
+                                                    HashCache.calculate_hash(self.file_data_new)]
+
+        self.syncer._copy_file(self.file_local, self.file_remote)
+
+        eq_(self.file_remote.apply_delta.call_count, 1)
+        eq_(self.file_remote.write_chunks.call_count, 0)
+        self.hash_cache.set_hash.assert_called_once_with(self.file_remote,
+                                                         HashCache.calculate_hash(self.file_data_new),
+                                                         signature([self.file_data_new], 16))
+
+    def test_delta_fallback(self):
+        self.file_remote.server_hash.return_value = None
+
+        self.syncer._copy_file(self.file_local, self.file_remote)
+
+        eq_(self.file_remote.apply_delta.call_count, 0)
+        eq_(self.file_remote.write_chunks.call_count, 1)
+        eq_(self.syncer.metrics.snapshot()['counters']['delta_fallbacks'], 1)
+        self.hash_cache.set_hash.assert_called_once_with(self.file_remote,
+                                                         HashCache.calculate_hash(self.file_data_new),
+                                                         signature([self.file_data_new], 16))
+
+    def test_delta_download(self):
+        self.file_remote.read_chunks.side_effect = lambda *args, **kwargs: iter([self.file_data_new])
+
+        self.syncer._copy_file(self.file_remote, self.file_local)
+
+        eq_(self.hash_cache.get_signature.call_count, 0)
+        self.hash_cache.set_hash.assert_called_once_with(self.file_local, HashCache.calculate_hash(self.file_data_new), None)
+        self.hash_cache.set_signature.assert_called_once_with(self.file_remote, signature([self.file_data_new], 16))
+
+    def test_delta_disabled(self):
+        syncer = Syncer(self.hash_cache)
+
+        syncer._copy_file(self.file_local, self.file_remote)
+
+        eq_(self.hash_cache.get_signature.call_count, 0)
+        eq_(self.file_remote.write_chunks.call_count, 1)
+
+
+class TestSyncBackup(object):
+
+    def setup(self):
+        self.backup_store = MagicMock()
+        self.file_local = MagicMock()
+
+    def test_backup_store(self):
+        syncer = Syncer(MagicMock(), backup_store = self.backup_store)
+
+        syncer._create_backup(self.file_local, True, file_hash = 'abcd')
+
+        self.backup_store.backup.assert_called_once_with(self.file_local, 'abcd', True)
+        eq_(self.file_local.copy.call_count, 0)
+
+    @raises(SyncException)
+    def test_backup_store_error(self):
+        self.backup_store.backup.side_effect = FileException('Error writing backup')
+        syncer = Syncer(MagicMock(), backup_store = self.backup_store)
+
+        syncer._create_backup(self.file_local)
+
+    def test_backup_copy(self):
+        syncer = Syncer(MagicMock())
+
+        syncer._create_backup(self.file_local)
+
+        eq_(self.file_local.copy.call_count, 1)
+
+
+class TestSyncMetrics(object):
+
+    file_data = b'0123456789' * 100
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        self.hash_cache = HashCache(os.path.join(self.temp_dir, 'cache.json'))
+        self.syncer = Syncer(self.hash_cache)
+
+        self.file_local = FileLocal(os.path.join(self.temp_dir, 'local.dat'))
+        self.file_local.write(self.file_data)
+        self.file_remote = FileLocal(os.path.join(self.temp_dir, 'remote.dat'))
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_copied(self):
+        self.syncer.sync(self.file_local, self.file_remote)
+
+        snapshot = self.syncer.metrics.snapshot()
+        eq_(snapshot['counters'], {'syncs': 1, 'cache_misses': 1})
+        eq_(snapshot['bytes_read'], {'local': len(self.file_data) * 2})
+        eq_(snapshot['bytes_written'], {'local': len(self.file_data)})
+        eq_(sorted(snapshot['phase_count']), ['hash', 'stat', 'sync', 'transfer'])
+
+    def test_cache_hits(self):
+        self.syncer.sync(self.file_local, self.file_remote)
+        self.syncer.metrics.reset()
+
+        eq_(self.syncer.sync(self.file_local, self.file_remote), 'Files are up to date')
+
+        snapshot = self.syncer.metrics.snapshot()
+        eq_(snapshot['counters'], {'syncs': 1, 'cache_hits': 2})
+        eq_(snapshot['bytes_read'], {})
+
+    def test_error(self):
+        os.unlink(self.file_local.name)
+
+        assert_raises(SyncException, self.syncer.sync, self.file_local, self.file_remote)
+
+        eq_(self.syncer.metrics.snapshot()['counters'], {'sync_errors': 1})
+
+    def test_shared(self):
+        metrics = SyncMetrics()
+
+        Syncer(self.hash_cache, metrics = metrics).sync(self.file_local, self.file_remote)
+
+        eq_(metrics.snapshot()['counters']['syncs'], 1)
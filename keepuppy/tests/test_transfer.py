@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+from keepuppy.files import FileLocal
+from keepuppy.transfer import Transfer, transfer
+from keepuppy.sync import HashCache
+from keepuppy.exceptions import FileException
+import os
+import tempfile
+from nose.tools import eq_, raises, assert_raises
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TestTransfer(object):
+
+    file_data = b'0123456789' * 10
+    missing_file_name = '/this/file/does/not/exist/and/path/ensures/write/will/fail'
+
+    file_source = None
+    file_destination = None
+
+    def setup(self):
+        temp_file = tempfile.NamedTemporaryFile(delete = False)
+        temp_file.write(self.file_data)
+        temp_file.close()
+
+        self.file_source = FileLocal(temp_file.name)
+        self.file_destination = FileLocal(temp_file.name + '.copy')
+
+    def teardown(self):
+        for file_name in [self.file_source.name, self.file_destination.name]:
+            try:
+                os.unlink(file_name)
+
+            except OSError:
+                pass
+
+    def test_transfer(self):
+        eq_(transfer(self.file_source, self.file_destination, 16), len(self.file_data))
+
+        eq_(self.file_destination.read(), self.file_data)
+
+    def test_progress(self):
+        progress_list = []
+
+        def func_progress(file_source, file_destination, bytes_transferred):
+            progress_list.append(bytes_transferred)
+
+        transfer_object = Transfer(self.file_source, self.file_destination, 32, func_progress)
+        transfer_object.run()
+
+        eq_(progress_list, [32, 64, 96, 100])
+        eq_(transfer_object.bytes_transferred, len(self.file_data))
+
+    def test_hash(self):
+        transfer_object = Transfer(self.file_source, self.file_destination, 32)
+        transfer_object.run()
+
+        eq_(transfer_object.file_hash, HashCache.calculate_hash(self.file_data))
+
+    def test_missing_source(self):
+        self.file_destination.write(self.file_data)
+
+        assert_raises(FileException, transfer, FileLocal(self.missing_file_name), self.file_destination)
+
+        eq_(self.file_destination.read(), self.file_data)
+
+    @raises(FileException)
+    def test_missing_destination(self):
+        transfer(self.file_source, FileLocal(self.missing_file_name))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+from keepuppy.watch import PollingWatcher, InotifyWatcher, watched_file_name
+import os
+import sys
+import tempfile
+import shutil
+import threading
+from nose.tools import eq_
+from nose.plugins.skip import SkipTest
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def test_watched_file_name():
+    eq_(watched_file_name(os.path.join('~', 'test.txt')), os.path.join(os.path.expanduser('~'), 'test.txt'))
+    eq_(watched_file_name('test.txt'), os.path.join(os.getcwd(), 'test.txt'))
+
+
+class WatcherTestBase(object):
+
+    file_data = b'012345'
+
+    temp_dir = None
+    file_name = None
+
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.temp_dir, 'test.txt')
+        self.write_file(self.file_name)
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_file(self, file_name):
+        with open(file_name, 'wb') as file_object:
+            file_object.write(self.file_data)
+
+    def create_watcher(self):
+        raise NotImplementedError
+
+    def write_later(self, func_write):
+        timer = threading.Timer(0.2, func_write)
+        timer.start()
+        return timer
+
+    def test_timeout(self):
+        with self.create_watcher() as watcher:
+            eq_(watcher.wait(0.2), [])
+
+    def test_write(self):
+        self.file_data += b'6789'
+
+        with self.create_watcher() as watcher:
+            timer = self.write_later(lambda: self.write_file(self.file_name))
+            eq_(watcher.wait(5), [self.file_name])
+            timer.join()
+
+    def test_replace(self):
+        file_name_temp = self.file_name + '.tmp'
+
+        def replace():
+            self.write_file(file_name_temp)
+            os.rename(file_name_temp, self.file_name)
+
+        with self.create_watcher() as watcher:
+            timer = self.write_later(replace)
+            eq_(watcher.wait(5), [self.file_name])
+            timer.join()
+
+    def test_other_file(self):
+        with self.create_watcher() as watcher:
+            timer = self.write_later(lambda: self.write_file(self.file_name + '.other'))
+            eq_(watcher.wait(0.5), [])
+            timer.join()
+
+
+class TestPollingWatcher(WatcherTestBase):
+
+    def create_watcher(self):
+        return PollingWatcher([self.file_name], 0.05)
+
+
+class TestInotifyWatcher(WatcherTestBase):
+
+    def setup(self):
+        if not sys.platform.startswith('linux'):
+            raise SkipTest('inotify is only available on Linux')
+
+        super(TestInotifyWatcher, self).setup()
+
+    def create_watcher(self):
+        return InotifyWatcher([self.file_name])
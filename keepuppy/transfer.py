@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from .files import DEFAULT_BLOCK_SIZE
+from .delta import SignatureBuilder
+from itertools import chain
+from hashlib import md5
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Transfer(object):
+    """Stream a file between any two file objects in fixed-size chunks, hashing the data as it passes."""
+
+    def __init__(self, file_source, file_destination, block_size = DEFAULT_BLOCK_SIZE, func_progress = None, signature_block_size = None):
+        self._file_source = file_source
+        self._file_destination = file_destination
+        self._block_size = block_size
+        self._func_progress = func_progress
+        self._signature_block_size = signature_block_size
+
+        self.bytes_transferred = 0
+        self.file_hash = None
+        self.signature = None
+
+    def run(self):
+        log.debug('Transfer (%s) to (%s)' % (self._file_source.key, self._file_destination.key))
+
+        self.bytes_transferred = 0
+        self.file_hash = None
+        self.signature = None
+        self._hash = md5()
+        # Build delta signatures of the data in transit too, if asked, so the next update can send only changes
+        self._signature_builder = SignatureBuilder(self._signature_block_size) if self._signature_block_size else None
+
+        # Read the first chunk before the destination is opened, so a missing source does not truncate it
+        chunks = self._chunks()
+        file_data = next(chunks, None)
+        if file_data is not None:
+            chunks = chain([file_data], chunks)
+
+        self._file_destination.write_chunks(chunks)
+        self.file_hash = self._hash.hexdigest()
+        if self._signature_builder:
+            self.signature = self._signature_builder.signature()
+
+        return self.bytes_transferred
+
+    def _chunks(self):
+        for file_data in self._file_source.read_chunks(self._block_size):
+            self.bytes_transferred += len(file_data)
+            self._hash.update(file_data)
+            if self._signature_builder:
+                self._signature_builder.update(file_data)
+
+            if self._func_progress:
+                self._func_progress(self._file_source, self._file_destination, self.bytes_transferred)
+
+            yield file_data
+
+
+def transfer(file_source, file_destination, block_size = DEFAULT_BLOCK_SIZE, func_progress = None):
+    return Transfer(file_source, file_destination, block_size, func_progress).run()
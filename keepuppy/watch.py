@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+from .exceptions import FileException
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from time import time, sleep
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_SETTLE_DELAY = 0.2
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def watched_file_name(file_name):
+    # The name a watcher reports changes to the file by
+    return os.path.abspath(os.path.expanduser(file_name))
+
+
+class WatcherBase(object):
+
+    def __init__(self, file_names, settle_delay = DEFAULT_SETTLE_DELAY):
+        self._file_names = [watched_file_name(file_name) for file_name in file_names]
+        self._settle_delay = settle_delay
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def wait(self, timeout = None):
+        time_end = time() + timeout if timeout is not None else None
+
+        changed = set(self._wait_changes(time_end))
+        if changed:
+            # Editors often save in several steps, so gather those into one change
+            changed.update(self._wait_changes(time() + self._settle_delay))
+
+        return sorted(changed)
+
+    def close(self):
+        pass
+
+    def _wait_changes(self, time_end):
+        raise NotImplementedError
+
+
+class PollingWatcher(WatcherBase):
+
+    def __init__(self, file_names, poll_interval = DEFAULT_POLL_INTERVAL, settle_delay = DEFAULT_SETTLE_DELAY):
+        super(PollingWatcher, self).__init__(file_names, settle_delay)
+
+        self._poll_interval = poll_interval
+        self._file_state = dict((file_name, self._stat(file_name)) for file_name in self._file_names)
+
+    @staticmethod
+    def _stat(file_name):
+        try:
+            stat = os.stat(file_name)
+            return stat.st_mtime, stat.st_size, stat.st_ino
+
+        except OSError:
+            return None
+
+    def _wait_changes(self, time_end):
+        while True:
+            changed = []
+            for file_name in self._file_names:
+                file_state = self._stat(file_name)
+                if file_state != self._file_state[file_name]:
+                    self._file_state[file_name] = file_state
+                    changed.append(file_name)
+
+            if changed:
+                return changed
+
+            if time_end is not None:
+                time_left = time_end - time()
+                if time_left <= 0:
+                    return []
+
+                sleep(min(self._poll_interval, time_left))
+
+            else:
+                sleep(self._poll_interval)
+
+
+class InotifyWatcher(WatcherBase):
+
+    # Watch the directories, as saving by writing a new file and renaming it replaces the watched inode
+    watch_mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, file_names, settle_delay = DEFAULT_SETTLE_DELAY):
+        super(InotifyWatcher, self).__init__(file_names, settle_delay)
+
+        self._libc = load_libc()
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise FileException('Unable to initialise inotify (%s)' % os.strerror(ctypes.get_errno()))
+
+        self._watch_dirs = {}
+        try:
+            for dir_name in set(os.path.dirname(file_name) for file_name in self._file_names):
+                wd = self._libc.inotify_add_watch(self._fd, dir_name.encode(sys.getfilesystemencoding()), self.watch_mask)
+                if wd < 0:
+                    raise FileException('Unable to watch directory (%s) (%s)' % (dir_name, os.strerror(ctypes.get_errno())))
+
+                self._watch_dirs[wd] = dir_name
+
+        except FileException:
+            self.close()
+            raise
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _wait_changes(self, time_end):
+        while True:
+            timeout = max(0, time_end - time()) if time_end is not None else None
+            readable, writable, errored = select.select([self._fd], [], [], timeout)
+            if not readable:
+                return []
+
+            changed = set(self._read_events()).intersection(self._file_names)
+            if changed:
+                return list(changed)
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+
+            raise
+
+        file_names = []
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+
+            name = data[offset:offset + name_length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+            offset += name_length
+
+            if wd in self._watch_dirs and name:
+                file_names.append(os.path.join(self._watch_dirs[wd], name))
+
+        return file_names
+
+
+def load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+
+    # Raises AttributeError when the C library has no inotify, e.g. MacOS X
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+    return libc
+
+
+def create_watcher(file_names, poll_interval = DEFAULT_POLL_INTERVAL):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(file_names)
+
+        except (OSError, AttributeError, FileException) as e:
+            log.warning('Unable to use inotify, polling for changes instead (%s)' % e)
+
+    return PollingWatcher(file_names, poll_interval)
@@ -9,6 +9,8 @@ import keepuppy
 import logging
 import os
 import subprocess
+import argparse
+from time import time
 
 
 DEFAULT_LOG_LEVEL = logging.INFO
@@ -16,6 +18,16 @@ DEFAULT_LOG_STREAM = sys.stderr
 DEFAULT_CACHE_FILE = '~/.keepuppy_cache.json'
 DEFAULT_HOST_NAME = 'localhost'
 DEFAULT_HOST_PORT = 22
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_SYNC_WORKERS = 4
+DEFAULT_DAEMON_INTERVAL = 360
+DEFAULT_DAEMON_KEEPALIVE = 30
+DEFAULT_DELTA_BLOCK_SIZE = 2048
+DEFAULT_BACKUP_MAX_COUNT = 50
+DEFAULT_BACKUP_MAX_AGE = 90
+DEFAULT_PROFILE_TOP = 30
+DEFAULT_LEASE_DURATION = 120
+DEFAULT_LEASE_TIMEOUT = 60
 
 
 class OptionError(Exception):
@@ -33,6 +45,31 @@ class Options(object):
         'remote_password': ('KEEPUPPY_SFTP_PASSWORD', None, False),
         'remote_host_name': ('KEEPUPPY_SFTP_HOST_NAME', DEFAULT_HOST_NAME, True),
         'remote_host_port': ('KEEPUPPY_SFTP_HOST_PORT', DEFAULT_HOST_PORT, True),
+        'remote_server_hash': ('KEEPUPPY_SFTP_SERVER_HASH', True, False),
+        'remote_pipelined': ('KEEPUPPY_SFTP_PIPELINED', True, False),
+        'remote_window_size': ('KEEPUPPY_SFTP_WINDOW_SIZE', None, False),
+        'remote_max_packet_size': ('KEEPUPPY_SFTP_MAX_PACKET_SIZE', None, False),
+        'block_size': ('KEEPUPPY_BLOCK_SIZE', DEFAULT_BLOCK_SIZE, True),
+        'sync_list': ('KEEPUPPY_SYNC_LIST', None, False),
+        'sync_workers': ('KEEPUPPY_SYNC_WORKERS', DEFAULT_SYNC_WORKERS, True),
+        'daemon_interval': ('KEEPUPPY_DAEMON_INTERVAL', DEFAULT_DAEMON_INTERVAL, True),
+        'backup_dir': ('KEEPUPPY_BACKUP_DIR', None, False),
+        'backup_max_count': ('KEEPUPPY_BACKUP_MAX_COUNT', DEFAULT_BACKUP_MAX_COUNT, True),
+        'backup_max_age': ('KEEPUPPY_BACKUP_MAX_AGE', DEFAULT_BACKUP_MAX_AGE, True),
+        'backup_compression': ('KEEPUPPY_BACKUP_COMPRESSION', None, False),
+        'fast_check': ('KEEPUPPY_FAST_CHECK', False, False),
+        'manifest_file': ('KEEPUPPY_MANIFEST_FILE', None, False),
+        'manifest_writer': ('KEEPUPPY_MANIFEST_WRITER', None, False),
+        'lease': ('KEEPUPPY_LEASE', None, False),
+        'lease_duration': ('KEEPUPPY_LEASE_DURATION', DEFAULT_LEASE_DURATION, True),
+        'lease_timeout': ('KEEPUPPY_LEASE_TIMEOUT', DEFAULT_LEASE_TIMEOUT, True),
+        'delta': ('KEEPUPPY_DELTA', False, False),
+        'delta_block_size': ('KEEPUPPY_DELTA_BLOCK_SIZE', DEFAULT_DELTA_BLOCK_SIZE, True),
+        'metrics_jsonl': ('KEEPUPPY_METRICS_JSONL', None, False),
+        'metrics_prometheus': ('KEEPUPPY_METRICS_PROMETHEUS', None, False),
+        'profile': ('KEEPUPPY_PROFILE', None, False),
+        'profile_top': ('KEEPUPPY_PROFILE_TOP', DEFAULT_PROFILE_TOP, True),
+        'profile_collapsed': ('KEEPUPPY_PROFILE_COLLAPSED', False, False),
     }
 
     @classmethod
@@ -50,6 +87,10 @@ class Options(object):
         raise OptionError("Unknown option '%s'" % item)
 
 
+def option_enabled(val):
+    return str(val).lower() not in ('', '0', 'false', 'no', 'off')
+
+
 def enable_logging(log_level = DEFAULT_LOG_LEVEL, log_stream = DEFAULT_LOG_STREAM):
     log = logging.getLogger("keepuppy")
     log.setLevel(log_level)
@@ -85,26 +126,222 @@ def restart_command(options):
     return restart_command_func
 
 
+def create_remote_file(options, remote_file):
+    return keepuppy.FileSFTP(remote_file,
+                             options.remote_user_name,
+                             options.remote_password,
+                             options.remote_host_name,
+                             int(options.remote_host_port),
+                             option_enabled(options.remote_server_hash),
+                             pipelined = option_enabled(options.remote_pipelined))
+
+
+def configure_connection_pool(options):
+    connection_pool = keepuppy.pool.connection_pool
+    if options.remote_window_size:
+        connection_pool.window_size = int(options.remote_window_size)
+
+    if options.remote_max_packet_size:
+        connection_pool.max_packet_size = int(options.remote_max_packet_size)
+
+
+def read_sync_list(options):
+    try:
+        with open(os.path.expanduser(options.sync_list)) as file_object:
+            lines = file_object.read().splitlines()
+
+    except IOError as e:
+        raise OptionError("Unable to read sync list '%s' (%s)" % (options.sync_list, e))
+
+    file_pairs = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        file_names = line.split('\t')
+        if len(file_names) != 2:
+            raise OptionError("Sync list line %d should be a local and a remote path separated by a tab" % line_number)
+
+        local_file, remote_file = [file_name.strip() for file_name in file_names]
+        file_pairs.append((keepuppy.FileLocal(os.path.expanduser(local_file)),
+                           create_remote_file(options, remote_file)))
+
+    return file_pairs
+
+
+def create_file_pairs(options):
+    if options.sync_list:
+        return read_sync_list(options)
+
+    return [(keepuppy.FileLocal(options.local_file), create_remote_file(options, options.remote_file))]
+
+
+def create_backup_store(options):
+    if not options.backup_dir:
+        return None
+
+    # A limit of 0 keeps backups forever
+    return keepuppy.BackupStore(options.backup_dir,
+                                int(options.backup_max_count) or None,
+                                int(options.backup_max_age) or None,
+                                options.backup_compression)
+
+
+def create_manifest(options):
+    if not options.manifest_file:
+        return None
+
+    return keepuppy.RemoteManifest(create_remote_file(options, options.manifest_file), options.manifest_writer)
+
+
+def create_locker(options):
+    if not option_enabled(options.lease):
+        return None
+
+    return keepuppy.RemoteLocker(duration = float(options.lease_duration), timeout = float(options.lease_timeout))
+
+
+def create_hash_cache(options):
+    return keepuppy.HashCache(options.cache_file, int(options.block_size))
+
+
+def create_syncer(options, hash_cache = None):
+    hash_cache = hash_cache or create_hash_cache(options)
+    return keepuppy.Syncer(hash_cache,
+                           restart_command(options),
+                           delta = option_enabled(options.delta),
+                           delta_block_size = int(options.delta_block_size),
+                           backup_store = create_backup_store(options),
+                           manifest = create_manifest(options),
+                           locker = create_locker(options))
+
+
+def create_metrics_exporters(options):
+    metrics_exporters = []
+    if options.metrics_jsonl:
+        metrics_exporters.append(keepuppy.JSONLinesExporter(options.metrics_jsonl))
+
+    if options.metrics_prometheus:
+        metrics_exporters.append(keepuppy.PrometheusTextfileExporter(options.metrics_prometheus))
+
+    return metrics_exporters
+
+
+def export_metrics(metrics_exporters, syncer):
+    for metrics_exporter in metrics_exporters:
+        try:
+            metrics_exporter.export(syncer.metrics)
+
+        except (IOError, OSError) as e:
+            # Metrics are not worth failing a sync over
+            print('Error writing metrics (%s)' % e, file = sys.stderr)
+
+
 def do_sync(options):
-    file_local = keepuppy.FileLocal(options.local_file)
+    if options.sync_list:
+        syncer = create_syncer(options)
+        metrics_exporters = create_metrics_exporters(options)
+        try:
+            do_sync_many(options, syncer, create_file_pairs(options))
+
+        finally:
+            export_metrics(metrics_exporters, syncer)
+
+        return
+
+    file_local, file_remote = create_file_pairs(options)[0]
+    hash_cache = create_hash_cache(options)
+
+    # When neither file has changed since the last sync, one stat of each is enough to finish
+    if option_enabled(options.fast_check) and hash_cache.unchanged(file_local, file_remote):
+        print('Files are up to date')
+        return
+
+    syncer = create_syncer(options, hash_cache)
+    metrics_exporters = create_metrics_exporters(options)
+    try:
+        status = syncer.sync(file_local, file_remote)
+        if status is not None:
+            print(status)
+
+    finally:
+        export_metrics(metrics_exporters, syncer)
+
+
+def do_sync_many(options, syncer, file_pairs):
+    sync_results = syncer.sync_many(file_pairs, int(options.sync_workers))
+
+    error_count = 0
+    for sync_result in sync_results:
+        if sync_result.error is not None:
+            error_count += 1
+            print('%s: Error: %s' % (sync_result.file_local.name, sync_result.error))
 
-    file_remote = keepuppy.FileSFTP(options.remote_file,
-                                    options.remote_user_name,
-                                    options.remote_password,
-                                    options.remote_host_name,
-                                    options.remote_host_port)
+        elif sync_result.status is not None:
+            print('%s: %s' % (sync_result.file_local.name, sync_result.status))
 
-    hash_cache = keepuppy.HashCache(options.cache_file)
-    syncer = keepuppy.Syncer(hash_cache, restart_command(options))
-    status = syncer.sync(file_local, file_remote)
-    if status is not None:
-        print(status)
+    if error_count:
+        raise keepuppy.SyncException('%d of %d files failed to sync' % (error_count, len(sync_results)))
 
 
-def keepuppy_sync():
+def do_daemon(options):
+    syncer = create_syncer(options)
+    metrics_exporters = create_metrics_exporters(options)
+    file_pairs = create_file_pairs(options)
+    daemon_interval = float(options.daemon_interval)
+
+    # Keep the SFTP session open between syncs rather than reconnecting each time
+    keepuppy.pool.connection_pool.idle_timeout = None
+    keepuppy.pool.connection_pool.keepalive = DEFAULT_DAEMON_KEEPALIVE
+
+    file_pair_lookup = dict((keepuppy.watch.watched_file_name(file_local.name), (file_local, file_remote))
+                            for file_local, file_remote in file_pairs)
+
+    with keepuppy.create_watcher(file_pair_lookup.keys()) as watcher:
+        sync_pairs = file_pairs
+        time_sync_all = time() + daemon_interval
+        while True:
+            # Any error is reported and the daemon carries on, e.g. writing the hash cache can fail with a full disk
+            try:
+                if sync_pairs:
+                    do_sync_many(options, syncer, sync_pairs)
+
+            except (keepuppy.SyncException, keepuppy.HashCacheException, keepuppy.FileException, IOError, OSError) as e:
+                print('Error:', e, file = sys.stderr)
+
+            export_metrics(metrics_exporters, syncer)
+
+            # Sync local changes as they happen, and everything at a fixed interval to pick up remote changes, which
+            # frequent saves of one file do not put off
+            changed = watcher.wait(max(0, time_sync_all - time()))
+            if time() >= time_sync_all:
+                sync_pairs = file_pairs
+                time_sync_all = time() + daemon_interval
+
+            else:
+                sync_pairs = [file_pair_lookup[file_name] for file_name in changed]
+
+
+def keepuppy_sync(args = None):
+    parser = argparse.ArgumentParser(description = 'Sync a KeePass database with an SFTP server.')
+    parser.add_argument('--daemon', action = 'store_true', help = 'keep running and sync whenever the local file changes')
+    args = parser.parse_args(args)
+
     enable_logging()
     options = Options()
-    do_sync(options)
+    configure_connection_pool(options)
+
+    func_run = do_daemon if args.daemon else do_sync
+    if options.profile:
+        # Only loaded when asked for, so normal runs do not pay for it
+        from keepuppy.profiling import ProfileSession
+
+        with ProfileSession(options.profile, int(options.profile_top), option_enabled(options.profile_collapsed)):
+            func_run(options)
+
+    else:
+        func_run(options)
 
 if __name__ == "__main__":
     try:
@@ -113,3 +350,6 @@ if __name__ == "__main__":
     except (OptionError, keepuppy.FileException, keepuppy.HashCacheException, keepuppy.SyncException) as e:
         print('Error:', e, file = sys.stderr)
         sys.exit(1)
+
+    except KeyboardInterrupt:
+        sys.exit(1)
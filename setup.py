@@ -26,7 +26,7 @@ setup(
     packages = ['keepuppy'],
     package_data = {
         '': ['README.rst', 'LICENSE', 'requirements.txt'],
-        'keepuppy': ['data/com.wamonite.keepuppy.plist']
+        'keepuppy': ['data/com.wamonite.keepuppy.plist', 'data/com.wamonite.keepuppy.daemon.plist']
     },
     scripts = ['keepuppy_sync.py', 'keepuppy_restart.py'],
     install_requires = ['paramiko', 'psutil'],